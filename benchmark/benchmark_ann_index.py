@@ -0,0 +1,72 @@
+"""
+Filename: benchmark_ann_index.py
+Description:
+    Compares the index types available to a Context on synthetic corpora. Vectors are drawn from a mixture of
+    Gaussian clusters, like embeddings of documents on a handful of topics, and normalized as Context does. Queries
+    are held out from the same distribution. Reports build (including training) time, recall@k against the exact
+    flat index, and p50/p99 latency of single-query searches.
+
+Usage:
+    python -m benchmark.benchmark_ann_index [--sizes 10000 100000 1000000] [--dimensions 256] [--k 10]
+                                            [--specs flat ivf hnsw ivfpq] [--queries 500]
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from src.service.index_spec import build_index
+
+
+def clustered_vectors(n: int, d: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centers = rng.standard_normal((clusters, d)).astype("float32")
+    vectors = np.empty((n, d), dtype="float32")
+    #generate in blocks so the 1M vector corpus doesn't need float64 temporaries of the same size
+    for start in range(0, n, 100000):
+        stop = min(n, start + 100000)
+        vectors[start:stop] = centers[rng.integers(0, clusters, stop - start)] + 0.5 * rng.standard_normal((stop - start, d), dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--specs", nargs="+", default=["flat", "ivf", "hnsw", "ivfpq"])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n in args.sizes:
+        vectors = clustered_vectors(n + args.queries, args.dimensions, max(10, n // 1000), rng)
+        vectors, queries = vectors[:n], vectors[n:]
+        print(f"{n} vectors x {args.dimensions} dimensions, {args.queries} queries, k={args.k}")
+
+        expected = None
+        for spec in args.specs:
+            start = time.perf_counter()
+            index = build_index(vectors, spec)
+            build_time = time.perf_counter() - start
+
+            latencies = []
+            found = np.empty((len(queries), args.k), dtype="int64")
+            for i, query in enumerate(queries):
+                start = time.perf_counter()
+                _, found[i] = index.search(query[None, :], args.k)
+                latencies.append(time.perf_counter() - start)
+
+            if expected is None:
+                #the first spec is the baseline; flat unless --specs says otherwise
+                expected = found
+            recall = np.mean([len(set(f) & set(e)) / args.k for f, e in zip(found, expected)])
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print(f"  {spec:>24}: build {build_time:7.2f} s, recall@{args.k} {recall:.3f}, p50 {p50:7.3f} ms, p99 {p99:7.3f} ms")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Filename: benchmark_async_load.py
+Description:
+    Load test of the async chat API: many concurrent conversations, each a few turns long, sent to the ASGI app
+    from src.app.asgi in this process against the local fake OpenAI server from the tests. Every turn embeds the
+    question, searches a context and waits for a completion with a fixed latency. The same load then goes through
+    the blocking CustomGPT.query on a fixed pool of worker threads, as a threaded WSGI server would run it.
+    Reports throughput, latency percentiles and the most requests the fake backend had in flight at once.
+
+Usage:
+    python -m benchmark.benchmark_async_load [--chats 300] [--turns 3] [--latency 0.3] [--chunks 5000] [--threads 32]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "test"))
+from asgi_client import asgi_request
+from fake_openai_server import FakeOpenAIServer, fake_embedding
+from src.app.asgi import create_asgi_app
+from src.service.context import Context
+from src.service.customGPT import CustomGPT
+from src.service.session_store import SessionStore
+
+
+def make_gpt(base_url: str, chunks: int) -> CustomGPT:
+    gpt = CustomGPT(name="bench", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                    initial_role="be brief", initial_context="", api_key="benchmark", base_url=base_url)
+    texts = [f"chunk {i} of the load test document" for i in range(chunks)]
+    gpt.add_context(Context("doc", "doc.docx", [[text, fake_embedding(text)] for text in texts], token_counts=[8] * chunks))
+    return gpt
+
+
+async def run_async(app, chats: int, turns: int) -> list:
+    async def chat(i):
+        latencies = []
+        session_id = None
+        for turn in range(turns):
+            start = time.perf_counter()
+            status, _, body = await asgi_request(app, "POST", "/chat/query",
+                                                 {"gpt_name": "bench", "message": f"chat {i} question {turn}", "session_id": session_id})
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError(f"chat {i} got status {status}: {body}")
+            session_id = json.loads(body)["session_id"]
+        return latencies
+
+    return [latency for latencies in await asyncio.gather(*[chat(i) for i in range(chats)]) for latency in latencies]
+
+
+def run_threads(gpt: CustomGPT, chats: int, turns: int, threads: int) -> list:
+    #each chat's turns are queued in order, like requests from one user who waits for every answer
+    def chat(i):
+        latencies = []
+        history = gpt.new_chat_history()
+        for turn in range(turns):
+            start = time.perf_counter()
+            gpt.query(f"chat {i} question {turn}", chat_history=history)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return [latency for latencies in executor.map(chat, range(chats)) for latency in latencies]
+
+
+def report(name: str, latencies: list, elapsed: float, server: FakeOpenAIServer) -> None:
+    latencies = sorted(latencies)
+    print(f"{name:<24} {len(latencies) / elapsed:8.1f} turns/s  total {elapsed:6.2f} s  "
+          f"p50 {statistics.median(latencies) * 1000:7.0f} ms  p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.0f} ms  "
+          f"max in flight {server.max_in_flight}")
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=300, help="concurrent conversations")
+    parser.add_argument("--turns", type=int, default=3, help="questions per conversation")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds the fake backend takes per request")
+    parser.add_argument("--chunks", type=int, default=5000, help="chunks in the searched context")
+    parser.add_argument("--threads", type=int, default=32, help="worker threads for the blocking baseline; 0 to skip it")
+    args = parser.parse_args()
+
+    print(f"{args.chats} conversations of {args.turns} turns, {args.latency * 1000:.0f} ms per backend request, "
+          f"{args.chunks} chunks searched per turn")
+
+    with FakeOpenAIServer(latency=args.latency) as server:
+        gpt = make_gpt(server.base_url, args.chunks)
+        app = create_asgi_app(SessionStore(lambda name: gpt if name == "bench" else None, max_sessions=args.chats))
+        start = time.perf_counter()
+        latencies = asyncio.run(run_async(app, args.chats, args.turns))
+        report("async (ASGI app)", latencies, time.perf_counter() - start, server)
+
+    if args.threads > 0:
+        with FakeOpenAIServer(latency=args.latency) as server:
+            gpt = make_gpt(server.base_url, args.chunks)
+            start = time.perf_counter()
+            latencies = run_threads(gpt, args.chats, args.turns, args.threads)
+            report(f"blocking ({args.threads} threads)", latencies, time.perf_counter() - start, server)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
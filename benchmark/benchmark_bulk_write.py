@@ -0,0 +1,52 @@
+"""
+Filename: benchmark_bulk_write.py
+Description:
+    Times writing a large synthetic context with context_db_connection.write_context (one transaction, executemany
+    for the chunk rows, index file moved into place after commit) and reading it back, using a temporary database
+    and faiss folder.
+
+Usage:
+    python -m benchmark.benchmark_bulk_write [--chunks 50000] [--dimensions 1536]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from src.data.connection_pool import close_pool
+from src.data.context_database import context_db_connection
+from src.service.context import Context
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    embeddings = [[f"chunk {i} " + "lorem ipsum " * 100, rng.standard_normal(args.dimensions).astype("float32")] for i in range(args.chunks)]
+    context = Context("bulk", "bulk.docx", embeddings)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_name = os.path.join(tmp_dir, "bulk.db")
+        db_connection = context_db_connection(db_name, faiss_dir=tmp_dir)
+        db_connection.initialize_with_entries()
+
+        start = time.perf_counter()
+        context_id = db_connection.write_context(context)
+        elapsed = time.perf_counter() - start
+        print(f"write: {args.chunks} chunks x {args.dimensions} dimensions in {elapsed:.2f}s ({args.chunks / elapsed:,.0f} chunks/sec)")
+
+        start = time.perf_counter()
+        db_connection.read_context_by_id(context_id)
+        print(f" read: {time.perf_counter() - start:.2f}s")
+        close_pool(db_name)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
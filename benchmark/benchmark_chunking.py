@@ -0,0 +1,84 @@
+"""
+Filename: benchmark_chunking.py
+Description:
+    Measures chunking throughput (tokens/sec) on a synthetic 1000 page document for the token-offset chunker in
+    src/service/chunking.py. The old word-by-word loop that re-encoded the chunk after every word is timed on a
+    small sample of pages for comparison, since running it on the whole document takes far too long.
+
+Usage:
+    python -m benchmark.benchmark_chunking [--pages 1000] [--chunk-size 500] [--overlap 0] [--legacy-pages 10]
+"""
+import argparse
+import random
+import time
+
+import tiktoken
+
+from src.service.chunking import chunk_token_spans
+
+WORDS = ("curtain wall mullion transom glazing unit spandrel panel anchor thermal break condensation "
+         "resistance pressure equalized rainscreen sealant gasket deflection wind load aluminum extrusion "
+         "insulating glass coating emissivity conductance fenestration assembly").split()
+
+
+def synthetic_document(n_pages: int, words_per_page: int = 500, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(n_pages):
+        sentences = []
+        n_words = 0
+        while n_words < words_per_page:
+            length = rng.randint(8, 25)
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + ".")
+            n_words += length
+        pages.append(" ".join(sentences))
+    return "\n".join(pages)
+
+
+def legacy_chunks(text: str, encoding, chunk_size: int) -> list:
+    #the loop previously inlined in CustomGPT.add_context_from_docx/add_context_from_pdf
+    chunks = []
+    chunk = []
+    for word in text.split():
+        chunk.append(word)
+        if len(encoding.encode(" ".join(chunk))) > chunk_size:
+            chunks.append(" ".join(chunk[:-1]))
+            chunk = [word]
+    if chunk:
+        chunks.append(" ".join(chunk))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--overlap", type=int, default=0)
+    parser.add_argument("--model", default="gpt-4-turbo")
+    parser.add_argument("--legacy-pages", type=int, default=10, help="pages to run the old chunker on; 0 to skip")
+    args = parser.parse_args()
+
+    encoding = tiktoken.encoding_for_model(args.model)
+    text = synthetic_document(args.pages)
+    n_tokens = len(encoding.encode(text))
+    print(f"Document: {args.pages} pages, {len(text):,} characters, {n_tokens:,} tokens")
+
+    for boundary in ["token", "word", "sentence", "paragraph"]:
+        start = time.perf_counter()
+        spans = chunk_token_spans(text, encoding, args.chunk_size, args.overlap, boundary)
+        elapsed = time.perf_counter() - start
+        print(f"{boundary:>10}: {len(spans):6d} chunks in {elapsed:7.3f}s -> {n_tokens / elapsed:12,.0f} tokens/sec")
+
+    if args.legacy_pages > 0:
+        sample = synthetic_document(args.legacy_pages)
+        sample_tokens = len(encoding.encode(sample))
+        start = time.perf_counter()
+        legacy_chunks(sample, encoding, args.chunk_size)
+        elapsed = time.perf_counter() - start
+        print(f"{'legacy':>10}: {args.legacy_pages} page sample in {elapsed:7.3f}s -> {sample_tokens / elapsed:12,.0f} tokens/sec")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
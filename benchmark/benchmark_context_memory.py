@@ -0,0 +1,76 @@
+"""
+Filename: benchmark_context_memory.py
+Description:
+    Measures the resident memory taken by loading a context from the database, with the FAISS index read into
+    memory alongside the numpy vectors from SQLite (the default), and with the index memory-mapped and only the chunk
+    texts kept in Python (mmap_indexes=True). Each mode is loaded in a fresh subprocess so the two measurements
+    don't share allocations. Anonymous RSS is private memory; file-backed RSS is pages of the mapped index file,
+    which are shared with the OS page cache and can be reclaimed under memory pressure.
+
+Usage:
+    python -m benchmark.benchmark_context_memory [--db db/gpt-database.db] [--context curtainwall101]
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+
+def rss_kb() -> dict:
+    #linux only; /proc/self/status splits resident memory into anonymous and file-backed pages
+    status = dict(line.split(":", 1) for line in open("/proc/self/status"))
+    return {key: int(status[key].split()[0]) for key in ["VmRSS", "RssAnon", "RssFile"]}
+
+
+def measure(db_name: str, context_name: str, mmap: bool) -> dict:
+    import gc
+    import faiss
+    import numpy as np
+    from src.data.context_database import context_db_connection
+
+    #touch the faiss search code first so its lazily loaded pages aren't counted against the context
+    warm_up = faiss.IndexFlatL2(8)
+    warm_up.add(np.zeros((1, 8), dtype="float32"))
+    warm_up.search(np.zeros((1, 8), dtype="float32"), 1)
+
+    db_connection = context_db_connection(db_name, mmap_indexes=mmap)
+    gc.collect()
+    before = rss_kb()
+    context = db_connection.read_context_by_name(context_name)
+    gc.collect()
+    loaded = rss_kb()
+    context.query_similar(np.random.default_rng(0).standard_normal(context.index.d), k=5)
+    searched = rss_kb()
+
+    index_bytes = context.index.ntotal * context.index.d * 4
+    return {"before": before, "loaded": loaded, "searched": searched, "index_kb": index_bytes // 1024, "chunks": len(context.chunks)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=str(Path(__file__).parent.parent / "db" / "gpt-database.db"))
+    parser.add_argument("--context", default="curtainwall101")
+    parser.add_argument("--measure", choices=["memory", "mmap"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        print(json.dumps(measure(args.db, args.context, args.measure == "mmap")))
+        return
+
+    for mode in ["memory", "mmap"]:
+        output = subprocess.run([sys.executable, "-m", "benchmark.benchmark_context_memory", "--db", args.db,
+                                 "--context", args.context, "--measure", mode],
+                                capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        growth = {key: result["loaded"][key] - result["before"][key] for key in result["before"]}
+        after_search = {key: result["searched"][key] - result["before"][key] for key in result["before"]}
+        print(f"{mode:>6}: {result['chunks']} chunks, index {result['index_kb']:,} kB | "
+              f"RSS after load +{growth['VmRSS']:,} kB (anon +{growth['RssAnon']:,}, file +{growth['RssFile']:,}) | "
+              f"after search +{after_search['VmRSS']:,} kB (anon +{after_search['RssAnon']:,}, file +{after_search['RssFile']:,})")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
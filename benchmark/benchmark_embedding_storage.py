@@ -0,0 +1,70 @@
+"""
+Filename: benchmark_embedding_storage.py
+Description:
+    Compares loading a context's embeddings from the legacy comma separated text format against float32 BLOBs
+    decoded with np.frombuffer, on a synthetic context written to a temporary database. Reports load time,
+    database size and whether the vectors round-trip exactly.
+
+Usage:
+    python -m benchmark.benchmark_embedding_storage [--chunks 5000] [--dimensions 1536] [--repeats 5]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from src.data.context_database import context_db_connection, embeddings_from_rows, vector_to_db
+
+
+def write_rows(db_name: str, vectors: np.ndarray, as_text: bool) -> None:
+    context_db_connection(db_name).initialize_with_entries()
+    conn = sqlite3.connect(db_name)
+    conn.execute('''INSERT INTO context (id, name, origin_filename, faiss_index_filename) VALUES (1, 'bench', 'bench.docx', 'bench.faiss')''')
+    conn.executemany('''INSERT INTO context_embeddings (context_id, chunk_index, chunk_text, embedding_vector) VALUES (1, ?, ?, ?)''',
+                     [(i, f"chunk {i}", ",".join(map(str, vector)) if as_text else vector_to_db(vector)) for i, vector in enumerate(vectors)])
+    conn.commit()
+    conn.close()
+    return
+
+
+def load_rows(db_name: str) -> list:
+    conn = sqlite3.connect(db_name)
+    rows = conn.execute('''SELECT chunk_text, embedding_vector FROM context_embeddings WHERE context_id = 1 ORDER BY chunk_index ASC''').fetchall()
+    conn.close()
+    return embeddings_from_rows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    vectors = np.random.default_rng(0).standard_normal((args.chunks, args.dimensions)).astype("float32")
+    print(f"{args.chunks} chunks x {args.dimensions} dimensions")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, as_text in [("text", True), ("blob", False)]:
+            db_name = os.path.join(tmp_dir, f"{label}.db")
+            write_rows(db_name, vectors, as_text)
+
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                embeddings = load_rows(db_name)
+                timings.append(time.perf_counter() - start)
+
+            exact = all(np.array_equal(vectors[i], e[1]) for i, e in enumerate(embeddings))
+            size_mb = os.path.getsize(db_name) / 1024 / 1024
+            print(f"{label:>5}: best load {min(timings) * 1000:9.1f} ms, median {sorted(timings)[len(timings) // 2] * 1000:9.1f} ms, "
+                  f"db size {size_mb:8.1f} MB, exact round trip: {exact}")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
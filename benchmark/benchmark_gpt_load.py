@@ -0,0 +1,77 @@
+"""
+Filename: benchmark_gpt_load.py
+Description:
+    Measures the cold-load time of one small GPT while the rest of the database grows. Filler contexts are written
+    directly to the tables so the benchmark doesn't need an embeddings endpoint. With the foreign-key indexes and
+    set-based loading the load time should stay flat as the filler grows, since it only depends on the GPT's own rows.
+
+Usage:
+    python -m benchmark.benchmark_gpt_load [--filler 0 20000 100000] [--dimensions 256] [--repeats 5]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+os.environ.setdefault("API_KEY", "benchmark")
+
+from src.data.connection_pool import close_pool
+from src.data.context_database import context_db_connection, vector_to_db
+from src.service.context import Context
+from src.service.customGPT import CustomGPT
+
+
+def add_filler(db_name: str, chunks: int, dimensions: int, chunks_per_context: int = 500) -> None:
+    rng = np.random.default_rng(1)
+    conn = sqlite3.connect(db_name)
+    for start in range(0, chunks, chunks_per_context):
+        cursor = conn.execute('''INSERT INTO context (name, origin_filename, faiss_index_filename) VALUES (?, 'filler.docx', 'unused.faiss')''', (f"filler_{start}",))
+        vectors = rng.standard_normal((min(chunks_per_context, chunks - start), dimensions)).astype("float32")
+        conn.executemany('''INSERT INTO context_embeddings (context_id, chunk_index, chunk_text, embedding_vector) VALUES (?, ?, ?, ?)''',
+                         [(cursor.lastrowid, i, f"filler chunk {i}", vector_to_db(vector)) for i, vector in enumerate(vectors)])
+    conn.commit()
+    conn.close()
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filler", type=int, nargs="+", default=[0, 20000, 100000])
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    faiss.omp_set_num_threads(1)
+
+    for filler in args.filler:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_name = os.path.join(tmp_dir, "bench.db")
+            db_connection = context_db_connection(db_name, faiss_dir=tmp_dir)
+            db_connection.initialize_with_entries()
+
+            gpt = CustomGPT(name="Benchgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                            initial_role="", initial_context="", api_key=os.environ["API_KEY"])
+            for i in range(4):
+                vectors = rng.standard_normal((200, args.dimensions)).astype("float32")
+                gpt.add_context(Context(f"bench_{i}", "bench.docx", [[f"chunk {j}", v] for j, v in enumerate(vectors)]))
+            db_connection.write_custom_gpt(gpt)
+            add_filler(db_name, filler, args.dimensions)
+
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                db_connection.read_custom_gpt_by_name("Benchgpt")
+                timings.append(time.perf_counter() - start)
+            print(f"{filler:>7} filler chunks: best load {min(timings) * 1000:7.1f} ms, median {sorted(timings)[len(timings) // 2] * 1000:7.1f} ms")
+            close_pool(db_name)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Filename: benchmark_index_build.py
+Description:
+    Measures how long Context.generate_faiss_index takes to build a flat index for a large context, against the
+    previous approach of normalizing each vector in a Python list comprehension. Embeddings are a list of
+    [chunk, vector] pairs whose vectors are row views of one matrix, as they are after loading from the database.
+
+Usage:
+    python -m benchmark.benchmark_index_build [--chunks 100000] [--dimensions 1536] [--repeats 3]
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from src.service.context import Context
+
+
+def build_per_vector(embeddings: list) -> faiss.Index:
+    index = faiss.IndexFlatL2(len(embeddings[0][1]))
+    vectors = np.array([e[1] / np.linalg.norm(e[1]) for e in embeddings])
+    index.add(vectors)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    matrix = np.random.default_rng(0).standard_normal((args.chunks, args.dimensions), dtype="float32")
+    embeddings = [[f"chunk {i}", matrix[i]] for i in range(args.chunks)]
+    print(f"{args.chunks} chunks x {args.dimensions} dimensions")
+
+    builds = [("per-vector", lambda: build_per_vector(embeddings))]
+    for metric in ["l2", "cosine"]:
+        context = Context("bench", "bench.docx", embedding_model="bench", metric=metric)
+        context.embeddings = embeddings
+        builds.append((f"vectorized {metric}", context.generate_faiss_index))
+
+    for label, build in builds:
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            build()
+            timings.append(time.perf_counter() - start)
+        print(f"{label:>17}: best {min(timings):6.2f} s, median {sorted(timings)[len(timings) // 2]:6.2f} s")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Filename: benchmark_ttft.py
+Description:
+    Compares time to first token of CustomGPT.query_stream against CustomGPT.query, which can't show anything until
+    the whole completion has arrived. Uses the local fake OpenAI server from the tests, set up with a fixed time to
+    first byte and a fixed generation time per word, so the numbers isolate the effect of streaming.
+
+Usage:
+    python -m benchmark.benchmark_ttft [--latency 0.3] [--token-latency 0.02] [--words 200] [--repeats 5]
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "test"))
+from fake_openai_server import FakeOpenAIServer
+from src.service.customGPT import CustomGPT
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the server starts answering")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds per generated word")
+    parser.add_argument("--words", type=int, default=200, help="length of the answer in words")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    #the fake server echoes the message, so the answer is about as long as the question
+    message = " ".join(["word"] * args.words)
+    with FakeOpenAIServer(latency=args.latency, token_latency=args.token_latency) as server:
+        gpt = CustomGPT(name="bench", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                        initial_role="", initial_context="", api_key="benchmark", base_url=server.base_url)
+
+        blocking = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            gpt.query(message, retrieve_relevant_context=False, chat_history=gpt.new_chat_history())
+            blocking.append(time.perf_counter() - start)
+
+        first_token, total = [], []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            for i, _ in enumerate(gpt.query_stream(message, retrieve_relevant_context=False, chat_history=gpt.new_chat_history())):
+                if i == 0:
+                    first_token.append(time.perf_counter() - start)
+            total.append(time.perf_counter() - start)
+
+    print(f"answer of {args.words + 1} words, {args.latency * 1000:.0f} ms to first byte, {args.token_latency * 1000:.0f} ms per word")
+    print(f"blocking query:  first text after {statistics.median(blocking) * 1000:8.1f} ms (median of {args.repeats})")
+    print(f"streaming query: first text after {statistics.median(first_token) * 1000:8.1f} ms, "
+          f"complete after {statistics.median(total) * 1000:8.1f} ms")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,23 @@ Author: Matthew Gardner
 Created: 2025-06-20
 Description:
     This script is for populating the database of custom gpt configurations and relevant contexts with default values.
+    Documents are parsed in parallel and embedded a few at a time; each finished document is checkpointed, so an
+    interrupted run picks up where it stopped and a rerun only ingests documents that changed.
 
 Usage:
-
+    python -m bootstrap.create_default_gpts [--reset] [--parse-workers N] [--embedding-workers N]
 """
 
 from src.service.customGPT import CustomGPT
 from src.data.context_database import context_db_connection
+from src.data.embedding_cache import embedding_cache_db_connection
+from src.service.extraction import SUPPORTED_SUFFIXES
+from src.service.ingestion import ingest_documents
 
+import argparse
 import dotenv
 import os
+import sqlite3
 from pathlib import Path
 
 dotenv.load_dotenv(Path(__file__).parent.parent.resolve() / "auth" / ".env")
@@ -29,41 +36,72 @@ create_gpts=[{"name":"BuddBot",
               "docs_for_context":["curtainwall101.docx"]
               }]
 
-#connect to database
-db_connection=context_db_connection(Path(__file__).parent.parent.resolve() / "db" / "gpt-database.db")
+def main():
+    """
+    Parse the command line, ingest the default GPTs' documents and write the GPTs. Document parsing runs in worker
+    processes, which import this module again when they are spawned (the default on Windows and macOS), so nothing
+    may run at import time; everything happens here, behind the __main__ guard.
+    """
+    parser = argparse.ArgumentParser(description="Create the default GPTs and ingest their documents.")
+    parser.add_argument("--reset", action="store_true", help="recreate the database, discarding every GPT, context and checkpoint")
+    parser.add_argument("--parse-workers", type=int, default=None, help="processes parsing documents (default: one per CPU, 0 for none)")
+    parser.add_argument("--embedding-workers", type=int, default=2, help="documents embedded at once")
+    args = parser.parse_args()
+
+    #connect to database, bringing an existing one up to the current schema
+    db_connection=context_db_connection(Path(__file__).parent.parent.resolve() / "db" / "gpt-database.db", migrate=True)
+    embedding_cache=embedding_cache_db_connection(Path(__file__).parent.parent.resolve() / "db" / "gpt-database.db") #reruns only embed chunks that changed
 
-#uncomment this section if you'd like to reset the database and enter all new gpts
+    #only start over when asked to or when there is no database yet, so reruns keep completed documents
+    try:
+        db_connection.get_all_gpt_info()
+        reset = args.reset
+    except sqlite3.OperationalError:
+        reset = True
+    if reset:
+        db_connection.initialize_with_entries()
 
-db_connection.initialize_with_entries()
-for gpt in create_gpts:
-    created_gpt=CustomGPT(name=gpt["name"],
-                   model=gpt["model"],
-                   context_embedding_model=gpt["context_embedding_model"],
-                   initial_role=gpt["initial_role"],
-                   initial_context=gpt["initial_context"],
-                   api_key=os.getenv("API_KEY")
-                   )
-    for doc in gpt["docs_for_context"]:
-        if db_connection.read_context_by_name(os.path.basename(doc)) is not None:
-            created_gpt.add_context(db_connection.read_context_by_name(os.path.basename(doc)))
-        else:
+    for gpt in create_gpts:
+        created_gpt=CustomGPT(name=gpt["name"],
+                       model=gpt["model"],
+                       context_embedding_model=gpt["context_embedding_model"],
+                       initial_role=gpt["initial_role"],
+                       initial_context=gpt["initial_context"],
+                       embedding_cache=embedding_cache,
+                       api_key=os.getenv("API_KEY")
+                       )
+        doc_paths=[]
+        for doc in gpt["docs_for_context"]:
             file_path=Path(__file__).parent.parent.resolve() / "documents" / f"{doc}"
-            if file_path.exists() and file_path.suffix.lower() == ".docx":
-                created_gpt.add_context_from_docx(context_name=os.path.splitext(os.path.basename(doc))[0],
-                                                  doc_name=str(file_path),
-                                                  chunk_size=1000)
-            elif file_path.exists() and file_path.suffix.lower() == ".pdf":
-                pass
+            if file_path.exists() and file_path.suffix.lower() in SUPPORTED_SUFFIXES:
+                doc_paths.append(file_path)
             else:
                 print(f"{file_path} is not a supported document type or does not exist.")
-    try:
-        db_connection.write_custom_gpt(created_gpt)
-    except Exception as e:
-        print(e)
-        print(f"{created_gpt.name} was not created; issue adding to database")
+        try:
+            ingest_documents(db_connection, created_gpt, doc_paths, chunk_size=1000,
+                             parse_workers=args.parse_workers, embedding_workers=args.embedding_workers)
+        except RuntimeError as e:
+            print(e)
+            print(f"{created_gpt.name} was not created; rerun to retry the documents that failed")
+            continue
+        try:
+            #replace the GPT in one transaction, so the old one is kept if writing the new one fails
+            with db_connection.transaction(write=True):
+                db_connection.delete_custom_gpt_by_name(created_gpt.name)
+                db_connection.write_custom_gpt(created_gpt)
+        except Exception as e:
+            print(e)
+            print(f"{created_gpt.name} was not created; issue adding to database")
+
+    #db/gpt-database.db is committed to the repository, and its -wal file is not
+    db_connection.pool.checkpoint()
+
+    #test a gpt
+    test_gpt:CustomGPT=db_connection.read_custom_gpt_by_name("BuddBot")
 
+    print(test_gpt.query("Who does the author of the technical document appear to be?"))
+    return
 
-#test a gpt
-test_gpt:CustomGPT=db_connection.read_custom_gpt_by_name("BuddBot")
 
-print(test_gpt.query("Who does the author of the technical document appear to be?"))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -9,18 +9,29 @@ print(sys.executable)
 from flask import Flask, send_from_directory
 from pathlib import Path
 
+from src.app import routes
 from src.app.routes import chat_blueprint
+from src.app.state import check_database, start_background_tasks
 from flask_cors import CORS
 
 import dotenv
 import os
 dotenv.load_dotenv("..//..//auth//.env")
 
-def create_app():
+def create_app(preload : bool = None, reload_interval : float = None):
+    """
+    :param preload: load every GPT in the background at startup instead of on its first query; defaults to the
+                    PRELOAD_GPTS environment variable
+    :param reload_interval: seconds between checks for GPTs changed in the database, which are then reloaded in
+                            the background; 0 to never check. Defaults to the RELOAD_INTERVAL_SECONDS environment variable
+    """
+    #an unmigrated database stops the server here instead of failing every request
+    check_database()
     app = Flask(__name__)
     CORS(app, origins=[
         "http://localhost:4200"])  # delete in production; this is just allowing cross origin communication for angular dev server
     app.register_blueprint(chat_blueprint,url_prefix='/chat')
+    start_background_tasks(routes.session_store, preload, reload_interval)
 
     angular_dist_path=Path(__file__).parent.parent.parent / "frontend" / "dist" / "custom-gpt-frontend" / "browser"
     print(angular_dist_path)
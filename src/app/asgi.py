@@ -0,0 +1,192 @@
+"""
+Filename: asgi.py
+Description:
+    Asyncio entry point for the chat API, beside the Flask app from create_app. It serves the same /chat routes as
+    routes.py, but answers with CustomGPT.aquery and aquery_stream. While a request waits on OpenAI it holds no
+    thread, so one process can keep hundreds of conversations in flight. Index search and database reads run in
+    the default thread executor.
+    This is a plain ASGI application, so it has no dependencies beyond the service code. Run it with any ASGI server.
+    The Angular frontend is still served by the Flask app.
+
+Usage:
+    uvicorn src.app.asgi:app --port 5000
+"""
+from src.app.state import get_all_gpt_info, create_session_store, check_database, start_background_tasks, admin_authorized, valid_queries
+from src.service.session_store import SessionStore
+import asyncio
+import json
+import os
+import uuid
+
+import dotenv
+dotenv.load_dotenv("..//..//auth//.env")
+
+
+async def read_json(receive) -> dict:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    return json.loads(body or b"{}")
+
+async def send_json(send, body, status : int = 200) -> None:
+    payload = json.dumps(body).encode("utf-8")
+    await send({"type":"http.response.start", "status":status,
+                "headers":[(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]})
+    await send({"type":"http.response.body", "body":payload})
+    return
+
+async def wait_for_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    return
+
+
+def create_asgi_app(session_store : SessionStore = None, preload : bool = None, reload_interval : float = None):
+    """
+    :param session_store: store of loaded GPTs and sessions, by default one configured from the environment as for
+                          the Flask app
+    :param preload: load every GPT in the background at startup instead of on its first query; defaults to the
+                    PRELOAD_GPTS environment variable
+    :param reload_interval: seconds between checks for GPTs changed in the database, which are then reloaded in
+                            the background; 0 to never check. Defaults to the RELOAD_INTERVAL_SECONDS environment variable
+    """
+    #a store configured from the environment serves the GPT database, whose schema is checked at startup
+    serves_database = session_store is None
+    if session_store is None:
+        session_store = create_session_store()
+
+    async def get_gpts(scope, receive, send):
+        await send_json(send, await asyncio.to_thread(get_all_gpt_info))
+        return
+
+    async def open_session(receive, send) -> tuple:
+        #clients send back the session id they were given to continue their conversation
+        query_data = await read_json(receive)
+        session_id = query_data.get("session_id") or uuid.uuid4().hex
+        #loading a GPT reads the database and builds its indexes, so it mustn't run on the event loop
+        gpt, chat_history = await asyncio.to_thread(session_store.get, query_data.get("gpt_name"), session_id)
+        if gpt is None:
+            await send_json(send, {"error":f"No GPT named {query_data.get('gpt_name')}"}, 404)
+        return query_data, session_id, gpt, chat_history
+
+    async def query(scope, receive, send):
+        query_data, session_id, gpt, chat_history = await open_session(receive, send)
+        if gpt is None:
+            return
+        message = await gpt.aquery(query_data.get("message"), chat_history=chat_history)
+        await send_json(send, {"message":message, "session_id":session_id})
+        return
+
+    async def query_stream(scope, receive, send):
+        """
+        Server-Sent Events as in routes.query_stream. Generation stops at the next token if the client disconnects.
+        """
+        query_data, session_id, gpt, chat_history = await open_session(receive, send)
+        if gpt is None:
+            return
+
+        #no-cache and X-Accel-Buffering keep proxies from holding the events back until the answer is complete
+        await send({"type":"http.response.start", "status":200,
+                    "headers":[(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+                               (b"x-accel-buffering", b"no"), (b"x-session-id", session_id.encode())]})
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        tokens = gpt.aquery_stream(query_data.get("message"), chat_history=chat_history)
+        try:
+            async for token in tokens:
+                if disconnected.done():
+                    return
+                await send({"type":"http.response.body", "body":f"event: token\ndata: {json.dumps({'token':token})}\n\n".encode(), "more_body":True})
+            event = f"event: done\ndata: {json.dumps({'session_id':session_id})}\n\n"
+        except Exception as e:
+            event = f"event: error\ndata: {json.dumps({'error':str(e)})}\n\n"
+        finally:
+            await tokens.aclose()
+            disconnected.cancel()
+        await send({"type":"http.response.body", "body":event.encode()})
+        return
+
+    async def batch_query(scope, receive, send):
+        """
+        JSON lines as in routes.batch_query. The batch runs on the thread executor, one result at a time.
+        """
+        query_data = await read_json(receive)
+        if not valid_queries(query_data.get("queries", [])):
+            await send_json(send, {"error":"queries must be a list of strings"}, 400)
+            return
+        gpt = await asyncio.to_thread(session_store.get_gpt, query_data.get("gpt_name"))
+        if gpt is None:
+            await send_json(send, {"error":f"No GPT named {query_data.get('gpt_name')}"}, 404)
+            return
+
+        await send({"type":"http.response.start", "status":200, "headers":[(b"content-type", b"application/x-ndjson")]})
+        results = gpt.query_batch(query_data.get("queries", []), k=query_data.get("k", 10),
+                                  max_concurrency=int(os.getenv("BATCH_MAX_CONCURRENCY", 8)))
+        pending = None
+        try:
+            while True:
+                #shielded, so a cancelled handler (client gone, server shutting down) doesn't abandon the running next()
+                pending = asyncio.ensure_future(asyncio.to_thread(next, results, None))
+                result = await asyncio.shield(pending)
+                if result is None:
+                    break
+                await send({"type":"http.response.body", "body":(json.dumps(result)+"\n").encode(), "more_body":True})
+        finally:
+            #the generator can only be closed once no thread is running it, and closing waits for the completions
+            #still in flight, so it happens off the event loop
+            if pending is not None and not pending.done():
+                await asyncio.wait([pending])
+            await asyncio.to_thread(results.close)
+        await send({"type":"http.response.body", "body":b""})
+        return
+
+    async def admin_sessions(scope, receive, send):
+        """
+        Session counts and memory as in routes.admin_sessions, for requests with the admin token.
+        """
+        token = dict(scope.get("headers", [])).get(b"x-admin-token", b"").decode("latin-1")
+        if not admin_authorized(token):
+            await send_json(send, {"error":"Forbidden"}, 403)
+            return
+        #stats() takes the session store's lock, which mustn't be waited on from the event loop
+        await send_json(send, await asyncio.to_thread(session_store.stats))
+        return
+
+    routes = {("GET", "/chat/get_gpts"): get_gpts,
+              ("POST", "/chat/query"): query,
+              ("POST", "/chat/query_stream"): query_stream,
+              ("POST", "/chat/batch_query"): batch_query,
+              ("GET", "/chat/admin/sessions"): admin_sessions}
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    #an unmigrated database stops the server here instead of failing every request
+                    try:
+                        if serves_database:
+                            await asyncio.to_thread(check_database)
+                    except RuntimeError as error:
+                        await send({"type":"lifespan.startup.failed", "message":str(error)})
+                        return
+                    start_background_tasks(session_store, preload, reload_interval)
+                    await send({"type":"lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type":"lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        handler = routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            await send_json(send, {"error":f"No route {scope['method']} {scope['path']}"}, 404)
+            return
+        await handler(scope, receive, send)
+        return
+
+    return app
+
+app = create_asgi_app()
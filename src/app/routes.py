@@ -1,27 +1,76 @@
-from flask import Blueprint, jsonify, request
-from src.service.customGPT import CustomGPT
-from src.data.context_database import context_db_connection
-from pathlib import Path
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+from src.app.state import get_all_gpt_info, create_session_store, admin_authorized, valid_queries
+import json
+import os
+import uuid
 
 chat_blueprint=Blueprint('chat',__name__)
 
-active_gpts:dict[str,CustomGPT]={}
-db_path = str(Path(__file__).parent.parent.parent.resolve() / "db" / "gpt-database.db")
+session_store = create_session_store()
+
 @chat_blueprint.route('/get_gpts',methods=['GET'])
 def get_gpts():
-    db_connection = context_db_connection(db_path)
-
-    gpt_query=db_connection.get_all_gpt_info()
-    gpts=[{"name":row[1],"model":row[2]} for row in gpt_query]
-
-    return jsonify(gpts)
+    return jsonify(get_all_gpt_info())
 
 @chat_blueprint.route('/query',methods=['POST'])
 def query():
     query_data=request.get_json()
-    if query_data.get("gpt_name") not in active_gpts:
-        print(query_data.get("gpt_name"))
-        db_connection = context_db_connection(db_path)
-        active_gpts[query_data.get("gpt_name")] = db_connection.read_custom_gpt_by_name(query_data.get("gpt_name"))
-    response = {"message":active_gpts[query_data.get("gpt_name")].query(query_data.get("message"))}
-    return jsonify(response)
\ No newline at end of file
+    #clients send back the session id they were given to continue their conversation
+    session_id = query_data.get("session_id") or uuid.uuid4().hex
+    gpt, chat_history = session_store.get(query_data.get("gpt_name"), session_id)
+    if gpt is None:
+        return jsonify({"error":f"No GPT named {query_data.get('gpt_name')}"}), 404
+    response = {"message":gpt.query(query_data.get("message"), chat_history=chat_history),
+                "session_id":session_id}
+    return jsonify(response)
+
+@chat_blueprint.route('/query_stream',methods=['POST'])
+def query_stream():
+    """
+    Like /query, but answers with Server-Sent Events as the completion is generated: a "token" event per piece of
+    the answer, then a "done" event with the session id, or an "error" event if generation fails part way.
+    """
+    query_data=request.get_json()
+    session_id = query_data.get("session_id") or uuid.uuid4().hex
+    gpt, chat_history = session_store.get(query_data.get("gpt_name"), session_id)
+    if gpt is None:
+        return jsonify({"error":f"No GPT named {query_data.get('gpt_name')}"}), 404
+
+    def events():
+        try:
+            for token in gpt.query_stream(query_data.get("message"), chat_history=chat_history):
+                yield f"event: token\ndata: {json.dumps({'token':token})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error':str(e)})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'session_id':session_id})}\n\n"
+
+    #no-cache and X-Accel-Buffering keep proxies from holding the events back until the answer is complete
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no", "X-Session-Id":session_id})
+
+@chat_blueprint.route('/batch_query',methods=['POST'])
+def batch_query():
+    """
+    Answer a list of independent questions, e.g. for an evaluation run. Answers are streamed back as JSON lines in
+    the order of the questions, each with index, query and answer (or error).
+    """
+    query_data=request.get_json()
+    if not valid_queries(query_data.get("queries", [])):
+        return jsonify({"error":"queries must be a list of strings"}), 400
+    gpt = session_store.get_gpt(query_data.get("gpt_name"))
+    if gpt is None:
+        return jsonify({"error":f"No GPT named {query_data.get('gpt_name')}"}), 404
+
+    results = gpt.query_batch(query_data.get("queries", []), k=query_data.get("k", 10),
+                              max_concurrency=int(os.getenv("BATCH_MAX_CONCURRENCY", 8)))
+    return Response(stream_with_context(json.dumps(result)+"\n" for result in results), mimetype="application/x-ndjson")
+
+@chat_blueprint.route('/admin/sessions',methods=['GET'])
+def admin_sessions():
+    """
+    Counts and approximate memory of the loaded GPTs and sessions. Needs the admin token (see state.admin_authorized).
+    """
+    if not admin_authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error":"Forbidden"}), 403
+    return jsonify(session_store.stats())
@@ -0,0 +1,143 @@
+"""
+Filename: state.py
+Description:
+    What the Flask routes and the ASGI app share: where the GPT database is, how a GPT is loaded from it, the
+    store of loaded GPTs and chat sessions configured from the environment, warming that store up at startup and
+    keeping it in step with the database, and who may see the admin endpoints.
+"""
+from src.service.customGPT import CustomGPT
+from src.service.session_store import SessionStore
+from src.service.answer_cache import SemanticAnswerCache
+from src.data.context_database import context_db_connection
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hmac
+import os
+import threading
+import time
+import weakref
+
+db_path = str(Path(__file__).parent.parent.parent.resolve() / "db" / "gpt-database.db")
+
+# session stores whose background tasks have been started, so calling create_app again doesn't start more
+_background_tasks_started = weakref.WeakSet()
+_background_tasks_lock = threading.Lock()
+
+def load_gpt(name : str) -> CustomGPT:
+    db_connection = context_db_connection(db_path)
+    gpt = db_connection.read_custom_gpt_by_name(name)
+    #ANSWER_CACHE_SIZE turns on the semantic answer cache of every GPT served
+    if gpt is not None and int(os.getenv("ANSWER_CACHE_SIZE", 0)) > 0:
+        gpt.answer_cache = SemanticAnswerCache(float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+                                               float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600)),
+                                               int(os.getenv("ANSWER_CACHE_SIZE")))
+    return gpt
+
+def get_all_gpt_info() -> list:
+    db_connection = context_db_connection(db_path)
+    return [{"name":row[1],"model":row[2]} for row in db_connection.get_all_gpt_info()]
+
+def get_gpt_generations() -> dict:
+    db_connection = context_db_connection(db_path)
+    return db_connection.get_gpt_generations()
+
+def check_database() -> None:
+    """
+    Raise RuntimeError, with the command that migrates it, if the GPT database's schema is behind this code. Called
+    once when a server starts so an unmigrated database stops it there; the connections opened for requests
+    afterwards don't check again.
+    """
+    context_db_connection(db_path)
+    return
+
+def admin_authorized(token : str) -> bool:
+    """
+    Whether a request may use the admin endpoints: it must send the ADMIN_TOKEN environment variable as its
+    X-Admin-Token header. Without ADMIN_TOKEN set the admin endpoints are off.
+    """
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8"))
+
+def valid_queries(queries) -> bool:
+    """
+    Whether a batch request's queries are a list of strings; anything else (e.g. a single string, which would be
+    answered one character at a time) is refused with 400.
+    """
+    return isinstance(queries, list) and all(isinstance(query, str) for query in queries)
+
+def create_session_store() -> SessionStore:
+    #loaded GPTs are shared by every session; each session has its own chat history
+    return SessionStore(load_gpt,
+                        max_sessions=int(os.getenv("MAX_SESSIONS", 1000)),
+                        session_ttl=float(os.getenv("SESSION_TTL_SECONDS", 1800)),
+                        gpt_ttl=float(os.getenv("GPT_TTL_SECONDS")) if os.getenv("GPT_TTL_SECONDS") else None,
+                        max_memory_bytes=int(float(os.getenv("MAX_MEMORY_MB")) * 1024 * 1024) if os.getenv("MAX_MEMORY_MB") else None,
+                        get_generations=get_gpt_generations)
+
+def preload_gpts(session_store : SessionStore, max_workers : int = 4) -> threading.Thread:
+    """
+    Load every GPT in the database into the session store on a background thread pool, so the first query for
+    each doesn't wait on a cold load. A query for a GPT that is still loading waits for that load.
+    :return: the background thread, already started
+    """
+    def preload(name : str) -> None:
+        try:
+            session_store.preload(name)
+        except Exception as e:
+            print(f"Preloading GPT {name} failed: {e}")
+        return
+
+    def run() -> None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            executor.map(preload, [gpt["name"] for gpt in get_all_gpt_info()])
+        return
+
+    thread = threading.Thread(target=run, name="preload-gpts", daemon=True)
+    thread.start()
+    return thread
+
+def watch_for_updates(session_store : SessionStore, interval : float) -> threading.Thread:
+    """
+    Check the database for changed GPTs every interval seconds on a background thread, reloading the stale ones
+    that are loaded (see SessionStore.refresh). Each check is one query of the custom_gpt table.
+    :return: the background thread, already started
+    """
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                reloaded = session_store.refresh()
+                if reloaded:
+                    print(f"Reloaded GPTs changed in the database: {', '.join(reloaded)}")
+            except Exception as e:
+                print(f"Checking for GPT updates failed: {e}")
+
+    thread = threading.Thread(target=run, name="watch-gpt-updates", daemon=True)
+    thread.start()
+    return thread
+
+def start_background_tasks(session_store : SessionStore, preload : bool = None, reload_interval : float = None) -> bool:
+    """
+    Start the optional startup and background work of a server process, configured from the environment unless
+    given: PRELOAD_GPTS (and PRELOAD_WORKERS) to preload every GPT, RELOAD_INTERVAL_SECONDS to watch for updates.
+    The tasks of a session store are started once; later calls for the same store do nothing.
+    :return: whether any tasks were started by this call
+    """
+    if preload is None:
+        preload = os.getenv("PRELOAD_GPTS", "0").lower() in ("1", "true", "yes")
+    if reload_interval is None:
+        reload_interval = float(os.getenv("RELOAD_INTERVAL_SECONDS", 0))
+    if not preload and reload_interval <= 0:
+        return False
+    with _background_tasks_lock:
+        if session_store in _background_tasks_started:
+            return False
+        _background_tasks_started.add(session_store)
+
+    if preload:
+        preload_gpts(session_store, int(os.getenv("PRELOAD_WORKERS", 4)))
+    if reload_interval > 0:
+        watch_for_updates(session_store, reload_interval)
+    return True
@@ -0,0 +1,204 @@
+"""
+Filename: connection_pool.py
+Description:
+    Thread-safe pool of persistent SQLite connections, shared by every database class that opens the same file.
+    Connections are opened once in WAL mode with tuned pragmas and handed out for the length of a transaction, so
+    readers don't block the writer and a request doesn't pay for opening the file again.
+    In WAL mode committed writes first go to a -wal file beside the database (with a -shm index); they only reach
+    the database file itself when SQLite checkpoints. Those files are not tracked by git, so call checkpoint()
+    after writing a database that is committed to the repository (e.g. db/gpt-database.db after bootstrapping),
+    or the committed file will be missing the latest writes.
+
+Usage:
+    pool = get_pool("db/gpt-database.db")
+    with pool.transaction(write=True) as cursor:
+        cursor.execute(...)
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# applied to every new connection; journal_mode is persistent in the file, the others are per connection
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",          # readers and one writer can work concurrently
+    "synchronous": "NORMAL",        # safe with WAL; only the last transactions can be lost on power failure
+    "foreign_keys": "ON",           # needed for the ON DELETE CASCADE constraints
+    "cache_size": -32000,           # page cache per connection, negative values are KiB
+    "mmap_size": 268435456,         # read the database through a 256 MiB memory map
+    "temp_store": "MEMORY",
+}
+
+
+class sqlite_connection_pool:
+
+    def __init__(self, db_name, max_connections : int = 8, timeout : float = 30.0, pragmas : dict = None):
+        self.db_name = str(db_name)
+        self.max_connections = max_connections  # connections opened at most; further callers wait for one to be returned
+        self.timeout = timeout                  # seconds to wait for a connection or a lock held by another writer
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self._idle = queue.LifoQueue()          # most recently used first, so its page cache is warm
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()         # the connection and transaction depth of the calling thread
+        self.schema_checked = False             # set by the database classes once they've migrated the schema
+        return
+
+    def _connect(self) -> sqlite3.Connection:
+        #isolation_level=None leaves transaction control to transaction() instead of the sqlite3 module
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.max_connections:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except Exception as e:
+                    self._opened -= 1
+                    raise e
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No database connection to {self.db_name} became free within {self.timeout}s")
+
+    def _release(self, conn : sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        return
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of the with block. A thread that already holds one, e.g. inside
+        transaction(), gets the same connection back.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, write : bool = False):
+        """
+        Run the with block as one transaction and yield a cursor. The transaction commits when the block exits and
+        rolls back if it raises. Nested calls on the same thread join the outermost transaction, so a method that
+        calls other database methods groups all of their work into a single unit of work on one connection.
+        :param write: take the write lock up front (BEGIN IMMEDIATE) rather than on the first write, which avoids
+                      deadlocks between two readers that both try to upgrade
+        """
+        with self.connection() as conn:
+            depth = getattr(self._local, "depth", 0)
+            if depth == 0:
+                conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+                self._local.after_commit = []
+                self._local.after_rollback = []
+            self._local.depth = depth + 1
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                if depth == 0:
+                    conn.commit()
+            except BaseException:
+                if depth == 0:
+                    conn.rollback()
+                    self._run_callbacks(self._local.after_rollback)
+                raise
+            finally:
+                self._local.depth = depth
+                cursor.close()
+            if depth == 0:
+                self._run_callbacks(self._local.after_commit)
+
+    def _run_callbacks(self, callbacks : list) -> None:
+        #cleared first so a callback that opens its own transaction starts with empty lists
+        self._local.after_commit = []
+        self._local.after_rollback = []
+        for callback in callbacks:
+            callback()
+        return
+
+    def after_commit(self, callback) -> None:
+        """
+        Run callback once the calling thread's current transaction has committed, e.g. to move files into place
+        that the committed rows refer to. Must be called inside transaction().
+        """
+        self._local.after_commit.append(callback)
+        return
+
+    def after_rollback(self, callback) -> None:
+        """
+        Run callback if the calling thread's current transaction is rolled back, e.g. to delete temporary files.
+        Must be called inside transaction().
+        """
+        self._local.after_rollback.append(callback)
+        return
+
+    def checkpoint(self) -> None:
+        """
+        Copy every write in the -wal file into the database file and truncate the -wal file, so the database file
+        alone holds everything committed, e.g. before committing it to the repository.
+        """
+        with self.connection() as conn:
+            busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            raise sqlite3.OperationalError(f"Could not checkpoint {self.db_name}; another connection is using it")
+        return
+
+    def close(self) -> None:
+        """
+        Close idle connections. Call this once work on the database has finished; connections still borrowed
+        at that point are not closed.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+        return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_name) -> sqlite_connection_pool:
+    """
+    Return the shared pool for a database file, creating it on first use.
+    """
+    key = os.path.abspath(str(db_name))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = sqlite_connection_pool(db_name)
+        return _pools[key]
+
+
+def close_pool(db_name) -> None:
+    """
+    Close and forget the shared pool for a database file, e.g. before deleting the file.
+    """
+    with _pools_lock:
+        pool = _pools.pop(os.path.abspath(str(db_name)), None)
+    if pool is not None:
+        pool.close()
+    return
@@ -1,154 +1,354 @@
 import os
 import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from itertools import groupby
+from src.data.connection_pool import get_pool
 from src.service.context import Context
 from src.service.customGPT import CustomGPT
 import faiss
 import numpy as np
-from pathlib import Path
+from pathlib import Path, PureWindowsPath
+
+def embeddings_from_rows(rows : list) -> list:
+    """
+    Build a context's [chunk, vector] list from (chunk_text, embedding_vector) rows ordered by chunk_index.
+    Vectors stored as float32 BLOBs are decoded with one np.frombuffer call into a single contiguous matrix, and each
+    chunk's vector is a row view of it. Rows still in the legacy comma separated text format are parsed individually.
+    """
+    if len(rows) == 0:
+        return []
+    if all(isinstance(row[1], bytes) for row in rows):
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype="float32").reshape(len(rows), -1)
+        return [[row[0], matrix[i]] for i, row in enumerate(rows)]
+    return [[row[0], vector_from_db(row[1])] for row in rows]
+
+
+def vector_from_db(value) -> np.ndarray:
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype="float32")
+    return np.array(value.split(","), dtype="float32")
+
+
+def vector_to_db(vector) -> bytes:
+    return np.asarray(vector, dtype="float32").tobytes()
+
+
+def resolve_faiss_path(faiss_index_filename : str) -> str:
+    """
+    Return the stored index path if it exists, otherwise the file with the same name in this repository's faiss folder.
+    Databases built on another machine (e.g. with Windows paths) can then still be loaded.
+    """
+    if os.path.exists(faiss_index_filename):
+        return faiss_index_filename
+    local_file = Path(__file__).parent.parent.parent / "faiss" / PureWindowsPath(faiss_index_filename).name
+    if local_file.exists():
+        return str(local_file)
+    return faiss_index_filename
+
+
+# Schema changes made after the tables created by initialize_with_entries, applied in order. PRAGMA user_version
+# records how many have been applied to a database, so existing databases are brought up to date by migrate().
+# Migrating is an explicit step (python -m src.data.context_database <db> migrate, or migrate=True); opening a
+# database that is behind fails rather than rewriting the file.
+SCHEMA_MIGRATIONS = [
+    #1: indexes on the foreign keys used to load a GPT and its contexts
+    ['''CREATE INDEX IF NOT EXISTS idx_context_embeddings_context_id ON context_embeddings (context_id, chunk_index)''',
+     '''CREATE INDEX IF NOT EXISTS idx_gpt_context_gpt_id ON gpt_context (gpt_id)''',
+     '''CREATE INDEX IF NOT EXISTS idx_gpt_context_context_id ON gpt_context (context_id)'''],
+    #2: the index spec each context's FAISS index was built with
+    ['''ALTER TABLE context ADD COLUMN index_spec TEXT NOT NULL DEFAULT 'flat' '''],
+    #3: the similarity metric of each context's FAISS index
+    ['''ALTER TABLE context ADD COLUMN metric TEXT NOT NULL DEFAULT 'l2' '''],
+    #4: tokens in each chunk, counted at ingestion so prompts can be packed without re-tokenizing; NULL for older rows
+    ['''ALTER TABLE context_embeddings ADD COLUMN token_count INTEGER'''],
+    #5: a generation counter per GPT, bumped by triggers whenever the GPT, its set of contexts or their chunks change,
+    #so a server can tell which of the GPTs it has loaded are stale with one small query (see get_gpt_generations)
+    ['''ALTER TABLE custom_gpt ADD COLUMN generation INTEGER NOT NULL DEFAULT 0''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_update
+        AFTER UPDATE OF name, model, context_embedding_model, initial_role, initial_context ON custom_gpt
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id = NEW.id; END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_link AFTER INSERT ON gpt_context
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id = NEW.gpt_id; END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_unlink AFTER DELETE ON gpt_context
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id = OLD.gpt_id; END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_context_update AFTER UPDATE ON context
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id = NEW.id); END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_chunk_insert AFTER INSERT ON context_embeddings
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id = NEW.context_id); END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_chunk_update
+        AFTER UPDATE OF context_id, chunk_index, chunk_text, embedding_vector ON context_embeddings
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id IN (OLD.context_id, NEW.context_id)); END''',
+     '''CREATE TRIGGER IF NOT EXISTS gpt_generation_on_chunk_delete AFTER DELETE ON context_embeddings
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id = OLD.context_id); END'''],
+    #6: documents bulk ingestion has finished, so an interrupted run can resume (see src/service/ingestion.py)
+    ['''CREATE TABLE IF NOT EXISTS ingestion_checkpoint (
+        doc_path TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        settings TEXT NOT NULL,
+        context_id INTEGER NOT NULL,
+        completed_at REAL NOT NULL,
+        CONSTRAINT fk_context
+            FOREIGN KEY(context_id) REFERENCES context(id)
+            ON DELETE CASCADE
+        )'''],
+    #7: the first and last page (PDF), paragraph (.docx) or line (.txt) of its document each chunk was cut from
+    ['''ALTER TABLE context_embeddings ADD COLUMN source_start INTEGER''',
+     '''ALTER TABLE context_embeddings ADD COLUMN source_end INTEGER'''],
+    #8: chunks edited in place (see update_context_chunks) may change only their sources
+    ['''DROP TRIGGER IF EXISTS gpt_generation_on_chunk_update''',
+     '''CREATE TRIGGER gpt_generation_on_chunk_update
+        AFTER UPDATE OF context_id, chunk_index, chunk_text, embedding_vector, source_start, source_end ON context_embeddings
+        BEGIN UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id IN (OLD.context_id, NEW.context_id)); END'''],
+]
+
 
 class context_db_connection:
-    def __init__(self,db_name):
+    def __init__(self,db_name, mmap_indexes : bool = False, faiss_dir : str = None, migrate : bool = False):
+        """
+        :param migrate: apply pending schema migrations to the database; without it a database whose schema is
+                        behind raises RuntimeError instead of being changed
+        """
         self.db_name = db_name
+        self.mmap_indexes = mmap_indexes  # load FAISS indexes memory-mapped and keep only chunk texts in memory
+        self.pool = get_pool(db_name)     # connections are shared by every object using the same database file
+        self.faiss_dir = faiss_dir or str(Path(__file__).parent.parent.parent / "faiss")  # where write_context saves indexes
+        self._pending_faiss_files = {}    # index file -> temporary file written by a transaction that hasn't committed yet
+
+        #check the schema, or bring an existing database up to it when asked to, once per process
+        if not self.pool.schema_checked:
+            if migrate:
+                self.migrate()
+            else:
+                self.check_schema()
+            self.pool.schema_checked = True
         return
 
-    def delete_context_by_id(self, id : int) -> None:
+    @contextmanager
+    def transaction(self, write : bool = False):
+        """
+        Unit of work: every database method called inside the with block runs on the same pooled connection, in
+        one transaction that commits when the block exits and rolls back if it raises.
+        Foreign keys (and therefore cascading deletes) are enabled on every pooled connection.
+        :param write: take the write lock at the start of the transaction; use this for anything that writes
+        :return: cursor for the transaction's connection
+        """
+        with self.pool.transaction(write) as cursor:
+            yield cursor
 
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+    def delete_context_by_id(self, id : int) -> None:
 
-        try:
-            cursor.execute('''PRAGMA foreign_keys = ON;''') #pragma stands for program directive; foreign key constraints (and therefore cascading aren't enabled by default so must specify)
+        with self.transaction(write=True) as cursor:
             cursor.execute('''DELETE FROM context WHERE id = ?''', (id,))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
 
         return
 
     def delete_context_by_name(self, name : str) -> None:
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
 
-        try:
-            cursor.execute(
-                '''PRAGMA foreign_keys = ON;''')  # pragma stands for program directive; foreign key constraints (and therefore cascading aren't enabled by default so must specify)
+        with self.transaction(write=True) as cursor:
             cursor.execute('''DELETE
                               FROM context
                               WHERE name = ?''', (name,))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
 
         return
 
+    def _load_contexts(self, cursor : sqlite3.Cursor, query_contexts : list, chunk_filter : str, params : tuple) -> list:
+        """
+        Build Contexts from their rows in the context table, reading the chunks of all of them with one query.
+        In mmap_indexes mode only the chunk texts are read; the vectors stay in the memory-mapped index files.
+        :param query_contexts: rows of the context table
+        :param chunk_filter: WHERE clause selecting the chunk rows of those contexts from context_embeddings
+        :param params: parameters for chunk_filter
+        :return: list of Context objects in the same order as query_contexts
+        """
+        columns = "context_id, chunk_index, token_count, source_start, source_end, chunk_text"
+        if not self.mmap_indexes:
+            columns += ", embedding_vector"
+        cursor.execute(f'''SELECT {columns} FROM context_embeddings {chunk_filter} ORDER BY context_id, chunk_index ASC''', params)
+        chunks_by_context = {context_id: list(rows) for context_id, rows in groupby(cursor.fetchall(), key=lambda row: row[0])}
+
+        contexts = []
+        for query_context in query_contexts:
+            #create context object to return and load data into if from query
+            context = Context(name=query_context[1],associated_doc_name=query_context[2],index_spec=query_context[4],metric=query_context[5])
+            faiss_file = self._pending_faiss_files.get(query_context[3]) or resolve_faiss_path(query_context[3])
+            context.load_faiss_index(faiss_file, mmap=self.mmap_indexes)
+
+            rows = chunks_by_context.get(query_context[0], [])
+            chunk_ids = [row[1] for row in rows]
+            token_counts = [row[2] for row in rows]
+            sources = [None if row[3] is None else (row[3], row[4]) for row in rows]
+            if self.mmap_indexes:
+                context.set_chunks([row[5] for row in rows], token_counts, sources, chunk_ids)
+            else:
+                context.set_embeddings(embeddings_from_rows([row[5:] for row in rows]), token_counts, sources, chunk_ids)
+            print("length of query_text: ", len(context.chunks))
+            contexts.append(context)
+
+        return contexts
+
+    def _load_context(self, cursor : sqlite3.Cursor, query_context : tuple) -> Context:
+        return self._load_contexts(cursor, [query_context], '''WHERE context_id = ?''', (query_context[0],))[0]
+
     def read_context_by_id(self,id : int) -> Context:
 
         #variables
         context=None
 
-        #initialize connection
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        try:
+        with self.transaction() as cursor:
             #initial query
             cursor.execute('''SELECT * FROM context WHERE id = ?''',(id,))
             query_context = cursor.fetchone()
             print(f"query_context: {query_context}")
 
             if query_context is not None:
-                cursor.execute('''SELECT * FROM context_embeddings WHERE context_id = ? ORDER BY chunk_index ASC''',(id,))
-                query_embeddings = cursor.fetchall()
-                print("length of query_text: ", len(query_embeddings))
-
-                #create context object to return and load data into if from query
-                context = Context(name=query_context[1],associated_doc_name=query_context[2])
-                context.load_faiss_index(query_context[3])
-
-                context.set_embeddings([[e[3],np.array(e[4].split(","),dtype="float32")] for e in query_embeddings])
-            #close database connection
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+                context = self._load_context(cursor, query_context)
 
         return context
 
     def read_context_by_name(self, name : str) -> Context:
 
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute('''SELECT * FROM context WHERE name = ?''',(name,))
-        query_context = cursor.fetchone()
-
-        if query_context is not None:
-            print(f"query_context: {query_context}")
-
-            cursor.execute('''SELECT * FROM context_embeddings WHERE context_id = ? ORDER BY chunk_index ASC''',(query_context[0],))
-            query_embeddings = cursor.fetchall()
-            print("length of query_text: ", len(query_embeddings))
-
-            #create context object to return and load data into if from query
-            context = Context(name=query_context[1],associated_doc_name=query_context[2])
-            context.load_faiss_index(query_context[3])
-
-            context.set_embeddings([[e[3],np.array(e[4].split(","),dtype="float32")] for e in query_embeddings])
-        else:
-            context = None
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT * FROM context WHERE name = ?''',(name,))
+            query_context = cursor.fetchone()
 
-        # close database connection
-        conn.commit()
-        conn.close()
+            if query_context is not None:
+                print(f"query_context: {query_context}")
+                context = self._load_context(cursor, query_context)
+            else:
+                context = None
 
         return context
 
     def write_context(self,context : Context) -> int:
 
         #input validation
-        if any([context.embeddings is None, context.index is None, context.associated_doc_name is None]):
-            raise ValueError(f"Context {context.name} does not have all initialized attributes to be written to database. One of context.text, context.embeddings, context.index, context.associated_doc_name are None")
+        if any([context.chunks is None, context.index is None, context.associated_doc_name is None]):
+            raise ValueError(f"Context {context.name} does not have all initialized attributes to be written to database. One of context.chunks, context.index, context.associated_doc_name are None")
 
         #variables
         id=None
 
-        #initialize database connection
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        try:
-            # save faiss index to file
-            faiss_file=str(Path(__file__).parent.parent.parent / "faiss" / f"{context.name}.faiss")
+        with self.transaction(write=True) as cursor:
+            faiss_file=str(Path(self.faiss_dir) / f"{context.name}.faiss")
             print("Faiss file: ",faiss_file)
-            faiss.write_index(context.index, faiss_file)
+            self._stage_faiss_index(context.index, faiss_file, context.name)
 
             # insert into context table
-            cursor.execute('''INSERT INTO context (name, origin_filename, faiss_index_filename) VALUES (?, ?, ?)''', (context.name, context.associated_doc_name, faiss_file))
+            cursor.execute('''INSERT INTO context (name, origin_filename, faiss_index_filename, index_spec, metric) VALUES (?, ?, ?, ?, ?)''', (context.name, context.associated_doc_name, faiss_file, context.index_spec, context.metric))
 
-            # insert embeddings into context_embeddings database
             id = cursor.lastrowid
-            for i in range(len(context.embeddings)):
-                chunk_text = context.embeddings[i][0]
-                embedding_as_string = ','.join(map(str,context.embeddings[i][1]))
-                cursor.execute('''INSERT INTO context_embeddings (context_id, chunk_index, chunk_text, embedding_vector) VALUES (?, ?, ?, ?)''',
-                               (id,i,chunk_text,embedding_as_string))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            self._insert_chunk_rows(cursor, id, context)
 
         return id
 
+    def _insert_chunk_rows(self, cursor : sqlite3.Cursor, context_id : int, context : Context) -> None:
+        #insert embeddings into context_embeddings database in one batch
+        vectors = context.get_vectors()
+        token_counts = context.token_counts or [None] * len(context.chunks)
+        sources = [source or (None, None) for source in context.sources or [None] * len(context.chunks)]
+        cursor.executemany('''INSERT INTO context_embeddings (context_id, chunk_index, chunk_text, embedding_vector, token_count, source_start, source_end) VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                           ((context_id,chunk_id,chunk_text,vector_to_db(vectors[i]),token_counts[i],*sources[i]) for i, (chunk_id, chunk_text) in enumerate(zip(context.chunk_ids, context.chunks))))
+        return
+
+    def _overwrite_context(self, cursor : sqlite3.Cursor, context_id : int, context : Context) -> None:
+        """
+        Replace everything stored for a context with the given one, keeping its row, and with it the links of the
+        GPTs that use it. Must be called inside a write transaction.
+        """
+        faiss_file=str(Path(self.faiss_dir) / f"{context.name}.faiss")
+        self._stage_faiss_index(context.index, faiss_file, context.name)
+        cursor.execute('''UPDATE context SET origin_filename = ?, faiss_index_filename = ?, index_spec = ?, metric = ? WHERE id = ?''',
+                       (context.associated_doc_name, faiss_file, context.index_spec, context.metric, context_id))
+        cursor.execute('''DELETE FROM context_embeddings WHERE context_id = ?''', (context_id,))
+        self._insert_chunk_rows(cursor, context_id, context)
+        return
+
+    def _stage_faiss_index(self, index, faiss_file : str, context_name : str) -> None:
+        """
+        Save a FAISS index to a temporary file; it is only moved into place once the rows referring to it have
+        committed (which may be at the end of an enclosing transaction), and is deleted if they roll back.
+        Must be called inside a write transaction.
+        """
+        temp_faiss_file=f"{faiss_file}.{uuid.uuid4().hex}.tmp"
+        faiss.write_index(index, temp_faiss_file)
+        if faiss_file in self._pending_faiss_files:
+            #staged earlier in the same transaction; the callbacks already registered move the newest file
+            os.remove(self._pending_faiss_files[faiss_file])
+            self._pending_faiss_files[faiss_file] = temp_faiss_file
+            return
+        self._pending_faiss_files[faiss_file] = temp_faiss_file
+        self.pool.after_commit(lambda: self._install_faiss_index(faiss_file, context_name))
+        self.pool.after_rollback(lambda: os.remove(self._pending_faiss_files.pop(faiss_file)))
+        return
+
+    def _install_faiss_index(self, faiss_file : str, context_name : str) -> None:
+        """
+        Move a staged index into place once its rows have committed. The commit already bumped the generation of
+        the GPTs using the context, so a server may have reloaded them in between with the new rows and the old
+        index; bumping it again now that the file is in place makes it reload once more.
+        """
+        os.replace(self._pending_faiss_files.pop(faiss_file), faiss_file)
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''UPDATE custom_gpt SET generation = generation + 1 WHERE id IN (SELECT gpt_id FROM gpt_context WHERE context_id IN (SELECT id FROM context WHERE name = ?))''',
+                           (context_name,))
+        return
+
+    def update_context_chunks(self, context : Context, added : list = (), removed : list = (), replaced : list = (), moved : list = (),
+                              vectors : dict = None) -> int:
+        """
+        Write chunk edits already made to a Context (see Context.add_chunks, remove_chunks, replace_chunks and
+        set_chunk_sources) to its stored copy, touching only the rows of those chunks. The FAISS index file is
+        replaced with the edited index when the transaction commits. Ids may be Python or numpy integers.
+        :param context: the edited context, stored under the same name
+        :param added: ids of chunks added to it
+        :param removed: ids of chunks removed from it
+        :param replaced: ids of chunks whose text and vector were replaced
+        :param moved: ids of chunks whose sources alone changed
+        :param vectors: chunk id -> embedding of added and replaced chunks, as they were embedded (see
+                        CustomGPT.update_context). Chunks not in it are read back from the context, which is lossy
+                        for a memory-mapped ivfpq index.
+        :return: id of the context in the database
+        """
+        #sqlite3 can't bind numpy integers, which is what ids taken from FAISS or numpy arrays are
+        added, removed, replaced, moved = ([int(chunk_id) for chunk_id in ids] for ids in (added, removed, replaced, moved))
+        vectors = {int(chunk_id): vector for chunk_id, vector in (vectors or {}).items()}
+
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''SELECT id, faiss_index_filename FROM context WHERE name = ?''', (context.name,))
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError(f"Context {context.name} is not in the database; write it with write_context first")
+            context_id, faiss_file = row[0], resolve_faiss_path(row[1])
+
+            def chunk_rows(chunk_ids : list) -> list:
+                missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in vectors]
+                vectors.update(zip(missing, context.get_chunk_vectors(missing) if missing else []))
+                rows = []
+                for chunk_id, vector in ((chunk_id, vectors[chunk_id]) for chunk_id in chunk_ids):
+                    position = context.chunk_position(chunk_id)
+                    rows.append((context.chunks[position], vector_to_db(vector),
+                                 None if context.token_counts is None else context.token_counts[position],
+                                 *((context.sources and context.sources[position]) or (None, None)),
+                                 context_id, chunk_id))
+                return rows
+
+            cursor.executemany('''DELETE FROM context_embeddings WHERE context_id = ? AND chunk_index = ?''',
+                               [(context_id, chunk_id) for chunk_id in removed])
+            cursor.executemany('''UPDATE context_embeddings SET chunk_text = ?, embedding_vector = ?, token_count = ?, source_start = ?, source_end = ? WHERE context_id = ? AND chunk_index = ?''',
+                               chunk_rows(replaced))
+            cursor.executemany('''INSERT INTO context_embeddings (chunk_text, embedding_vector, token_count, source_start, source_end, context_id, chunk_index) VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                               chunk_rows(added))
+            cursor.executemany('''UPDATE context_embeddings SET source_start = ?, source_end = ? WHERE context_id = ? AND chunk_index = ?''',
+                               [(*((context.sources and context.sources[context.chunk_position(chunk_id)]) or (None, None)), context_id, chunk_id) for chunk_id in moved])
+
+            #an index file can't be patched in place, but writing it out is cheap next to re-embedding the context
+            if added or removed or replaced:
+                self._stage_faiss_index(context.index, faiss_file, context.name)
+
+        return context_id
+
     def delete_custom_gpt_by_id(self, id : int) -> None:
 
 
@@ -157,6 +357,9 @@ class context_db_connection:
 
     def delete_custom_gpt_by_name(self, name : str) -> None:
 
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''DELETE FROM custom_gpt WHERE name = ?''', (name,))
+
         return
 
     def read_custom_gpt_by_id(self, id : int) -> CustomGPT:
@@ -165,31 +368,30 @@ class context_db_connection:
 
     def get_all_gpt_info(self) -> list:
 
-        #begin connection
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        try:
+        with self.transaction() as cursor:
             cursor.execute('''SELECT * FROM custom_gpt''')
             gpts = cursor.fetchall()
-            return gpts
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
-        return
+
+        return gpts
+
+    def get_gpt_generations(self) -> dict:
+        """
+        Current generation of every GPT, to compare with CustomGPT.generation of loaded copies.
+        :return: dict of GPT name to generation
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT name, generation FROM custom_gpt''')
+            generations = dict(cursor.fetchall())
+
+        return generations
 
     def read_custom_gpt_by_name(self, name : str) -> CustomGPT:
 
         #variables
         custom_gpt=None
 
-        #initialize database connection
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        try:
+        #the GPT row and all of its contexts are read in one transaction, so they are a consistent snapshot
+        with self.transaction() as cursor:
             cursor.execute('''SELECT * FROM custom_gpt WHERE name = ?''',(name,))
             result = cursor.fetchone()
 
@@ -203,18 +405,15 @@ class context_db_connection:
                                        initial_context=result[5],
                                        api_key=os.getenv("API_KEY")
                                        )
-                #populate object with contexts
-                cursor.execute('''SELECT context_id FROM gpt_context WHERE gpt_id = ?''',(gpt_id,))
-                context_ids = cursor.fetchall()
-                if context_ids is not None:
-                    for context_id in context_ids:
-                        custom_gpt.add_context(self.read_context_by_id(context_id[0]))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+                custom_gpt.generation = result[6]
+                #populate object with contexts; one query for the context rows and one for all of their chunks,
+                #however many contexts the GPT has
+                cursor.execute('''SELECT * FROM context WHERE id IN (SELECT context_id FROM gpt_context WHERE gpt_id = ?) ORDER BY id''',(gpt_id,))
+                query_contexts = cursor.fetchall()
+                for context in self._load_contexts(cursor, query_contexts,
+                                                   '''WHERE context_id IN (SELECT context_id FROM gpt_context WHERE gpt_id = ?)''',
+                                                   (gpt_id,)):
+                    custom_gpt.add_context(context)
 
         return custom_gpt
 
@@ -223,11 +422,9 @@ class context_db_connection:
         #variables
         id=None
 
-        #initialize connection
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        try:
+        #contexts, the GPT row and their links are written in one transaction, so a failure part way through leaves
+        #no orphaned contexts behind; index files of new contexts only appear once it has committed
+        with self.transaction(write=True) as cursor:
             #insert contexts into context database
             context_ids=[]
             for context in custom_gpt.contexts:
@@ -243,7 +440,7 @@ class context_db_connection:
                     if context_with_same_name == custom_gpt.contexts[context]:
                         context_ids.append(context_query[0])
                     else:
-                        context.name=context.name+"_"+custom_gpt.name
+                        custom_gpt.contexts[context].name=custom_gpt.contexts[context].name+"_"+custom_gpt.name
                         context_ids.append(self.write_context(custom_gpt.contexts[context]))
                 else:
                     context_ids.append(self.write_context(custom_gpt.contexts[context]))
@@ -259,20 +456,132 @@ class context_db_connection:
             id=cursor.lastrowid
 
             #associate contexts with gpt
-            for context_id in context_ids:
-                cursor.execute('''INSERT INTO gpt_context (gpt_id, context_id) VALUES (?, ?)''',
-                               (id,context_id))
-
-            # close database connection
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            cursor.executemany('''INSERT INTO gpt_context (gpt_id, context_id) VALUES (?, ?)''',
+                               [(id,context_id) for context_id in context_ids])
 
         return id
 
+    def get_ingestion_checkpoints(self) -> dict:
+        """
+        Documents whose ingestion has completed.
+        :return: dict of document path to (content hash, settings, context id)
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT doc_path, content_hash, settings, context_id FROM ingestion_checkpoint''')
+            checkpoints = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+        return checkpoints
+
+    def write_ingested_context(self, doc_path : str, content_hash : str, settings : str, context : Context, changes : dict = None) -> int:
+        """
+        Write the context built from a document together with its ingestion checkpoint, in one transaction, so a
+        document is either completely ingested or not at all. A context left with the same name by an earlier run
+        (e.g. from a previous version of the document) is rewritten in place, so GPTs using it keep it.
+        :param content_hash: hash of the document's contents when it was ingested
+        :param settings: the ingestion settings that shaped the context (chunking, models, index), as one string
+        :param changes: for a stored context edited in place, the chunk ids passed to update_context_chunks
+                        (added, removed, replaced, moved); only those chunks are written
+        :return: id of the context
+        """
+        with self.transaction(write=True) as cursor:
+            if changes is not None:
+                context_id = self.update_context_chunks(context, **changes)
+            else:
+                cursor.execute('''SELECT id FROM context WHERE name = ?''', (context.name,))
+                row = cursor.fetchone()
+                if row is None:
+                    context_id = self.write_context(context)
+                else:
+                    context_id = row[0]
+                    self._overwrite_context(cursor, context_id, context)
+            cursor.execute('''INSERT OR REPLACE INTO ingestion_checkpoint (doc_path, content_hash, settings, context_id, completed_at) VALUES (?, ?, ?, ?, ?)''',
+                           (doc_path, content_hash, settings, context_id, time.time()))
+
+        return context_id
+
+    def schema_version(self) -> int:
+        """
+        :return: number of SCHEMA_MIGRATIONS the database has had, or None if its tables don't exist yet
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'context' ''')
+            if cursor.fetchone()[0] == 0:
+                return None
+            cursor.execute('''PRAGMA user_version''')
+            return cursor.fetchone()[0]
+
+    def check_schema(self) -> None:
+        """
+        Raise RuntimeError if the database's schema is older than this code expects. Nothing is written.
+        """
+        version = self.schema_version()
+        if version is not None and version < len(SCHEMA_MIGRATIONS):
+            raise RuntimeError(f"Database {self.db_name} is at schema version {version} but version {len(SCHEMA_MIGRATIONS)} is needed; "
+                               f"migrate it with: python -m src.data.context_database {self.db_name} migrate")
+        return
+
+    def migrate(self) -> int:
+        """
+        Apply any schema migrations the database hasn't had yet. Databases whose tables don't exist yet are left
+        alone; initialize_with_entries creates them at the latest version.
+        :return: number of migrations applied
+        """
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'context' ''')
+            if cursor.fetchone()[0] == 0:
+                return 0
+            cursor.execute('''PRAGMA user_version''')
+            version = cursor.fetchone()[0]
+            if version >= len(SCHEMA_MIGRATIONS):
+                return 0
+            for migration in SCHEMA_MIGRATIONS[version:]:
+                for statement in migration:
+                    cursor.execute(statement)
+            cursor.execute(f'''PRAGMA user_version = {len(SCHEMA_MIGRATIONS)}''')
+
+        return len(SCHEMA_MIGRATIONS) - version
+
+    def migrate_embeddings_to_blob(self, vacuum : bool = True) -> int:
+        """
+        Convert context_embeddings rows stored in the legacy comma separated text format to float32 BLOBs, in place.
+        Rows already stored as BLOBs are left alone, so this is safe to run more than once.
+        :param vacuum: rebuild the database file afterwards to release the space freed by the conversion
+        :return: number of rows converted
+        """
+        converted = 0
+
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''SELECT id FROM context_embeddings WHERE typeof(embedding_vector) = 'text' ''')
+            row_ids = [row[0] for row in cursor.fetchall()]
+
+            #convert in groups so only a slice of the table's text vectors is held in memory at once
+            for i in range(0, len(row_ids), 500):
+                group = row_ids[i:i + 500]
+                cursor.execute(f'''SELECT id, embedding_vector FROM context_embeddings WHERE id IN ({",".join("?" * len(group))})''', group)
+                cursor.executemany('''UPDATE context_embeddings SET embedding_vector = ? WHERE id = ?''',
+                                   [(vector_to_db(vector_from_db(vector)), row_id) for row_id, vector in cursor.fetchall()])
+                converted += len(group)
+
+        if vacuum and converted > 0:
+            #VACUUM can't run inside a transaction
+            with self.pool.connection() as conn:
+                conn.execute('''VACUUM''')
+
+        return converted
+
+    def backfill_token_counts(self, count_tokens) -> int:
+        """
+        Count the tokens of chunks stored before token counts were kept, so queries don't have to.
+        :param count_tokens: function from chunk text to its token count, e.g. CustomGPT.count_tokens
+        :return: number of chunks counted
+        """
+        with self.transaction(write=True) as cursor:
+            cursor.execute('''SELECT id, chunk_text FROM context_embeddings WHERE token_count IS NULL''')
+            counts = [(count_tokens(chunk_text), row_id) for row_id, chunk_text in cursor.fetchall()]
+            cursor.executemany('''UPDATE context_embeddings SET token_count = ? WHERE id = ?''', counts)
+
+        return len(counts)
+
     def initialize_with_entries(self, contexts : list[Context] = None, custom_gpts : list[CustomGPT] = None) -> None:
         """
         Initializes the database. Any GPT objects and context provided will be used to populate the database. Context objects associated with a particular gpt will also be added.
@@ -282,66 +591,90 @@ class context_db_connection:
         :return: None
         """
 
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        #create tables
-        cursor.execute('''DROP TABLE IF EXISTS custom_gpt''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS custom_gpt (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE,
-        model TEXT NOT NULL,
-        context_embedding_model TEXT NOT NULL,
-        initial_role TEXT,
-        initial_context TEXT
-        )
-        ''')
-        cursor.execute('''DROP TABLE IF EXISTS context''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS context (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE,
-        origin_filename TEXT NOT NULL,
-        faiss_index_filename TEXT NOT NULL
-        )
-        ''')
-        cursor.execute('''DROP TABLE IF EXISTS context_embeddings''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS context_embeddings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        context_id INTEGER NOT NULL,
-        chunk_index INTEGER NOT NULL,
-        chunk_text TEXT NOT NULL,
-        embedding_vector TEXT NOT NULL,
-        CONSTRAINT fk_context
-            FOREIGN KEY(context_id) REFERENCES context(id)
-            ON DELETE CASCADE
-        )
-        ''')
-        cursor.execute('''DROP TABLE IF EXISTS gpt_context''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS gpt_context (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        gpt_id INTEGER NOT NULL,
-        context_id INTEGER NOT NULL,
-        CONSTRAINT fk_context
-            FOREIGN KEY(context_id) REFERENCES context (id)
-            ON DELETE CASCADE,
-        CONSTRAINT fk_gpt_context
-            FOREIGN KEY(gpt_id) REFERENCES custom_gpt (id)
-            ON DELETE CASCADE
-        )
-        ''')
+        with self.transaction(write=True) as cursor:
+            #create tables
+            cursor.execute('''DROP TABLE IF EXISTS custom_gpt''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS custom_gpt (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            model TEXT NOT NULL,
+            context_embedding_model TEXT NOT NULL,
+            initial_role TEXT,
+            initial_context TEXT
+            )
+            ''')
+            cursor.execute('''DROP TABLE IF EXISTS context''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS context (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            origin_filename TEXT NOT NULL,
+            faiss_index_filename TEXT NOT NULL
+            )
+            ''')
+            cursor.execute('''DROP TABLE IF EXISTS context_embeddings''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS context_embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            context_id INTEGER NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            chunk_text TEXT NOT NULL,
+            embedding_vector BLOB NOT NULL,
+            CONSTRAINT fk_context
+                FOREIGN KEY(context_id) REFERENCES context(id)
+                ON DELETE CASCADE
+            )
+            ''')
+            cursor.execute('''DROP TABLE IF EXISTS gpt_context''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS gpt_context (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gpt_id INTEGER NOT NULL,
+            context_id INTEGER NOT NULL,
+            CONSTRAINT fk_context
+                FOREIGN KEY(context_id) REFERENCES context (id)
+                ON DELETE CASCADE,
+            CONSTRAINT fk_gpt_context
+                FOREIGN KEY(gpt_id) REFERENCES custom_gpt (id)
+                ON DELETE CASCADE
+            )
+            ''')
+
+            #checkpoints refer to the contexts just dropped
+            cursor.execute('''DROP TABLE IF EXISTS ingestion_checkpoint''')
+
+            #bring the new tables up to the latest schema version
+            cursor.execute('''PRAGMA user_version = 0''')
+            self.migrate()
+
+            #insert data into tables
+            if contexts:
+                for context in contexts:
+                    self.write_context(context)
+
+            if custom_gpts:
+                for custom_gpt in custom_gpts:
+                    self.write_custom_gpt(custom_gpt)
 
-        #insert data into tables
-        if contexts:
-            for context in contexts:
-                self.write_context(context)
-
-        if custom_gpts:
-            for custom_gpt in custom_gpts:
-                self.write_custom_gpt(custom_gpt)
+        return
 
-        #close database connection
-        conn.commit()
-        conn.close()
 
-        return
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance commands for a custom GPT database.")
+    parser.add_argument("db_name")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="apply pending schema migrations")
+    commands.add_parser("migrate-blob", help="convert text embeddings to float32 BLOBs in place")
+    count_parser = commands.add_parser("count-tokens", help="store token counts for chunks written without them")
+    count_parser.add_argument("--model", default="gpt-4-turbo", help="chat model whose tokenizer to count with")
+    args = parser.parse_args()
+
+    db_connection = context_db_connection(args.db_name, migrate=args.command == "migrate")
+    if args.command == "migrate":
+        print(f"Schema is at version {db_connection.schema_version()}")
+    elif args.command == "migrate-blob":
+        print(f"Converted {db_connection.migrate_embeddings_to_blob()} embeddings to BLOBs")
+    elif args.command == "count-tokens":
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(args.model)
+        print(f"Counted tokens of {db_connection.backfill_token_counts(lambda text: len(encoding.encode(text)))} chunks")
@@ -0,0 +1,169 @@
+"""
+Filename: embedding_cache.py
+Description:
+    Persistent, content-addressed cache of chunk embeddings stored in the SQLite database next to the contexts.
+    Entries are keyed by a hash of (embedding model, chunk text), so re-ingesting an unchanged or slightly edited
+    document only sends the chunks that actually changed to the embeddings endpoint.
+
+Usage:
+    python -m src.data.embedding_cache db/gpt-database.db stats
+    python -m src.data.embedding_cache db/gpt-database.db evict --max-mb 200 [--older-than-days 90]
+    python -m src.data.embedding_cache db/gpt-database.db vacuum
+"""
+import argparse
+import hashlib
+import time
+
+import numpy as np
+
+from src.data.connection_pool import get_pool
+
+
+class embedding_cache_db_connection:
+    # SQLite limits the number of bound parameters in one statement, so lookups are split into groups
+    max_keys_per_query = 500
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.pool = get_pool(db_name)  # shares pooled connections with context_db_connection on the same file
+        self.initialize()
+        return
+
+    @staticmethod
+    def cache_key(model : str, text : str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def initialize(self) -> None:
+        """
+        Create the cache table if it doesn't exist. Unlike the context tables this is never dropped by
+        context_db_connection.initialize_with_entries, so cached embeddings survive a database reset.
+        """
+        with self.pool.transaction(write=True) as cursor:
+            cursor.execute('''CREATE TABLE IF NOT EXISTS embedding_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            embedding_vector BLOB NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+            )
+            ''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache (last_used_at)''')
+
+        return
+
+    def get_many(self, model : str, texts : list) -> dict:
+        """
+        Look up cached embeddings for a list of texts.
+        :return: dict mapping each text found in the cache to its float32 vector
+        """
+        keys = {self.cache_key(model, text): text for text in texts}
+        found = {}
+
+        with self.pool.transaction(write=True) as cursor:
+            key_list = list(keys)
+            for i in range(0, len(key_list), self.max_keys_per_query):
+                group = key_list[i:i + self.max_keys_per_query]
+                placeholders = ",".join("?" * len(group))
+                cursor.execute(f'''SELECT key, embedding_vector FROM embedding_cache WHERE key IN ({placeholders})''', group)
+                for key, vector in cursor.fetchall():
+                    found[keys[key]] = np.frombuffer(vector, dtype="float32")
+                cursor.execute(f'''UPDATE embedding_cache SET last_used_at = ? WHERE key IN ({placeholders})''', [time.time()] + group)
+
+        return found
+
+    def put_many(self, model : str, embeddings : list) -> None:
+        """
+        Store embeddings in the cache.
+        :param embeddings: list of [text, vector] pairs
+        """
+        now = time.time()
+        rows = []
+        for text, vector in embeddings:
+            blob = np.asarray(vector, dtype="float32").tobytes()
+            rows.append((self.cache_key(model, text), model, blob, len(blob), now, now))
+
+        with self.pool.transaction(write=True) as cursor:
+            cursor.executemany('''INSERT OR REPLACE INTO embedding_cache (key, model, embedding_vector, size_bytes, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)''', rows)
+
+        return
+
+    def size(self) -> dict:
+        """
+        :return: number of cached entries and total bytes of stored vectors, overall and per model
+        """
+        with self.pool.transaction() as cursor:
+            cursor.execute('''SELECT model, COUNT(*), COALESCE(SUM(size_bytes), 0) FROM embedding_cache GROUP BY model''')
+            models = {model: {"entries": entries, "bytes": size} for model, entries, size in cursor.fetchall()}
+
+        return {"entries": sum(m["entries"] for m in models.values()),
+                "bytes": sum(m["bytes"] for m in models.values()),
+                "models": models}
+
+    def evict(self, max_bytes : int = None, older_than_days : float = None) -> int:
+        """
+        Remove entries not used in the last older_than_days days, then least recently used entries until the
+        stored vectors fit within max_bytes. Run vacuum() afterwards to give the space back to the filesystem.
+        :return: number of entries removed
+        """
+        removed = 0
+
+        with self.pool.transaction(write=True) as cursor:
+            if older_than_days is not None:
+                cursor.execute('''DELETE FROM embedding_cache WHERE last_used_at < ?''', (time.time() - older_than_days * 86400,))
+                removed += cursor.rowcount
+            if max_bytes is not None:
+                cursor.execute('''SELECT COALESCE(SUM(size_bytes), 0) FROM embedding_cache''')
+                excess = cursor.fetchone()[0] - max_bytes
+                if excess > 0:
+                    #walk entries from least to most recently used until enough bytes are covered
+                    cursor.execute('''SELECT key, size_bytes FROM embedding_cache ORDER BY last_used_at ASC''')
+                    stale = []
+                    for key, size in cursor.fetchall():
+                        if excess <= 0:
+                            break
+                        stale.append((key,))
+                        excess -= size
+                    cursor.executemany('''DELETE FROM embedding_cache WHERE key = ?''', stale)
+                    removed += len(stale)
+
+        return removed
+
+    def vacuum(self) -> None:
+        """
+        Rebuild the database file to release space freed by evictions.
+        """
+        #VACUUM can't run inside a transaction
+        with self.pool.connection() as conn:
+            conn.execute('''VACUUM''')
+
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and shrink the persistent embedding cache.")
+    parser.add_argument("db_name")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats")
+    evict_parser = commands.add_parser("evict")
+    evict_parser.add_argument("--max-mb", type=float)
+    evict_parser.add_argument("--older-than-days", type=float)
+    commands.add_parser("vacuum")
+    args = parser.parse_args()
+
+    cache = embedding_cache_db_connection(args.db_name)
+    if args.command == "evict":
+        max_bytes = None if args.max_mb is None else int(args.max_mb * 1024 * 1024)
+        print(f"Evicted {cache.evict(max_bytes, args.older_than_days)} entries")
+    elif args.command == "vacuum":
+        cache.vacuum()
+    stats = cache.size()
+    print(f"{stats['entries']} cached embeddings, {stats['bytes'] / 1024 / 1024:.1f} MB")
+    for model, model_stats in stats["models"].items():
+        print(f"  {model}: {model_stats['entries']} entries, {model_stats['bytes'] / 1024 / 1024:.1f} MB")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Filename: answer_cache.py
+Description:
+    Semantic cache of a CustomGPT's answers. Past queries are kept in a small FAISS inner product index over their
+    normalized embeddings, so a new query whose cosine similarity to a cached one reaches the threshold gets that
+    query's answer without retrieval or a completion. Only answers to the first turn of a conversation are cached,
+    since later answers depend on what came before. Entries expire after ttl seconds and the least recently used
+    are evicted beyond max_entries. An entry only matches queries asked with the same retrieval settings.
+    Clearing the cache starts a new generation; an answer put with the generation read before it was generated is
+    dropped if the cache was cleared meanwhile, so a query in flight during an update can't cache a stale answer.
+
+Usage:
+    cache = SemanticAnswerCache(threshold=0.95, ttl=3600, max_entries=256)
+    generation = cache.generation
+    answer = cache.get(query_vector, settings)
+    if answer is None:
+        answer = ...
+        cache.put(query_vector, settings, answer, generation)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+from src.service.index_spec import normalize
+
+
+class SemanticAnswerCache:
+    """
+    Safe to share between threads; hit and miss counts are kept for monitoring.
+    """
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600.0, max_entries: int = 256):
+        self.threshold = threshold      # least cosine similarity between a query and a cached one for a hit
+        self.ttl = ttl                  # seconds an answer stays valid; None to never expire
+        self.max_entries = max_entries  # least recently used entries are evicted beyond this
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0             # incremented by every clear()
+        self.index = None               # IndexIDMap2 over the normalized query vectors, made on the first put
+        self._entries = OrderedDict()   # id in the index -> (expiry time, settings, answer), least recently used first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        return
+
+    def get(self, query_vector: np.ndarray, settings: tuple = ()) -> str:
+        """
+        Return the answer of the most similar cached query asked with the same settings, or None if none is similar
+        enough.
+        :param settings: anything else the answer depends on, e.g. the retrieval parameters of the query
+        """
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                self.misses += 1
+                return None
+            #the closest few, in case the closest was asked with other settings
+            similarities, ids = self.index.search(normalize(query_vector), min(8, self.index.ntotal))
+            now = time.monotonic()
+            expired = []
+            answer = None
+            for similarity, entry_id in zip(similarities[0], ids[0]):
+                if similarity < self.threshold:
+                    break
+                expiry, entry_settings, entry_answer = self._entries[int(entry_id)]
+                if expiry is not None and expiry <= now:
+                    expired.append(int(entry_id))
+                elif entry_settings == settings:
+                    self._entries.move_to_end(int(entry_id))
+                    answer = entry_answer
+                    break
+            self._remove(expired)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def put(self, query_vector: np.ndarray, settings: tuple, answer: str, generation: int = None) -> None:
+        """
+        :param generation: the cache's generation when the answer's retrieval started; if the cache has been cleared
+                           since, the answer may come from what the clear was for and isn't cached
+        """
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        vector = normalize(query_vector)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            self.index.add_with_ids(vector, np.array([self._next_id], dtype="int64"))
+            self._entries[self._next_id] = (expiry, settings, answer)
+            self._next_id += 1
+            if len(self._entries) > self.max_entries:
+                self._remove(list(self._entries)[:len(self._entries) - self.max_entries])
+        return
+
+    def _remove(self, entry_ids: list) -> None:
+        if entry_ids:
+            self.index.remove_ids(np.array(entry_ids, dtype="int64"))
+            for entry_id in entry_ids:
+                del self._entries[entry_id]
+        return
+
+    def clear(self) -> None:
+        """
+        Forget every answer, e.g. because the contexts or instructions they were generated from changed.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.index = None
+            self.generation += 1
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_entries": self.max_entries}
@@ -0,0 +1,159 @@
+"""
+Filename: chat_history.py
+Description:
+    Chat history of a CustomGPT kept within a token bound. Each message's tokens are counted at most once, the
+    first time they're needed, so a history without a bound never tokenizes anything unless token_count is read.
+    When the total goes over max_tokens the oldest turns are dropped, or with a summarize function folded into a
+    running summary of the conversation so far. Outgoing message lists are built from the stored message dicts
+    without copying them; the dicts are never modified after they are added. The approximate bytes of the message
+    texts are kept as messages come and go, so the memory of many histories can be tracked without walking them.
+
+Usage:
+    history = ChatHistory("You are a helpful assistant", max_tokens=4000, count_tokens=gpt.count_tokens)
+    history.append("user", "What anchors a curtain wall?")
+    messages = history.messages(extra=[{"role": "user", "content": prompt}], reserve_tokens=prompt_tokens)
+"""
+import sys
+from collections import deque
+
+# tokens the chat format adds around every message, on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ChatHistory:
+
+    def __init__(self, system_prompt : str, max_tokens : int = None, count_tokens=None, summarize=None):
+        """
+        :param max_tokens: most tokens kept in the history, including the system prompt; None keeps everything
+        :param count_tokens: function from text to its token count; without it tokens are estimated as 4 characters each
+        :param summarize: optional function (previous summary or None, list of dropped messages) -> new summary text.
+                          Without it turns that don't fit are simply dropped. A summary longer than a quarter of
+                          max_tokens is cut to fit.
+        """
+        self.max_tokens = max_tokens
+        self.bind(count_tokens, summarize)
+        self.system = self._entry("system", system_prompt)
+        self.summary = None         # [message, tokens] summarizing dropped turns, if summarize is set
+        self.turns = deque()        # [message, tokens] of the user and assistant turns kept, oldest first
+        self.content_bytes = _content_bytes(self.system)
+        self.on_resize = None       # optional function called with the change in content_bytes whenever it changes
+
+    def bind(self, count_tokens=None, summarize=None) -> None:
+        """
+        Replace the token counting and summarize functions, e.g. to point a history at a reloaded GPT so it
+        doesn't keep the old one alive.
+        """
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        self.summarize = summarize
+        return
+
+    @staticmethod
+    def _entry(role : str, content : str) -> list:
+        #tokens are filled in by _tokens when first needed
+        return [{"role": role, "content": content}, None]
+
+    def _tokens(self, entry : list) -> int:
+        if entry[1] is None:
+            entry[1] = self.count_tokens(entry[0]["content"]) + MESSAGE_OVERHEAD_TOKENS
+        return entry[1]
+
+    @property
+    def token_count(self) -> int:
+        """
+        Tokens in the history as it would be sent: system prompt, summary and kept turns.
+        """
+        return self._tokens(self.system) + (0 if self.summary is None else self._tokens(self.summary)) + sum(self._tokens(entry) for entry in self.turns)
+
+    def _resized(self, delta : int) -> None:
+        self.content_bytes += delta
+        if delta != 0 and self.on_resize is not None:
+            self.on_resize(delta)
+        return
+
+    def append(self, role : str, content : str) -> None:
+        entry = self._entry(role, content)
+        self.turns.append(entry)
+        self._resized(_content_bytes(entry) + self._trim())
+        return
+
+    def _trim(self) -> int:
+        """
+        Drop or summarize the oldest turns until the history fits in max_tokens.
+        :return: change in content bytes
+        """
+        delta = 0
+        if self.max_tokens is None:
+            return delta
+        total = self.token_count
+        #always keep the latest turn, even if it is over the bound on its own
+        while total > self.max_tokens and len(self.turns) > 1:
+            dropped = []
+            while total > self.max_tokens and len(self.turns) > 1:
+                entry = self.turns.popleft()
+                total -= entry[1]
+                delta -= _content_bytes(entry)
+                dropped.append(entry[0])
+            if self.summarize is not None:
+                #the new summary replaces the old one, and may itself push older turns out
+                previous = None
+                if self.summary is not None:
+                    previous = self.summary[0]["content"]
+                    total -= self.summary[1]
+                    delta -= _content_bytes(self.summary)
+                self.summary = self._entry("system", self.summarize(previous, dropped))
+                self._shorten(self.summary, self.max_tokens // 4)
+                total += self._tokens(self.summary)
+                delta += _content_bytes(self.summary)
+        return delta
+
+    def _shorten(self, entry : list, max_tokens : int) -> None:
+        #cut the content in proportion to how far over it is, until it fits
+        while self._tokens(entry) > max_tokens and len(entry[0]["content"]) > 0:
+            content = entry[0]["content"]
+            keep = min(len(content) - 1, len(content) * (max_tokens - MESSAGE_OVERHEAD_TOKENS) // entry[1])
+            entry[0] = {"role": entry[0]["role"], "content": content[:max(0, keep)]}
+            entry[1] = None
+        return
+
+    def messages(self, extra : list = None, reserve_tokens : int = 0) -> list:
+        """
+        Build the message list to send: the system prompt, the summary if there is one, then as many of the most
+        recent turns as fit in max_tokens less reserve_tokens, then extra.
+        :param extra: messages to send after the history without adding them to it, e.g. the prompt with context
+        :param reserve_tokens: tokens to leave free for extra
+        """
+        head = [self.system[0]] + ([] if self.summary is None else [self.summary[0]])
+        turns = [message for message, _ in self.turns]
+        if self.max_tokens is not None and reserve_tokens > 0:
+            available = self.max_tokens - reserve_tokens - self._tokens(self.system) - (0 if self.summary is None else self._tokens(self.summary))
+            kept = 0
+            for entry in reversed(self.turns):
+                if self._tokens(entry) > available:
+                    break
+                available -= entry[1]
+                kept += 1
+            turns = turns[len(turns) - kept:]
+        return head + turns + (extra or [])
+
+    def clear(self) -> None:
+        """
+        Drop all turns and the summary, keeping the system prompt.
+        """
+        delta = -sum(_content_bytes(entry) for entry in self.turns) - (0 if self.summary is None else _content_bytes(self.summary))
+        self.turns.clear()
+        self.summary = None
+        self._resized(delta)
+        return
+
+    def __len__(self):
+        return len(self.turns) + 1 + (self.summary is not None)
+
+    def __getitem__(self, item):
+        return self.messages()[item]
+
+    def __iter__(self):
+        return iter(self.messages())
+
+
+def _content_bytes(entry : list) -> int:
+    return sys.getsizeof(entry[0]["content"])
@@ -0,0 +1,183 @@
+import re
+from bisect import bisect_right
+
+# Boundaries a chunk may be cut on, from weakest to strongest
+BOUNDARY_LEVELS = {"token": 0, "word": 1, "sentence": 2, "paragraph": 3}
+# level of a token that starts inside a character, e.g. the second byte of "é" with byte-level tokens
+MID_CHARACTER = -1
+
+_WHITESPACE = re.compile(r"\s+")
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]*$")
+
+
+def _token_boundary_levels(text: str, offsets: list) -> list:
+    """
+    Classify every token start offset by the strongest boundary it sits on.
+    A token that starts inside (or right after) a run of whitespace is a word boundary; the run is promoted
+    to a sentence boundary when the text before it ends a sentence, and to a paragraph boundary when the run
+    contains a newline. Runs and offsets are both sorted, so this is a single linear merge.
+    """
+    levels = [0] * len(offsets)
+    runs = _WHITESPACE.finditer(text)
+    run = next(runs, None)
+    for i, offset in enumerate(offsets):
+        #advance to the first whitespace run that could contain this offset
+        while run is not None and run.end() < offset:
+            run = next(runs, None)
+        if run is None:
+            break
+        if run.start() <= offset <= run.end():
+            if "\n" in run.group():
+                levels[i] = BOUNDARY_LEVELS["paragraph"]
+            elif _SENTENCE_END.search(text, max(0, run.start() - 4), run.start()):
+                levels[i] = BOUNDARY_LEVELS["sentence"]
+            else:
+                levels[i] = BOUNDARY_LEVELS["word"]
+    return levels
+
+
+def _character_levels(encoding, tokens: list, levels: list) -> list:
+    """
+    Mark the tokens that start inside a multibyte character as MID_CHARACTER, so no chunk is cut there.
+    """
+    for i, token_bytes in enumerate(encoding.decode_tokens_bytes(tokens)):
+        #UTF-8 continuation bytes are 10xxxxxx
+        if token_bytes and token_bytes[0] & 0xC0 == 0x80:
+            levels[i] = MID_CHARACTER
+    return levels
+
+
+def _find_cut(levels: list, start: int, hard_end: int, level: int) -> int:
+    """
+    Walk back from hard_end to the last token in (start, hard_end] that starts a boundary of at least the
+    requested level. Falls back to the strongest weaker boundary seen, then to the last token starting a
+    character, and to a hard token cut if there is none.
+    """
+    best, best_level = hard_end, MID_CHARACTER
+    for i in range(hard_end, start, -1):
+        if levels[i] >= level:
+            return i
+        if levels[i] > best_level:
+            best, best_level = i, levels[i]
+    return best
+
+
+def _validate(chunk_size: int, overlap: int, boundary: str) -> None:
+    if boundary not in BOUNDARY_LEVELS:
+        raise ValueError(f"boundary must be one of {list(BOUNDARY_LEVELS)}, not {boundary}")
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    if not 0 <= overlap < chunk_size:
+        raise ValueError("overlap must be non-negative and smaller than chunk_size")
+
+
+def _cut_ranges(levels: list, n_tokens: int, chunk_size: int, overlap: int, level: int, final: bool) -> tuple:
+    """
+    Split n_tokens tokens into (start, end) ranges of at most chunk_size tokens, cut on the requested boundary level.
+    Unless final, more text will follow the last token, so cutting stops before a chunk that would reach it.
+    Chunks start and end only on tokens that start a character (unless one character is more than chunk_size
+    tokens), so the text left over can be cut again later exactly as if it had been cut with the text before it.
+    :return: (list of ranges, token the next chunk starts at)
+    """
+    ranges = []
+    start = 0
+    while start < n_tokens:
+        #the last token may still merge with the text that follows, so only cut well before it
+        if not final and start + chunk_size >= n_tokens - 1:
+            break
+        end = min(start + chunk_size, n_tokens)
+        if end < n_tokens:
+            end = _find_cut(levels, start, end, level)
+        ranges.append((start, end))
+        if end >= n_tokens:
+            return ranges, n_tokens
+
+        #step back by the overlap, snapping forward to a word boundary so the next chunk doesn't open mid-word,
+        #or with token boundaries to the start of a character
+        next_start = end - overlap
+        while next_start < end and levels[next_start] < min(level, BOUNDARY_LEVELS["word"]):
+            next_start += 1
+        start = max(next_start, start + 1)
+        while start < end and levels[start] == MID_CHARACTER:
+            start += 1
+
+    return ranges, start
+
+
+def chunk_token_stream(blocks, encoding, chunk_size: int = 500, overlap: int = 0, boundary: str = "word"):
+    """
+    Chunk a document arriving as a stream of text blocks (pages, paragraphs, lines), yielding each chunk as soon as
+    the text after it is known. Blocks are joined with newlines, so a block boundary is a paragraph boundary, and only
+    the text not yet cut into chunks (a few chunks' worth, or one block if that is larger) is held at a time.
+    :param blocks: iterable of (source, text) pairs, where source identifies the block, e.g. its page number
+    :param encoding: tiktoken encoding used to count tokens
+    :return: generator of (chunk_text, token_count, (first source, last source)) tuples
+    """
+    _validate(chunk_size, overlap, boundary)
+    level = BOUNDARY_LEVELS[boundary]
+    min_window = 8 * chunk_size     # characters buffered before cutting; roughly two chunks of English text
+
+    buffer = ""         # text not cut into chunks yet
+    block_starts = []   # offset in buffer where each of its blocks starts
+    block_sources = []  # source of each of those blocks
+    window = min_window
+
+    def cut(final: bool):
+        nonlocal buffer, block_starts, block_sources, window
+        tokens = encoding.encode(buffer, disallowed_special=())
+        decoded, offsets = encoding.decode_with_offsets(tokens)
+        levels = _token_boundary_levels(decoded, offsets) if level > 0 else [0] * len(tokens)
+        if not buffer.isascii():
+            levels = _character_levels(encoding, tokens, levels)
+        ranges, resume = _cut_ranges(levels, len(tokens), chunk_size, overlap, level, final)
+        for start, end in ranges:
+            raw = decoded[offsets[start]:offsets[end] if end < len(tokens) else len(decoded)]
+            chunk = raw.strip()
+            if chunk:
+                first = offsets[start] + len(raw) - len(raw.lstrip())
+                last = first + len(chunk) - 1
+                yield (chunk, end - start, (block_sources[bisect_right(block_starts, first) - 1],
+                                            block_sources[bisect_right(block_starts, last) - 1]))
+
+        #keep the uncut tail, with the blocks it overlaps, and wait for twice as much text before cutting it again
+        tail = offsets[resume] if resume < len(tokens) else len(decoded)
+        keep = max(bisect_right(block_starts, tail) - 1, 0)
+        buffer = decoded[tail:]
+        block_starts = [max(block_start - tail, 0) for block_start in block_starts[keep:]]
+        block_sources = block_sources[keep:]
+        window = max(min_window, 2 * len(buffer))
+
+    for source, text in blocks:
+        if not text or not text.strip():
+            continue
+        #cut before adding the next block, so a document that is a single block is tokenized exactly once
+        if len(buffer) >= window:
+            yield from cut(final=False)
+        if buffer:
+            buffer += "\n"
+        block_starts.append(len(buffer))
+        block_sources.append(source)
+        buffer += text
+
+    if buffer:
+        yield from cut(final=True)
+
+
+def chunk_token_spans(text: str, encoding, chunk_size: int = 500, overlap: int = 0, boundary: str = "word") -> list:
+    """
+    Tokenize text once and split it into chunks of at most chunk_size tokens.
+    :param text: document text
+    :param encoding: tiktoken encoding used to count tokens
+    :param chunk_size: maximum number of tokens in a chunk
+    :param overlap: number of tokens repeated from the end of one chunk at the start of the next
+    :param boundary: preferred cut point; one of "token", "word", "sentence" or "paragraph"
+    :return: list of (chunk_text, token_count) tuples
+    """
+    return [(chunk, n_tokens) for chunk, n_tokens, _ in chunk_token_stream([(None, text)], encoding, chunk_size, overlap, boundary)]
+
+
+def chunk_text(text: str, encoding, chunk_size: int = 500, overlap: int = 0, boundary: str = "word") -> list[str]:
+    """
+    Split text into chunks of at most chunk_size tokens. See chunk_token_spans for the parameters.
+    """
+    return [chunk for chunk, _ in chunk_token_spans(text, encoding, chunk_size, overlap, boundary)]
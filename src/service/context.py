@@ -1,6 +1,8 @@
 import numpy as np
 import faiss
 import os
+from src.service.index_spec import build_index, parse_index_spec, metric_type, normalize
+from src.service.retrieval import Hit, similarity_from_distances, mmr
 
 class Context:
     """
@@ -18,75 +20,423 @@ class Context:
     --------------
     1. Initialize with a name and optional embeddings.
     2. If embeddings are provided, a FAISS index is built automatically.
-    3. Call `query_similar(query_vector, k)` to retrieve the top-k
-       most similar chunks of text to the query vector.
+    3. Call `search(query_vector, k)` to retrieve the top-k most similar
+       chunks as scored Hits, or `query_similar(query_vector, k)` for
+       their text joined into one string.
+
+    Index types:
+    ------------
+    `index_spec` selects the FAISS index built for the context: "flat"
+    (exact, the default), "ivf", "hnsw" or "ivfpq", optionally with
+    parameters such as "hnsw:efSearch=128". See src/service/index_spec.py.
+    `metric` is "l2" (the default) or "cosine"; stored and query vectors
+    are normalized either way, so both rank chunks by cosine similarity,
+    but cosine indexes report the similarity itself (higher is closer).
+
+    Memory-mapped mode:
+    -------------------
+    A context loaded with `load_faiss_index(filename, mmap=True)` and
+    `set_chunks(chunks)` keeps only the chunk texts in Python. The vectors
+    live solely in the read-only, memory-mapped index file, so
+    `embeddings` is None and the index cannot be modified in place.
+
+    Incremental updates:
+    --------------------
+    Every chunk has a stable id (`chunk_ids`, its position until chunks
+    are added or removed) that FAISS returns for it and Hits carry.
+    `add_chunks`, `remove_chunks` and `replace_chunks` edit the index by
+    id instead of rebuilding it, so an edit costs time in proportion to
+    the chunks it touches; context_db_connection.update_context_chunks
+    writes the same diff to the database. The first edit copies a
+    memory-mapped index into memory, and moves a flat or hnsw index into
+    an IndexIDMap2 (IVF indexes keep ids themselves). HNSW graphs can't
+    drop vectors, so removing or replacing chunks of an hnsw context
+    rebuilds the graph from the stored vectors.
     """
     def __init__(self, name: str, associated_doc_name: str = None,
                  embeddings: list = None,
-                 embedding_model: str = "text-embedding-3-small"):
+                 embedding_model: str = "text-embedding-3-small",
+                 index_spec: str = "flat",
+                 metric: str = "l2",
+                 token_counts: list = None,
+                 sources: list = None):
         # Name of this context object (like an identifier)
         self.associated_doc_name = associated_doc_name  # Optional link to a document
         self.embeddings = embeddings                    # List of (chunk, vector) pairs
+        self.chunks = None                              # List of chunk texts, in index order
         self.embeddings_model = embedding_model         # Model used to create embeddings
         self.index = None                               # Will hold the FAISS index
         self.name = name                                # Human-readable context name
+        self.mmap = False                               # True when the index is a read-only memory map of its file
+        parse_index_spec(index_spec)                    # fail early on a bad spec
+        self.index_spec = index_spec                    # Type and parameters of the FAISS index, see index_spec.py
+        metric_type(metric)
+        self.metric = metric                            # "l2" distance or "cosine" similarity between normalized vectors
+        self.token_counts = token_counts                # Tokens in each chunk, counted at ingestion; None if unknown
+        self.sources = sources                          # (first, last) page/paragraph/line of each chunk; None if unknown
+        self.chunk_ids = None                           # Stable id of each chunk, in index order
+        self._positions = None                          # chunk id -> position, None while ids are positions
 
         # If embeddings were provided, immediately build a FAISS index for similarity search
         if embeddings is not None:
+            self.chunks = [e[0] for e in embeddings]
+            self._set_chunk_ids(None)
             self.generate_faiss_index()
 
         return
 
-    def query_similar(self, query_vector: np.array, k: int = 10) -> str:
+    def search(self, query_vector: np.array, k: int = 10,
+               score_threshold: float = None, mmr_diversity: float = None,
+               fetch_k: int = None) -> list:
         """
         Query the FAISS index for the k most similar chunks to the given vector.
-        Returns a string containing the top matching chunks.
+        The query is normalized like the stored vectors before searching.
+        k is clamped to the number of chunks in the index.
+        :param score_threshold: drop chunks whose cosine similarity to the query is below this
+        :param mmr_diversity: re-rank with maximal marginal relevance, from 0
+                              (plain ranking) to 1 (avoid near-duplicates only)
+        :param fetch_k: candidates fetched for MMR to choose from, default max(4k, 20)
+        :return: list of Hits, most similar first
         """
-        if all([self.index is not None, self.embeddings is not None]):
-            # Perform similarity search in FAISS
-            D, I = self.index.search(np.array([query_vector], dtype="float32"), k)
+        return self.search_batch(query_vector, k, score_threshold, mmr_diversity, fetch_k)[0]
 
-            # Collect the top k text chunks that match
-            top_chunks = ""
-            for i in range(k):
-                top_chunks += ("Chunk from FAISS: " + self.embeddings[I[0][i]][0] + "\n")
-        else:
+    def search_batch(self, query_vectors: np.ndarray, k: int = 10,
+                     score_threshold: float = None, mmr_diversity: float = None,
+                     fetch_k: int = None) -> list:
+        """
+        Like search() for many queries at once, with a single FAISS search
+        over the matrix of query vectors.
+        :param query_vectors: one query vector per row, or a list of vectors
+        :return: one list of Hits per query, in query order
+        """
+        if not all([self.index is not None, self.chunks is not None]):
             raise RuntimeError("FAISS index has not been initialized or there is no associated text.")
+
+        queries = normalize(query_vectors)
+        k = min(k, self.index.ntotal)
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+        n_candidates = k if mmr_diversity is None else min(self.index.ntotal, fetch_k or max(4 * k, 20))
+
+        # Perform similarity search in FAISS
+        D, I = self.index.search(queries, n_candidates)
+        return [self._hits(D[row], I[row], k, score_threshold, mmr_diversity) for row in range(len(queries))]
+
+    def _hits(self, distances: np.ndarray, ids: np.ndarray, k: int,
+              score_threshold: float, mmr_diversity: float) -> list:
+        """
+        Turn one query's row of FAISS results into Hits.
+        """
+        # Approximate indexes pad with -1 when they find fewer candidates
+        found = ids >= 0
+        if score_threshold is not None:
+            found &= similarity_from_distances(distances, self.index.metric_type) >= score_threshold
+        ids = ids[found]
+        scores = similarity_from_distances(distances[found], self.index.metric_type)
+
+        if mmr_diversity is not None:
+            order = mmr(self._normalized_vectors(ids), scores, k, mmr_diversity)
+            ids, scores = ids[order], scores[order]
+
+        hits = []
+        for i, score in zip(ids[:k], scores[:k]):
+            position = self.chunk_position(int(i))
+            hits.append(Hit(self.name, int(i), float(score), self.chunks[position],
+                            None if self.token_counts is None else self.token_counts[position],
+                            None if self.sources is None else self.sources[position]))
+        return hits
+
+    def query_similar(self, query_vector: np.array, k: int = 10,
+                      score_threshold: float = None, mmr_diversity: float = None) -> str:
+        """
+        Query the FAISS index for the k most similar chunks to the given vector.
+        Returns a string containing the top matching chunks, see search().
+        """
+        # Collect the text chunks that match
+        top_chunks = ""
+        for hit in self.search(query_vector, k, score_threshold, mmr_diversity):
+            top_chunks += ("Chunk from FAISS: " + hit.text + "\n")
         return top_chunks
 
     def generate_faiss_index(self) -> None:
         """
         Create and populate a FAISS index from the stored embeddings.
-        Each embedding vector is normalized before insertion.
+        Each embedding vector is normalized before insertion. The index type
+        comes from index_spec; approximate indexes are trained on the same vectors.
         """
         if len(self.embeddings) > 0:
-            # Create a flat L2 index with dimension equal to embedding length
-            self.index = faiss.IndexFlatL2(len(self.embeddings[0][1]))
-
-            # Normalize each embedding vector before adding to index
-            vectors = np.array([e[1] / np.linalg.norm(e[1]) for e in self.embeddings])
+            # Normalize all embedding vectors in one pass before adding to index
+            vectors = normalize([e[1] for e in self.embeddings])
 
-            # Add the vectors to FAISS index
-            self.index.add(vectors)
+            # Build, train if needed, and fill the FAISS index
+            self.index = build_index(vectors, self.index_spec, self.metric)
+            if self._positions is not None:
+                # chunks were added or removed since their ids were assigned
+                self.index = self._refilled(self.index, vectors, self.chunk_ids)
         else:
             self.index = None
             raise ValueError("Embeddings attribute is empty")
+        self.mmap = False
         return
 
-    def load_faiss_index(self, fiass_index_filename: str) -> None:
+    def load_faiss_index(self, fiass_index_filename: str, mmap: bool = False) -> None:
         """
         Load a FAISS index from file and assign to this context.
+        With mmap=True the stored vectors are memory-mapped read-only instead of
+        copied into memory, so pages are shared with the OS file cache and only
+        read in when searched.
         """
-        self.index = faiss.read_index(fiass_index_filename)
+        if mmap:
+            self.index = faiss.read_index(fiass_index_filename, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        else:
+            self.index = faiss.read_index(fiass_index_filename)
+        self.mmap = mmap
         return
 
-    def set_embeddings(self, embeddings: list) -> None:
+    def get_vectors(self) -> np.ndarray:
+        """
+        Return the stored vectors as a matrix, one row per chunk.
+        Uses the embeddings when they are held in memory, otherwise
+        reconstructs them from the index (where they are normalized).
+        """
+        if self.embeddings is not None:
+            return np.array([e[1] for e in self.embeddings], dtype="float32")
+        if self.index is not None:
+            if self._positions is None and not isinstance(self.index, faiss.IndexIDMap2):
+                self._make_reconstructable()
+                return self.index.reconstruct_n(0, self.index.ntotal)
+            return self.get_chunk_vectors(self.chunk_ids)
+        raise RuntimeError("Context has neither embeddings nor a FAISS index to take vectors from.")
+
+    def get_chunk_vectors(self, chunk_ids: list) -> np.ndarray:
+        """
+        Return the vectors of the given chunks, one row each, like get_vectors().
+        Vectors reconstructed from an ivfpq index are approximate.
+        """
+        if self.embeddings is not None:
+            return np.array([self.embeddings[self.chunk_position(int(i))][1] for i in chunk_ids], dtype="float32")
+        self._make_reconstructable()
+        return self.index.reconstruct_batch(np.asarray(chunk_ids, dtype="int64"))
+
+    def _normalized_vectors(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Return the normalized vectors of the given chunks, one row each.
+        """
+        return normalize(self.get_chunk_vectors(ids))
+
+    def _make_reconstructable(self) -> None:
+        # IVF indexes need a map from ids to list positions to reconstruct
+        # vectors; with ivfpq the reconstructed vectors are approximate
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            if self._positions is None:
+                ivf.make_direct_map()
+            else:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return
+
+    def chunk_position(self, chunk_id: int) -> int:
+        """
+        Return where the chunk with this id is in chunks (and the other per-chunk lists).
+        """
+        return chunk_id if self._positions is None else self._positions[chunk_id]
+
+    def _set_chunk_ids(self, chunk_ids: list) -> None:
+        # ids default to positions; the id -> position map is only kept once they differ
+        self.chunk_ids = list(range(len(self.chunks))) if chunk_ids is None else list(chunk_ids)
+        if self.chunk_ids == list(range(len(self.chunk_ids))):
+            self._positions = None
+        else:
+            self._positions = {chunk_id: position for position, chunk_id in enumerate(self.chunk_ids)}
+        return
+
+    def _refilled(self, index: faiss.Index, vectors: np.ndarray, chunk_ids: list) -> faiss.Index:
+        """
+        Return an empty copy of the index (keeping its training and parameters) filled with the given normalized
+        vectors under the given chunk ids. IVF indexes store the ids themselves; others are wrapped in an IndexIDMap2.
+        """
+        refilled = faiss.clone_index(index)
+        refilled.reset()
+        ivf = faiss.try_extract_index_ivf(refilled)
+        if ivf is not None:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif not isinstance(refilled, faiss.IndexIDMap2):
+            refilled = faiss.IndexIDMap2(refilled)
+        if len(chunk_ids) > 0:
+            refilled.add_with_ids(vectors, np.asarray(chunk_ids, dtype="int64"))
+        return refilled
+
+    def _editable_index(self) -> None:
         """
-        Replace embeddings list with a new one.
-        Does not automatically rebuild FAISS index.
+        Prepare the index for edits by chunk id: copy a memory-mapped index into memory, and move a flat or hnsw
+        index into an IndexIDMap2 the first time.
+        """
+        if self.index is None or self.chunks is None:
+            raise RuntimeError("FAISS index has not been initialized or there is no associated text.")
+        if self.mmap:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.mmap = False
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif not isinstance(self.index, faiss.IndexIDMap2):
+            self.index = self._refilled(self.index, normalize(self.get_vectors()), self.chunk_ids)
+        return
+
+    def _update_index(self, removed: list, vectors: np.ndarray = None, added: list = None) -> None:
+        """
+        Remove the vectors of some chunk ids from the index, then add vectors under others. HNSW graphs can't drop
+        vectors, so with removals they are rebuilt from the vectors they keep.
+        """
+        inner = self.index.index if isinstance(self.index, faiss.IndexIDMap2) else self.index
+        if removed and isinstance(faiss.downcast_index(inner), faiss.IndexHNSW):
+            dropped = set(removed)
+            kept = [i for i in self.chunk_ids if i not in dropped]
+            kept_vectors = self.index.reconstruct_batch(np.asarray(kept, dtype="int64"))
+            if added:
+                kept, kept_vectors = kept + list(added), np.vstack([kept_vectors, vectors])
+            self.index = self._refilled(self.index, kept_vectors, kept)
+            return
+        if removed:
+            self.index.remove_ids(np.asarray(removed, dtype="int64"))
+        if added:
+            self.index.add_with_ids(vectors, np.asarray(added, dtype="int64"))
+        return
+
+    def add_chunks(self, embeddings: list, token_counts: list = None, sources: list = None) -> list:
+        """
+        Add chunks to the index under new ids, without rebuilding it.
+        :param embeddings: list of [chunk, vector] pairs
+        :param token_counts: tokens in each new chunk, if known
+        :param sources: (first, last) source of each new chunk, if known
+        :return: the ids given to the new chunks, in order
+        """
+        if len(embeddings) == 0:
+            return []
+        vectors = normalize([e[1] for e in embeddings])
+        if vectors.shape[1] != self.index.d:
+            raise ValueError(f"Vectors have {vectors.shape[1]} dimensions, the index of context {self.name} has {self.index.d}")
+
+        self._editable_index()
+        first_id = max(self.chunk_ids, default=-1) + 1
+        ids = list(range(first_id, first_id + len(embeddings)))
+        self._update_index([], vectors, ids)
+
+        n_existing = len(self.chunks)
+        self.chunks = self.chunks + [e[0] for e in embeddings]
+        if self.embeddings is not None:
+            self.embeddings = self.embeddings + [list(e) for e in embeddings]
+        self.token_counts = _extended(self.token_counts, token_counts, n_existing, len(embeddings))
+        self.sources = _extended(self.sources, sources, n_existing, len(embeddings))
+        self._set_chunk_ids(self.chunk_ids + ids)
+        return ids
+
+    def remove_chunks(self, chunk_ids: list) -> None:
+        """
+        Remove chunks by id from the index, without rebuilding it (except for hnsw, see the class docstring).
+        The remaining chunks keep their ids.
+        """
+        removed = set(self.check_chunk_ids(chunk_ids))
+        if len(removed) == len(self.chunks):
+            raise ValueError(f"Removing every chunk would leave context {self.name} empty; delete the context instead")
+        if not removed:
+            return
+
+        self._editable_index()
+        self._update_index(list(removed))
+
+        kept = [position for position, chunk_id in enumerate(self.chunk_ids) if chunk_id not in removed]
+        self.chunks = [self.chunks[p] for p in kept]
+        if self.embeddings is not None:
+            self.embeddings = [self.embeddings[p] for p in kept]
+        if self.token_counts is not None:
+            self.token_counts = [self.token_counts[p] for p in kept]
+        if self.sources is not None:
+            self.sources = [self.sources[p] for p in kept]
+        self._set_chunk_ids([self.chunk_ids[p] for p in kept])
+        return
+
+    def replace_chunks(self, chunk_ids: list, embeddings: list, token_counts: list = None, sources: list = None) -> None:
+        """
+        Replace the text and vector of chunks by id; they keep their ids and positions.
+        :param embeddings: list of [chunk, vector] pairs, one per id
+        """
+        chunk_ids = self.check_chunk_ids(chunk_ids)
+        if len(chunk_ids) != len(embeddings):
+            raise ValueError(f"{len(chunk_ids)} chunk ids were given for {len(embeddings)} replacement chunks")
+        if len(set(chunk_ids)) != len(chunk_ids):
+            raise ValueError("Each chunk can only be replaced once at a time")
+        if not chunk_ids:
+            return
+
+        self._editable_index()
+        self._update_index(chunk_ids, normalize([e[1] for e in embeddings]), chunk_ids)
+
+        #copy rather than edit lists the caller may still hold
+        self.chunks = list(self.chunks)
+        if self.embeddings is not None:
+            self.embeddings = list(self.embeddings)
+        if self.token_counts is not None or token_counts is not None:
+            self.token_counts = list(self.token_counts or [None] * len(self.chunks))
+        if self.sources is not None or sources is not None:
+            self.sources = list(self.sources or [None] * len(self.chunks))
+        for i, (chunk_id, embedding) in enumerate(zip(chunk_ids, embeddings)):
+            position = self.chunk_position(chunk_id)
+            self.chunks[position] = embedding[0]
+            if self.embeddings is not None:
+                self.embeddings[position] = list(embedding)
+            if self.token_counts is not None:
+                self.token_counts[position] = None if token_counts is None else token_counts[i]
+            if self.sources is not None:
+                self.sources[position] = None if sources is None else sources[i]
+        return
+
+    def set_chunk_sources(self, sources: dict) -> None:
+        """
+        Update where chunks came from, e.g. after pages were inserted before them, without touching the index.
+        :param sources: chunk id -> (first, last) source
+        """
+        self.check_chunk_ids(list(sources))
+        self.sources = list(self.sources or [None] * len(self.chunks))
+        for chunk_id, source in sources.items():
+            self.sources[self.chunk_position(chunk_id)] = source
+        return
+
+    def check_chunk_ids(self, chunk_ids: list) -> list:
+        """
+        Return the ids as ints, raising ValueError if any of them isn't a chunk of this context.
+        """
+        chunk_ids = [int(i) for i in chunk_ids]
+        known = set(self.chunk_ids)
+        unknown = [i for i in chunk_ids if i not in known]
+        if unknown:
+            raise ValueError(f"Context {self.name} has no chunks with ids {unknown}")
+        return chunk_ids
+
+    def set_chunks(self, chunks: list, token_counts: list = None, sources: list = None, chunk_ids: list = None) -> None:
+        """
+        Replace the chunk texts without keeping their vectors in memory.
+        Used with a memory-mapped index, which already holds the vectors.
+        """
+        self.chunks = chunks
+        self.embeddings = None
+        self.token_counts = token_counts
+        self.sources = sources
+        self._set_chunk_ids(chunk_ids)
+        return
+
+    def set_embeddings(self, embeddings: list, token_counts: list = None, sources: list = None, chunk_ids: list = None) -> None:
+        """
+        Replace embeddings list with a new one, and the chunks' token counts,
+        sources and ids if known. Does not automatically rebuild FAISS index.
         """
         if len(embeddings) > 0:
             self.embeddings = embeddings
+            self.chunks = [e[0] for e in embeddings]
+            self.token_counts = token_counts
+            self.sources = sources
+            self._set_chunk_ids(chunk_ids)
         else:
             raise ValueError("Embeddings cannot be empty list.")
         return
@@ -126,7 +476,7 @@ class Context:
             return False
 
         # Run a test query with a random vector and compare results
-        query_vector = np.random.rand(1, len(self.embeddings[0][1]))[0]
+        query_vector = np.random.rand(1, self.index.d)[0]
         if self.query_similar(query_vector) != other.query_similar(query_vector):
             return False
 
@@ -139,8 +489,13 @@ class Context:
         """
         outstring = f'''Context name: {self.name}\n
         Associated doc name: {self.associated_doc_name}\n
-        No. Embeddings: {len(self.embeddings)}\n'''
+        No. Embeddings: {len(self.chunks)}\n'''
         return outstring
 
 
-
+def _extended(values: list, new_values: list, n_existing: int, n_new: int) -> list:
+    # per-chunk metadata such as token counts may be unknown (None) for the existing chunks, the new ones or both
+    if values is None and new_values is None:
+        return None
+    return (list(values) if values is not None else [None] * n_existing) + \
+           (list(new_values) if new_values is not None else [None] * n_new)
@@ -1,88 +1,102 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from src.service.context import Context
+from src.service.chunking import chunk_token_stream
+from src.service.embedding import embed_chunks, embed_chunk_stream, QueryEmbeddingCache, MAX_BATCH_INPUTS
+from src.service.merged_index import MergedIndex
+from src.service.prompt import pack_hits
+from src.service.chat_history import ChatHistory
+from src.service.answer_cache import SemanticAnswerCache
 import tiktoken
-from docx import Document
-from pypdf import PdfReader
+from src.service.extraction import iter_docx_paragraphs, iter_pdf_pages
 import numpy as np
-import copy
 from pathlib import Path
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 class CustomGPT(OpenAI):
 
-    def __init__(self, name: str, model: str, context_embedding_model : str, initial_role : str, initial_context : str, **kwargs):
+    def __init__(self, name: str, model: str, context_embedding_model : str, initial_role : str, initial_context : str,
+                 embedding_batch_size : int = 256, embedding_concurrency : int = 4,
+                 query_cache_size : int = 1024, query_cache_ttl : float = 3600.0, embedding_cache=None,
+                 merged_index : bool = False, index_spec : str = "flat", metric : str = "l2",
+                 context_token_budget : int = None, history_max_tokens : int = None, summarize_history : bool = False,
+                 answer_cache_size : int = 0, answer_cache_threshold : float = 0.95, answer_cache_ttl : float = 3600.0,
+                 **kwargs):
         super().__init__(**kwargs)
+        #optional semantic cache of first-turn answers, cleared whenever the contexts or instructions change
+        self.answer_cache = SemanticAnswerCache(answer_cache_threshold, answer_cache_ttl, answer_cache_size) if answer_cache_size > 0 else None
         self.name = name
         self.context_embedding_model = context_embedding_model.lower()
         self.contexts={}
-        self.chat_history=[{"role":"system","content":initial_role}]
         self.initial_role=initial_role
         self.initial_context=initial_context
         self.model = model
+        self.embedding_batch_size = embedding_batch_size    # chunks sent per embeddings request during ingestion
+        self.embedding_concurrency = embedding_concurrency  # embeddings requests in flight at once during ingestion
+        self.query_embedding_cache = QueryEmbeddingCache(query_cache_size, query_cache_ttl)  # recent query vectors
+        self.embedding_cache = embedding_cache              # optional persistent chunk embedding cache used during ingestion
+        self.merged_index = MergedIndex() if merged_index else None  # optional single index over all contexts, searched for a global top-k
+        self.index_spec = index_spec                        # FAISS index type for contexts built by add_context_from_*, see index_spec.py
+        self.metric = metric                                # similarity metric ("l2" or "cosine") for contexts built by add_context_from_*
+        self.context_token_budget = context_token_budget    # most tokens of retrieved chunks put in a prompt, None for no limit
+        self.history_max_tokens = history_max_tokens        # most tokens kept in a chat history, None for no limit
+        self.summarize_history = summarize_history          # summarize turns that fall out of the history window instead of dropping them
+        #conversation so far, used by query() unless it is given another history (e.g. one per user session)
+        self.chat_history = self.new_chat_history()
+        self._async_client = None                           # (event loop, AsyncOpenAI) used by aquery and aquery_stream
+        self.generation = None                              # database generation this GPT was read at, None if it wasn't read from one
 
-    def add_context_from_docx(self, context_name : str, doc_name : str, chunk_size : int = 500) -> Context:
-
-        #break document into chunks of text to be used in embedding
-        doc = Document(doc_name)
-        text = "\n".join(p.text for p in doc.paragraphs if p.text.strip())
-        words = text.split()
-        chunks=[]
-        chunk=[]
-        embedding=tiktoken.encoding_for_model(self.model)
-        for word in words:
-            chunk.append(word)
-            if len(embedding.encode(" ".join(chunk))) > chunk_size:
-                chunks.append(" ".join(chunk[:-1]))
-                chunk = [word]
-        if chunk:
-            chunks.append(" ".join(chunk))
-
-        #embed chunks using specified embedding model
-        embeddings=[]
-        for chunk in chunks:
-            embedding=np.array(super().embeddings.create(input=chunk,model=self.context_embedding_model).data[0].embedding,dtype="float32")
-            embeddings.append([chunk,embedding])
+    def add_context_from_docx(self, context_name : str, doc_name : str, chunk_size : int = 500, chunk_overlap : int = 0, boundary : str = "word") -> Context:
 
-        #create context object with embedding
-        context = Context(context_name,doc_name,embeddings,self.context_embedding_model)
-        self.contexts[context_name] = context
-
-        return context
+        #chunk the document paragraph by paragraph, recording the paragraphs each chunk came from
+        return self.add_context_from_blocks(context_name, doc_name, iter_docx_paragraphs(doc_name), chunk_size, chunk_overlap, boundary)
 
-    def add_context_from_pdf(self, context_name : str, doc_name : str, chunk_size : int = 500) -> Context:
+    def add_context_from_pdf(self, context_name : str, doc_name : str, chunk_size : int = 500, chunk_overlap : int = 0, boundary : str = "word") -> Context:
 
-        #break document into chunks of text
+        #chunk the document page by page, recording the pages each chunk came from
         pdf_path=Path(__file__).parent.parent.parent / "documents" / doc_name
-        pdf_reader = PdfReader(pdf_path)
-        text = " ".join(page.extract_text() for page in pdf_reader.pages)
-        words = text.split()
-
-        chunks=[]
-        chunk=[]
-        embedding=tiktoken.encoding_for_model(self.model)
-        for word in words:
-            chunk.append(word)
-            if len(embedding.encode(" ".join(chunk))) > chunk_size:
-                chunks.append(" ".join(chunk[:-1]))
-                chunk = [word]
-        if chunk:
-            chunks.append(" ".join(chunk))
-
-        #embed chunks using specified embedding model
-
-        embeddings=[]
-        for chunk in chunks:
-            embedding=np.array(super().embeddings.create(input=chunk,model=self.context_embedding_model).data[0].embedding,dtype="float32")
-            embeddings.append([chunk,embedding])
+        return self.add_context_from_blocks(context_name, doc_name, iter_pdf_pages(pdf_path), chunk_size, chunk_overlap, boundary)
+
+    def add_context_from_text(self, context_name : str, doc_name : str, text : str, chunk_size : int = 500, chunk_overlap : int = 0, boundary : str = "word") -> Context:
+
+        return self.add_context_from_blocks(context_name, doc_name, [(None, text)], chunk_size, chunk_overlap, boundary)
+
+    def add_context_from_blocks(self, context_name : str, doc_name : str, blocks, chunk_size : int = 500, chunk_overlap : int = 0, boundary : str = "word") -> Context:
+        """
+        Build a context from a document read as a stream of (source, text) blocks, such as the pages from
+        extraction.iter_pdf_pages. Blocks are chunked and chunks embedded as they arrive, so only a window of the
+        document's text is held at a time; each chunk records the first and last source it was cut from.
+        """
+        #chunk blocks into a token stream, embedding chunks in batches as they come out
+        spans = chunk_token_stream(blocks, tiktoken.encoding_for_model(self.model), chunk_size, chunk_overlap, boundary)
+        embeddings, token_counts, sources = [], [], []
+        for (chunk, n_tokens, source), vector in embed_chunk_stream(self, spans, self.context_embedding_model,
+                                                                    max_inputs=self.embedding_batch_size,
+                                                                    max_concurrency=self.embedding_concurrency,
+                                                                    cache=self.embedding_cache):
+            embeddings.append([chunk, vector])
+            token_counts.append(n_tokens)
+            sources.append(None if source[0] is None else source)
 
         #create context object with embedding
-        context = Context(context_name,doc_name,embeddings,self.context_embedding_model)
+        context = Context(context_name,doc_name,embeddings,self.context_embedding_model,self.index_spec,self.metric,
+                          token_counts=token_counts, sources=sources)
         self.contexts[context_name] = context
+        self.invalidate_answer_cache()
+        if self.merged_index is not None:
+            if context_name in self.merged_index.contexts:
+                self.merged_index.remove_context(context_name)
+            self.merged_index.add_context(context_name, context)
 
         return context
 
     def add_context(self, context : Context):
         if (context.name not in self.contexts):
             self.contexts[context.name] = context
+            self.invalidate_answer_cache()
+            if self.merged_index is not None:
+                self.merged_index.add_context(context.name, context)
         else:
             raise ValueError(f"context {context.name} already exists within this custom GPT")
         return
@@ -90,43 +104,411 @@ class CustomGPT(OpenAI):
     def remove_context(self, name : str):
         if (name in self.contexts):
             del self.contexts[name]
+            self.invalidate_answer_cache()
+            if self.merged_index is not None:
+                self.merged_index.remove_context(name)
         else:
             raise ValueError(f"context {name} does not exist within this custom GPT")
         return
 
+    def update_context(self, name : str, add : list = (), remove : list = (), replace : dict = None, vectors : dict = None) -> list:
+        """
+        Edit a context's chunks in place by stable chunk id, embedding only the new texts. Write the same edit to
+        the database with context_db_connection.update_context_chunks(context, added, remove, list(replace), vectors=vectors).
+        Every id is checked before anything is embedded or changed, so an invalid edit leaves the context as it was.
+        :param add: texts of chunks to add
+        :param remove: ids of chunks to remove
+        :param replace: chunk id -> new text
+        :param vectors: optional dict filled with chunk id -> embedding of every added and replaced chunk, so they
+                        are stored as embedded rather than read back from the index
+        :return: ids of the added chunks
+        """
+        if name not in self.contexts:
+            raise ValueError(f"context {name} does not exist within this custom GPT")
+        context = self.contexts[name]
+        remove = context.check_chunk_ids(remove)
+        replace = dict(zip(context.check_chunk_ids(list(replace or {})), (replace or {}).values()))
+        duplicates = sorted(chunk_id for chunk_id, count in Counter(remove).items() if count > 1)
+        if duplicates:
+            raise ValueError(f"Chunks {duplicates} of context {name} are removed more than once")
+        both = sorted(set(remove) & set(replace))
+        if both:
+            raise ValueError(f"Chunks {both} of context {name} can't be both replaced and removed")
+        if not add and len(remove) == len(context.chunk_ids):
+            raise ValueError(f"Removing every chunk of context {name} would leave it empty")
+
+        #embed the new texts in one pass, counting their tokens for batching and prompt packing
+        texts = list(add) + list(replace.values())
+        token_counts = [self.count_tokens(text) for text in texts]
+        embeddings = embed_chunks(self, texts, self.context_embedding_model, token_counts=token_counts,
+                                  max_inputs=self.embedding_batch_size,
+                                  max_concurrency=self.embedding_concurrency,
+                                  cache=self.embedding_cache)
+
+        #add first, so a context can have all its chunks swapped for new ones
+        added = context.add_chunks(embeddings[:len(add)], token_counts[:len(add)])
+        context.replace_chunks(list(replace), embeddings[len(add):], token_counts[len(add):])
+        context.remove_chunks(remove)
+        if vectors is not None:
+            vectors.update(zip(added + list(replace), (vector for _, vector in embeddings)))
+
+        self.invalidate_answer_cache()
+        if self.merged_index is not None:
+            #chunk positions shifted, so the context's vectors are mapped again
+            self.merged_index.remove_context(name)
+            self.merged_index.add_context(name, context)
+
+        return added
+
     def clear_contexts(self):
         self.contexts={}
+        self.invalidate_answer_cache()
+        if self.merged_index is not None:
+            self.merged_index.clear()
+        return
+
+    @property
+    def initial_role(self) -> str:
+        return self._initial_role
+
+    @initial_role.setter
+    def initial_role(self, initial_role : str):
+        self._initial_role = initial_role
+        self.invalidate_answer_cache()
+
+    @property
+    def initial_context(self) -> str:
+        return self._initial_context
+
+    @initial_context.setter
+    def initial_context(self, initial_context : str):
+        self._initial_context = initial_context
+        self.invalidate_answer_cache()
+
+    def invalidate_answer_cache(self) -> None:
+        if self.answer_cache is not None:
+            self.answer_cache.clear()
+        return
+
+    def _cached_answer(self, query : str, query_vector : np.ndarray, settings : tuple, chat_history : ChatHistory) -> str:
+        """
+        Look up the answer cache for the first turn of a conversation. A cached answer is added to the chat history
+        as if it had just been generated.
+        :return: the cached answer, or None to generate one
+        """
+        if self.answer_cache is None or query_vector is None or len(chat_history) != 1:
+            return None
+        answer = self.answer_cache.get(query_vector, settings)
+        if answer is not None:
+            chat_history.append("user", query)
+            chat_history.append("assistant", answer)
+        return answer
+
+    def _answer_cache_generation(self) -> int:
+        #read before retrieval, so an answer generated from contexts that changed meanwhile isn't cached
+        return None if self.answer_cache is None else self.answer_cache.generation
+
+    def _cache_answer(self, query_vector : np.ndarray, settings : tuple, first_turn : bool, answer : str, generation : int) -> None:
+        if self.answer_cache is not None and query_vector is not None and first_turn:
+            self.answer_cache.put(query_vector, settings, answer, generation)
+        return
+
+    def new_chat_history(self) -> ChatHistory:
+        """
+        Start an empty conversation with this GPT's system prompt and history settings.
+        """
+        return ChatHistory(self.initial_role, self.history_max_tokens, self.count_tokens,
+                           self.summarize_turns if self.summarize_history else None)
+
+    def bind_chat_history(self, chat_history : ChatHistory) -> None:
+        """
+        Count and summarize a conversation started with another instance of this GPT using this one.
+        """
+        chat_history.bind(self.count_tokens, self.summarize_turns if self.summarize_history else None)
         return
 
     def clear_chat_history(self):
-        self.chat_history=[self.chat_history[0]]
+        self.chat_history.clear()
         return
 
-    def query(self, query : str, retrieve_relevant_context=True):
+    def summarize_turns(self, summary : str, messages : list) -> str:
+        """
+        Fold chat turns dropped from the history window into the running summary of the conversation.
+        """
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        previous = f"Summary so far:\n{summary}\n" if summary else ""
+        response = super().chat.completions.create(model=self.model, messages=[
+            {"role":"system","content":"Summarize the conversation below in a few sentences, keeping facts, names and numbers the user may refer back to."},
+            {"role":"user","content":f"{previous}Conversation:\n{transcript}"}])
+        return "Summary of the earlier conversation: "+response.choices[0].message.content
+
+    def embed_query(self, query : str) -> np.ndarray:
+        """
+        Embed a query with the context embedding model, reusing the cached vector for recently seen queries.
+        """
+        return self.query_embedding_cache.get_or_embed(self, self.context_embedding_model, query)
+
+    def embed_queries(self, queries : list) -> list:
+        """
+        Embed many queries with as few embeddings requests as possible: cached and repeated queries aren't sent, and
+        the rest go in batches of up to the API's input limit.
+        """
+        vectors = [self.query_embedding_cache.get(self.context_embedding_model, query) for query in queries]
+        missing = list(dict.fromkeys(query for query, vector in zip(queries, vectors) if vector is None))
+        #a query has at most as many tokens as UTF-8 bytes, so this keeps batches within the token limit without tokenizing
+        embedded = dict(embed_chunks(self, missing, self.context_embedding_model,
+                                     token_counts=[len(query.encode("utf-8")) for query in missing],
+                                     max_inputs=MAX_BATCH_INPUTS, max_concurrency=self.embedding_concurrency))
+        for query, vector in embedded.items():
+            self.query_embedding_cache.put(self.context_embedding_model, query, vector)
+        return [embedded[query] if vector is None else vector for query, vector in zip(queries, vectors)]
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """
+        AsyncOpenAI client with this GPT's key and endpoint. Its connections belong to the event loop it was made
+        on, so a new one is made when called from another loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client[0] is not loop:
+            self._async_client = (loop, AsyncOpenAI(api_key=self.api_key, organization=self.organization, project=self.project,
+                                                    base_url=self.base_url, timeout=self.timeout, max_retries=self.max_retries))
+        return self._async_client[1]
+
+    async def aembed_query(self, query : str) -> np.ndarray:
+        """
+        embed_query without blocking the event loop.
+        """
+        return await self.query_embedding_cache.aget_or_embed(self.async_client, self.context_embedding_model, query)
+
+    def count_tokens(self, text : str) -> int:
+        return len(tiktoken.encoding_for_model(self.model).encode(text))
+
+    def _prepare_query(self, query : str, retrieve_relevant_context : bool, k : int, score_threshold : float,
+                       mmr_diversity : float, token_budget : int, chat_history : ChatHistory, query_vector : np.ndarray = None,
+                       hits : list = None, context_usage : dict = None) -> tuple:
+        """
+        Retrieve context for a query, record the query in the chat history and build the messages to send.
+        :param query_vector: embedding of the query if the caller already has it
+        :param hits: chunks retrieved for the query if the caller already searched
+        :param context_usage: dict to fill with the tokens and chunks used and dropped, see prompt.pack_hits
+        :return: (messages, chat history the answer should be appended to)
+        """
+        if chat_history is None:
+            chat_history = self.chat_history
         if retrieve_relevant_context:
             context_text=""
-            chunk_idx=0
-            for context in self.contexts:
-                context_text+=f"Chunk {chunk_idx} from FAISS: "+self.contexts[context].query_similar(super().embeddings.create(input=query,model=self.context_embedding_model).data[0].embedding)+"\n"
-                chunk_idx+=1
+            if hits is None:
+                if query_vector is None:
+                    query_vector=self.embed_query(query)
+                hits = self._search(query_vector, k, score_threshold, mmr_diversity)[0]
+
+            #fill the budget with the best chunks across all contexts
+            hits, usage = pack_hits(hits, self.context_token_budget if token_budget is None else token_budget, self.count_tokens)
+            if context_usage is not None:
+                context_usage.update(usage)
+            for chunk_idx, hit in enumerate(hits):
+                context_text+=f"Chunk {chunk_idx} from {hit.context}: "+hit.text+"\n"
             query_content = f"Using this initial context:{self.initial_context}\nAnd the following additional context:{context_text}\n Answer the following:{query}"
 
             #append chat history; distinction must be made between the context fed into the model and what we append to our chat history. Don't want to feed every bit of context in every time because we'll hit the token limit
-            print(len(self.chat_history))
-            if len(self.chat_history) > 0:
-                chat_history_for_query : list = copy.deepcopy(self.chat_history) + [{"role":"user","content":query_content}]
-            else:
-                chat_history_for_query = [{"role":"user","content":query_content}]
-            self.chat_history.append({"role": "user", "content": query})
-            response = super().chat.completions.create(model=self.model, messages=chat_history_for_query)
+            reserve_tokens = 0 if chat_history.max_tokens is None else self.count_tokens(query_content)
+            chat_history_for_query = chat_history.messages(extra=[{"role":"user","content":query_content}], reserve_tokens=reserve_tokens)
+            chat_history.append("user", query)
+            return chat_history_for_query, chat_history
         else:
-            self.chat_history.append({"role":"user","content":self.initial_context+"\n"+query})
-            response = super().chat.completions.create(model=self.model, messages=self.chat_history)
+            chat_history.append("user", self.initial_context+"\n"+query)
+            return chat_history.messages(), chat_history
+
+    def _search(self, query_vectors : np.ndarray, k : int, score_threshold : float, mmr_diversity : float) -> list:
+        """
+        Search every context for each query, with one FAISS search per context however many queries there are.
+        :param query_vectors: one query vector per row, or a single vector
+        :return: one list of Hits per query
+        """
+        if self.merged_index is not None:
+            #one search over every context, keeping the k closest chunks overall
+            return self.merged_index.search_batch(query_vectors, k, score_threshold, mmr_diversity)
+        hits = [[] for _ in range(len(np.atleast_2d(query_vectors)))]
+        for context in self.contexts:
+            for query_hits, context_hits in zip(hits, self.contexts[context].search_batch(query_vectors, k, score_threshold, mmr_diversity)):
+                query_hits += context_hits
+        return hits
+
+    def query(self, query : str, retrieve_relevant_context=True, k : int = 10,
+              score_threshold : float = None, mmr_diversity : float = None, token_budget : int = None,
+              chat_history : ChatHistory = None, context_usage : dict = None):
+        """
+        Answer a query, adding the chunks most similar to it to the prompt.
+        :param k: chunks retrieved per context, or overall with a merged index
+        :param score_threshold: leave out chunks whose cosine similarity to the query is below this
+        :param mmr_diversity: re-rank retrieved chunks with maximal marginal relevance to drop near-duplicates
+        :param token_budget: most tokens of retrieved chunks to include, highest scoring first; defaults to
+                             context_token_budget.
+        :param chat_history: conversation to continue, defaults to self.chat_history. Sessions sharing one GPT
+                             (and its contexts) each pass their own.
+        :param context_usage: optional dict filled with the tokens and chunks of context used and dropped by this
+                              query's prompt (see prompt.pack_hits); left empty for a cached answer
+        With an answer cache, the first question of a conversation that is close enough to one answered before gets
+        that answer back without retrieval or a completion.
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        generation = self._answer_cache_generation()
+        query_vector = self.embed_query(query) if retrieve_relevant_context else None
+        settings = (k, score_threshold, mmr_diversity, token_budget)
+        answer = self._cached_answer(query, query_vector, settings, chat_history)
+        if answer is not None:
+            return answer
 
-        self.chat_history.append({"role":response.choices[0].message.role, "content":response.choices[0].message.content})
+        first_turn = len(chat_history) == 1
+        messages, chat_history = self._prepare_query(query, retrieve_relevant_context, k, score_threshold, mmr_diversity, token_budget, chat_history, query_vector,
+                                                     context_usage=context_usage)
+        response = super().chat.completions.create(model=self.model, messages=messages)
+
+        chat_history.append(response.choices[0].message.role, response.choices[0].message.content)
+        self._cache_answer(query_vector, settings, first_turn, response.choices[0].message.content, generation)
 
         return response.choices[0].message.content
 
+    def query_stream(self, query : str, retrieve_relevant_context=True, k : int = 10,
+                     score_threshold : float = None, mmr_diversity : float = None, token_budget : int = None,
+                     chat_history : ChatHistory = None, context_usage : dict = None):
+        """
+        Answer a query like query(), yielding the answer in pieces as the completion streams in. The full answer is
+        added to the chat history once the stream ends; if the caller stops early (e.g. the client disconnected)
+        the part already yielded is added instead. A cached answer is yielded in one piece.
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        generation = self._answer_cache_generation()
+        query_vector = self.embed_query(query) if retrieve_relevant_context else None
+        settings = (k, score_threshold, mmr_diversity, token_budget)
+        answer = self._cached_answer(query, query_vector, settings, chat_history)
+        if answer is not None:
+            yield answer
+            return
+
+        first_turn = len(chat_history) == 1
+        messages, chat_history = self._prepare_query(query, retrieve_relevant_context, k, score_threshold, mmr_diversity, token_budget, chat_history, query_vector,
+                                                     context_usage=context_usage)
+        stream = super().chat.completions.create(model=self.model, messages=messages, stream=True)
+
+        parts = []
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            #only complete answers are cached
+            self._cache_answer(query_vector, settings, first_turn, "".join(parts), generation)
+        finally:
+            stream.close()
+            chat_history.append("assistant", "".join(parts))
+
+    async def aquery(self, query : str, retrieve_relevant_context=True, k : int = 10,
+                     score_threshold : float = None, mmr_diversity : float = None, token_budget : int = None,
+                     chat_history : ChatHistory = None, context_usage : dict = None):
+        """
+        Answer a query like query() without blocking the event loop, so one process can serve many conversations
+        at once: the embeddings and chat requests go through the async client, and the index search and prompt
+        assembly, which are CPU bound, run in the loop's default thread executor. So do additions to the chat
+        history, since trimming it may summarize dropped turns with a blocking completion.
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        generation = self._answer_cache_generation()
+        query_vector = await self.aembed_query(query) if retrieve_relevant_context else None
+        settings = (k, score_threshold, mmr_diversity, token_budget)
+        answer = await asyncio.to_thread(self._cached_answer, query, query_vector, settings, chat_history)
+        if answer is not None:
+            return answer
+
+        first_turn = len(chat_history) == 1
+        messages, chat_history = await asyncio.to_thread(self._prepare_query, query, retrieve_relevant_context, k, score_threshold,
+                                                         mmr_diversity, token_budget, chat_history, query_vector,
+                                                         context_usage=context_usage)
+        response = await self.async_client.chat.completions.create(model=self.model, messages=messages)
+
+        await asyncio.to_thread(chat_history.append, response.choices[0].message.role, response.choices[0].message.content)
+        self._cache_answer(query_vector, settings, first_turn, response.choices[0].message.content, generation)
+
+        return response.choices[0].message.content
+
+    async def aquery_stream(self, query : str, retrieve_relevant_context=True, k : int = 10,
+                            score_threshold : float = None, mmr_diversity : float = None, token_budget : int = None,
+                            chat_history : ChatHistory = None, context_usage : dict = None):
+        """
+        Async generator version of query_stream(), run like aquery().
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        generation = self._answer_cache_generation()
+        query_vector = await self.aembed_query(query) if retrieve_relevant_context else None
+        settings = (k, score_threshold, mmr_diversity, token_budget)
+        answer = await asyncio.to_thread(self._cached_answer, query, query_vector, settings, chat_history)
+        if answer is not None:
+            yield answer
+            return
+
+        first_turn = len(chat_history) == 1
+        messages, chat_history = await asyncio.to_thread(self._prepare_query, query, retrieve_relevant_context, k, score_threshold,
+                                                         mmr_diversity, token_budget, chat_history, query_vector,
+                                                         context_usage=context_usage)
+        stream = await self.async_client.chat.completions.create(model=self.model, messages=messages, stream=True)
+
+        parts = []
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            self._cache_answer(query_vector, settings, first_turn, "".join(parts), generation)
+        finally:
+            await asyncio.to_thread(chat_history.append, "assistant", "".join(parts))
+            await stream.close()
+
+    def query_batch(self, queries : list, k : int = 10, score_threshold : float = None, mmr_diversity : float = None,
+                    token_budget : int = None, max_concurrency : int = 8):
+        """
+        Answer many independent questions, each as the first turn of its own conversation, e.g. for an evaluation run.
+        All questions are embedded together (see embed_queries) and each context is searched once for all of them;
+        then up to max_concurrency completions run at a time. Other options are as for query().
+        :return: generator of one dict per question, in input order as soon as each is ready: index, query and
+                 either answer, with the context_usage of its prompt unless it was cached, or error
+        """
+        generation = self._answer_cache_generation()
+        query_vectors = self.embed_queries(queries)
+        hits = self._search(np.vstack(query_vectors), k, score_threshold, mmr_diversity) if queries else []
+        settings = (k, score_threshold, mmr_diversity, token_budget)
+
+        def answer(i : int) -> dict:
+            try:
+                chat_history = self.new_chat_history()
+                cached = self._cached_answer(queries[i], query_vectors[i], settings, chat_history)
+                if cached is not None:
+                    return {"index": i, "query": queries[i], "answer": cached}
+                context_usage = {}
+                messages, _ = self._prepare_query(queries[i], True, k, score_threshold, mmr_diversity, token_budget,
+                                                  chat_history, query_vectors[i], hits[i], context_usage)
+                response = super(CustomGPT, self).chat.completions.create(model=self.model, messages=messages)
+                self._cache_answer(query_vectors[i], settings, True, response.choices[0].message.content, generation)
+                return {"index": i, "query": queries[i], "answer": response.choices[0].message.content,
+                        "context_usage": context_usage}
+            except Exception as e:
+                #one failed question doesn't stop the rest of the batch
+                return {"index": i, "query": queries[i], "error": str(e)}
+
+        #keep a bounded window of questions in flight, so stopping early doesn't leave the whole batch queued
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            pending = deque()
+            try:
+                for i in range(len(queries)):
+                    pending.append(executor.submit(answer, i))
+                    if len(pending) >= 2 * max_concurrency:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def attributes_as_dict(self):
         return {"name":self.name,
                 "model":self.model,}
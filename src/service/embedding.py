@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+import tiktoken
+
+# OpenAI embeddings endpoint limits: 2048 inputs and 300k tokens per request. The token budget is kept below the
+# hard limit because chunk token counts come from the chat model's encoding, which is close to but not always
+# the same as the embedding model's.
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 250_000
+
+# errors worth retrying; everything else (bad request, auth, ...) is raised immediately
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+def batch_ranges(token_counts: list, max_inputs: int = 256, max_tokens: int = MAX_BATCH_TOKENS) -> list:
+    """
+    Group consecutive chunks into batches that fit within the input and token limits of one embeddings request.
+    :param token_counts: token count of each chunk
+    :param max_inputs: maximum number of chunks per batch
+    :param max_tokens: maximum total tokens per batch
+    :return: list of (start, end) index ranges into the chunk list
+    """
+    ranges = []
+    start = 0
+    batch_tokens = 0
+    for i, n_tokens in enumerate(token_counts):
+        if i > start and (i - start >= max_inputs or batch_tokens + n_tokens > max_tokens):
+            ranges.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += n_tokens
+    if start < len(token_counts):
+        ranges.append((start, len(token_counts)))
+    return ranges
+
+
+def embed_batch(client: openai.OpenAI, batch: list, model: str, max_retries: int = 6, initial_backoff: float = 1.0) -> list:
+    """
+    Embed one batch of texts in a single request, retrying with exponential backoff and jitter on rate limits
+    and transient server errors. A retry-after header from the server takes precedence over the computed delay.
+    :return: list of float32 vectors in the same order as batch
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.embeddings.create(input=batch, model=model)
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise e
+            time.sleep(retry_delay(e, attempt, initial_backoff))
+
+    return response_vectors(response, len(batch))
+
+
+async def aembed_batch(client: openai.AsyncOpenAI, batch: list, model: str, max_retries: int = 6, initial_backoff: float = 1.0) -> list:
+    """
+    embed_batch for an async client: waits between retries without blocking the event loop.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = await client.embeddings.create(input=batch, model=model)
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise e
+            await asyncio.sleep(retry_delay(e, attempt, initial_backoff))
+
+    return response_vectors(response, len(batch))
+
+
+def retry_delay(error: Exception, attempt: int, initial_backoff: float) -> float:
+    delay = initial_backoff * 2 ** attempt * (0.5 + random.random())
+    retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            pass
+    return delay
+
+
+def response_vectors(response, n_inputs: int) -> list:
+    #results carry their input index, so don't rely on the response order
+    vectors = [None] * n_inputs
+    for item in response.data:
+        vectors[item.index] = np.array(item.embedding, dtype="float32")
+    return vectors
+
+
+def embed_chunks(client: openai.OpenAI, chunks: list, model: str, token_counts: list = None,
+                 max_inputs: int = 256, max_tokens: int = MAX_BATCH_TOKENS, max_concurrency: int = 4,
+                 max_retries: int = 6, initial_backoff: float = 1.0, cache=None) -> list:
+    """
+    Embed text chunks in batches, with up to max_concurrency batch requests in flight at once.
+    :param client: OpenAI client (or CustomGPT) used to call the embeddings endpoint
+    :param chunks: list of chunk texts
+    :param model: embedding model name
+    :param token_counts: token count of each chunk, e.g. from chunk_token_spans; counted with the model's encoding if None
+    :param max_inputs: maximum chunks per request, capped at the API limit
+    :param max_tokens: maximum total tokens per request
+    :param max_concurrency: maximum number of requests in flight
+    :param cache: optional persistent cache (see src.data.embedding_cache) checked before calling the API
+    :return: list of [chunk, vector] pairs in the same order as chunks, as expected by Context
+    """
+    if not chunks:
+        return []
+    if token_counts is None:
+        token_counts = [len(tokens) for tokens in tiktoken.encoding_for_model(model).encode_ordinary_batch(chunks)]
+
+    #only chunks missing from the cache go to the API; repeated chunks within the document are sent once
+    cached = cache.get_many(model, chunks) if cache is not None else {}
+    missing = {}
+    for chunk, n_tokens in zip(chunks, token_counts):
+        if chunk not in cached and chunk not in missing:
+            missing[chunk] = n_tokens
+    to_embed = list(missing)
+
+    ranges = batch_ranges(list(missing.values()), min(max_inputs, MAX_BATCH_INPUTS), max_tokens)
+    if ranges:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(ranges)))) as executor:
+            results = executor.map(lambda r: embed_batch(client, to_embed[r[0]:r[1]], model, max_retries, initial_backoff), ranges)
+            embedded = dict(zip(to_embed, (vector for batch in results for vector in batch)))
+        if cache is not None:
+            cache.put_many(model, list(embedded.items()))
+        cached.update(embedded)
+
+    return [[chunk, cached[chunk]] for chunk in chunks]
+
+
+def embed_chunk_stream(client: openai.OpenAI, spans, model: str, max_inputs: int = 256, max_concurrency: int = 4,
+                       **options):
+    """
+    Embed chunks as they arrive from a generator, e.g. chunking.chunk_token_stream, taking just enough chunks at a
+    time to fill max_concurrency requests of max_inputs chunks, so only those are held before being embedded.
+    :param spans: iterable of (chunk, token_count, ...) tuples; anything after the token count is passed through
+    :param options: further arguments for embed_chunks
+    :return: generator of (span, vector) pairs in the same order as spans
+    """
+    spans = iter(spans)
+    window = min(max_inputs, MAX_BATCH_INPUTS) * max(1, max_concurrency)
+    while True:
+        group = list(itertools.islice(spans, window))
+        if not group:
+            return
+        embeddings = embed_chunks(client, [span[0] for span in group], model, token_counts=[span[1] for span in group],
+                                  max_inputs=max_inputs, max_concurrency=max_concurrency, **options)
+        yield from zip(group, (vector for _, vector in embeddings))
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings keyed by (model, text), with entries expiring after ttl seconds.
+    Safe to share between threads; hit and miss counts are kept for monitoring.
+    """
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries  # least recently used entries are evicted beyond this
+        self.ttl = ttl                  # seconds an entry stays valid; None to never expire
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # (model, text) -> (expiry time, vector)
+        self._lock = threading.Lock()
+        return
+
+    def get(self, model: str, text: str) -> np.ndarray:
+        """
+        Return the cached vector for (model, text), or None if it is missing or expired.
+        """
+        key = (model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, model: str, text: str, vector: np.ndarray) -> None:
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[(model, text)] = (expiry, vector)
+            self._entries.move_to_end((model, text))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return
+
+    def get_or_embed(self, client: openai.OpenAI, model: str, text: str) -> np.ndarray:
+        """
+        Return the embedding of text, only calling the embeddings endpoint on a cache miss.
+        """
+        vector = self.get(model, text)
+        if vector is None:
+            vector = embed_batch(client, [text], model)[0]
+            self.put(model, text, vector)
+        return vector
+
+    async def aget_or_embed(self, client: openai.AsyncOpenAI, model: str, text: str) -> np.ndarray:
+        """
+        get_or_embed with an async client.
+        """
+        vector = self.get(model, text)
+        if vector is None:
+            vector = (await aembed_batch(client, [text], model))[0]
+            self.put(model, text, vector)
+        return vector
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        return
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_entries": self.max_entries}
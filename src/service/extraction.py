@@ -0,0 +1,58 @@
+"""
+Filename: extraction.py
+Description:
+    Text extraction from the document types contexts are built from. Documents are read as a stream of numbered
+    blocks (pages of a PDF, paragraphs of a .docx, lines of a .txt) so they can be chunked without holding the whole
+    text at once (see chunking.chunk_token_stream), and each chunk can record the blocks it came from. These are
+    module level functions so they can run in worker processes during bulk ingestion (see ingestion.py).
+"""
+from pathlib import Path
+
+from docx import Document
+from pypdf import PdfReader
+
+# file suffixes iter_document_blocks can read
+SUPPORTED_SUFFIXES = (".docx", ".pdf", ".txt")
+
+
+def iter_docx_paragraphs(path):
+    """
+    Yield (paragraph number, text) for each non-empty paragraph, numbered from 1 among all the document's paragraphs.
+    """
+    doc = Document(str(path))
+    for number, paragraph in enumerate(doc.paragraphs, 1):
+        if paragraph.text.strip():
+            yield number, paragraph.text
+
+
+def iter_pdf_pages(path):
+    """
+    Yield (page number, text) for each page, numbered from 1. Pages are read and extracted one at a time.
+    """
+    pdf_reader = PdfReader(path)
+    for number, page in enumerate(pdf_reader.pages, 1):
+        yield number, page.extract_text()
+
+
+def iter_text_lines(path):
+    """
+    Yield (line number, text) for each line of a UTF-8 text file, numbered from 1.
+    """
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            yield number, line.rstrip("\r\n")
+
+
+def iter_document_blocks(path):
+    """
+    Yield the (number, text) blocks of a .docx, .pdf or .txt file, chosen by its suffix.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".docx":
+        return iter_docx_paragraphs(path)
+    if suffix == ".pdf":
+        return iter_pdf_pages(path)
+    if suffix == ".txt":
+        return iter_text_lines(path)
+    raise ValueError(f"{path} is not a supported document type; expected one of {', '.join(SUPPORTED_SUFFIXES)}")
+
@@ -0,0 +1,105 @@
+"""
+Filename: index_spec.py
+Description:
+    Builds the FAISS index behind a Context from a short index spec, so large contexts can use an approximate
+    nearest neighbour index instead of an exact scan. A spec is an index type optionally followed by parameters,
+    e.g. "flat", "ivf", "hnsw:M=32,efSearch=128" or "ivfpq:nlist=1024,m=48,nprobe=32". Parameters left out are
+    chosen from the number of vectors, and indexes that need training are trained on the vectors they are built from.
+    Every index type can rank by L2 distance or, for cosine similarity, by inner product of normalized vectors.
+
+    flat   exact search, the cost of a query grows linearly with the number of chunks
+    ivf    inverted lists over k-means cells; searches the nprobe cells closest to the query
+    hnsw   graph index; no training, more memory per vector, efSearch trades speed for recall
+    ivfpq  ivf with vectors compressed by product quantization to m bytes each, for very large contexts
+"""
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+
+METRICS = {"l2": faiss.METRIC_L2, "cosine": faiss.METRIC_INNER_PRODUCT}
+
+# k-means wants at least this many training points per centroid (faiss warns below it)
+MIN_POINTS_PER_CENTROID = 39
+
+
+def parse_index_spec(spec: str) -> tuple:
+    """
+    Split a spec such as "ivf:nlist=256,nprobe=8" into its type and a dict of integer parameters.
+    """
+    index_type, _, params = spec.strip().lower().partition(":")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r} in index spec {spec!r}, expected one of {INDEX_TYPES}")
+    parsed = {}
+    for param in filter(None, params.split(",")):
+        name, _, value = param.partition("=")
+        try:
+            parsed[name.strip().lower()] = int(value)
+        except ValueError:
+            raise ValueError(f"Index spec parameter {param!r} in {spec!r} must be name=integer")
+    return index_type, parsed
+
+
+def default_nlist(n: int) -> int:
+    #about 4 * sqrt(n) cells, but never so many that k-means runs short of training points
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_CENTROID))
+
+
+def default_pq_m(d: int) -> int:
+    #m sub-quantizers of 8 bits each must divide the dimension; aim for about 8 dimensions per byte
+    for m in range(max(1, d // 8), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def metric_type(metric: str) -> int:
+    if metric not in METRICS:
+        raise ValueError(f"Unknown similarity metric {metric!r}, expected one of {list(METRICS)}")
+    return METRICS[metric]
+
+
+def normalize(vectors) -> np.ndarray:
+    """
+    Return the vectors as a contiguous float32 matrix scaled to unit length in one pass. Zero vectors stay zero.
+    Always copies, so the caller's vectors are left untouched.
+    """
+    vectors = np.array(vectors, dtype="float32", order="C", ndmin=2)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def build_index(vectors: np.ndarray, spec: str = "flat", metric: str = "l2") -> faiss.Index:
+    """
+    Create, train if needed, and fill an index for the given (normalized, float32) vectors.
+    An ivfpq spec on too few vectors to train 256 PQ centroids falls back to ivf.
+    :param metric: "l2" ranks by euclidean distance, "cosine" by inner product, which for unit vectors is the
+                   cosine similarity (higher is closer)
+    """
+    index_type, params = parse_index_spec(spec)
+    faiss_metric = metric_type(metric)
+    n, d = vectors.shape
+
+    if index_type == "ivfpq" and n < MIN_POINTS_PER_CENTROID * 256:
+        index_type = "ivf"
+
+    if index_type == "flat":
+        index = faiss.IndexFlat(d, faiss_metric)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, params.get("m", 32), faiss_metric)
+        index.hnsw.efConstruction = params.get("efconstruction", 80)
+        index.hnsw.efSearch = params.get("efsearch", 64)
+    else:
+        nlist = params.get("nlist", default_nlist(n))
+        if index_type == "ivf":
+            index = faiss.index_factory(d, f"IVF{nlist},Flat", faiss_metric)
+        else:
+            #"np" skips polysemous training, which takes ~10x longer than the PQ training itself and only helps hamming filtering
+            index = faiss.index_factory(d, f"IVF{nlist},PQ{params.get('m', default_pq_m(d))}x{params.get('nbits', 8)}np", faiss_metric)
+        index.nprobe = min(nlist, params.get("nprobe", max(8, nlist // 16)))
+        index.train(vectors)
+
+    index.add(vectors)
+    return index
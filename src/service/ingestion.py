@@ -0,0 +1,215 @@
+"""
+Filename: ingestion.py
+Description:
+    Bulk ingestion of many documents into contexts for a CustomGPT. Documents are parsed and chunked, optionally in
+    a process pool, and the chunks of a few documents at a time are embedded on a bounded thread pool. Each finished context
+    is written to the database in the same transaction as a checkpoint row recording the document's content hash
+    and the ingestion settings. A rerun skips every document whose checkpoint still matches, so an interrupted run
+    resumes where it stopped. An edited document is chunked again and its chunks matched against its stored context
+    by text, so only the chunks that changed are embedded and written. Progress is reported after every document
+    in documents and chunks per second.
+
+Usage:
+    contexts = ingest_documents(db_connection, gpt, sorted(Path("documents").glob("*.pdf")), chunk_size=1000)
+
+    Worker processes are started with spawn on Windows and macOS, which imports the calling script again in each
+    of them; only pass parse_workers from a script whose work runs behind an if __name__ == "__main__": guard.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from pathlib import Path
+
+import tiktoken
+
+from src.service.chunking import chunk_token_stream
+from src.service.context import Context
+from src.service.embedding import embed_chunks
+from src.service.extraction import iter_document_blocks
+
+
+def file_hash(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingestion_settings(gpt, chunk_size : int, chunk_overlap : int, boundary : str) -> str:
+    """
+    Everything besides the document that shapes its context; a checkpoint only counts if these are unchanged.
+    """
+    return json.dumps({"model": gpt.model, "embedding_model": gpt.context_embedding_model, "chunk_size": chunk_size,
+                       "chunk_overlap": chunk_overlap, "boundary": boundary, "index_spec": gpt.index_spec,
+                       "metric": gpt.metric}, sort_keys=True)
+
+
+def parse_document(path : str, model : str, chunk_size : int, chunk_overlap : int, boundary : str) -> list:
+    """
+    Chunk a document as its pages, paragraphs or lines are extracted; runs in a worker process.
+    :return: list of (chunk text, token count, (first source, last source))
+    """
+    spans = list(chunk_token_stream(iter_document_blocks(path), tiktoken.encoding_for_model(model),
+                                    chunk_size, chunk_overlap, boundary))
+    if not spans:
+        raise ValueError(f"{path} has no text to ingest")
+    return spans
+
+
+def diff_chunks(context : Context, spans : list) -> tuple:
+    """
+    Match a document's new chunks against the chunks of its stored context by text.
+    :param spans: (chunk text, token count, source) of each new chunk
+    :return: (ids of chunks to remove, spans to add, {chunk id: new source} of kept chunks whose source changed)
+    """
+    stored = defaultdict(deque)
+    for chunk_id, chunk in zip(context.chunk_ids, context.chunks):
+        stored[chunk].append(chunk_id)
+
+    added, moved = [], {}
+    for span in spans:
+        if stored.get(span[0]):
+            chunk_id = stored[span[0]].popleft()
+            if context.sources is None or context.sources[context.chunk_position(chunk_id)] != span[2]:
+                moved[chunk_id] = span[2]
+        else:
+            added.append(span)
+    removed = [chunk_id for chunk_ids in stored.values() for chunk_id in chunk_ids]
+    return removed, added, moved
+
+
+def print_progress(progress : dict) -> None:
+    print(f"[{progress['done'] + progress['failed']}/{progress['total']}] {progress['document']}: {progress['chunks']} chunks | "
+          f"{progress['docs_per_second']:.2f} docs/s, {progress['chunks_per_second']:.1f} chunks/s")
+    return
+
+
+def _run(pool, function, *args) -> Future:
+    #without a pool the work is done here and now, wrapped in a finished future
+    if pool is not None:
+        return pool.submit(function, *args)
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def ingest_documents(db_connection, gpt, doc_paths : list, chunk_size : int = 500, chunk_overlap : int = 0,
+                     boundary : str = "word", parse_workers : int = 0, embedding_workers : int = 2,
+                     progress=print_progress) -> dict:
+    """
+    Build a context from each document, named after its file, write it to the database and add it to the GPT.
+    Embedding uses the GPT's client, embedding model, batch size, concurrency and embedding cache, and the
+    contexts get its index_spec and metric.
+    :param db_connection: context_db_connection the contexts and checkpoints are written to
+    :param doc_paths: .docx, .pdf or .txt files; their names (without suffix) must be unique
+    :param parse_workers: processes parsing and chunking documents; 0 (the default) to parse in this process, None
+                          for one per CPU. The calling script must guard its work with if __name__ == "__main__":
+    :param embedding_workers: documents embedded at once, each with up to gpt.embedding_concurrency requests in flight
+    :param progress: called with a dict after each ingested or failed document (see print_progress); None for silence
+    :return: dict of context name to Context for every document, including ones already ingested by an earlier run
+    :raises RuntimeError: if any document failed, after all the others have been ingested; a rerun retries only those
+    """
+    paths = [str(Path(path).resolve()) for path in doc_paths]
+    names = [Path(path).stem for path in paths]
+    duplicates = [name for name, count in Counter(names).items() if count > 1]
+    if duplicates:
+        raise ValueError(f"Documents must have unique names to become contexts; more than one is named {', '.join(duplicates)}")
+
+    #documents completed by an earlier run with the same contents and settings are read back instead
+    settings = ingestion_settings(gpt, chunk_size, chunk_overlap, boundary)
+    checkpoints = db_connection.get_ingestion_checkpoints()
+    contexts = {}
+    remaining = deque()
+    for path, name in zip(paths, names):
+        content_hash = file_hash(path)
+        checkpoint = checkpoints.get(path)
+        context = None
+        if checkpoint is not None and checkpoint[1] == settings:
+            context = db_connection.read_context_by_id(checkpoint[2])
+        if context is not None and checkpoint[0] == content_hash:
+            contexts[name] = context
+        else:
+            #an edited document's stored context is updated in place rather than built again
+            remaining.append((path, name, content_hash, context))
+
+    total = len(remaining)
+    done, chunks_done, failures = 0, 0, {}
+    start = time.perf_counter()
+    n_parse_workers = os.cpu_count() if parse_workers is None else parse_workers
+    #documents parsed or being embedded at once, so chunks waiting for the embedder don't pile up in memory
+    max_in_flight = max(1, n_parse_workers) + 2 * embedding_workers
+
+    def embed(spans : list) -> list:
+        return embed_chunks(gpt, [chunk for chunk, _, _ in spans], gpt.context_embedding_model,
+                            token_counts=[n_tokens for _, n_tokens, _ in spans],
+                            max_inputs=gpt.embedding_batch_size,
+                            max_concurrency=gpt.embedding_concurrency,
+                            cache=gpt.embedding_cache)
+
+    with ProcessPoolExecutor(max_workers=n_parse_workers) if n_parse_workers > 0 else nullcontext() as parse_pool, \
+         ThreadPoolExecutor(max_workers=max(1, embedding_workers)) as embed_pool:
+        pending = {}  # future -> (stage, path, name, content hash, stored context, chunk spans once parsed, diff)
+        while remaining or pending:
+            while remaining and len(pending) < max_in_flight:
+                path, name, content_hash, stored = remaining.popleft()
+                future = _run(parse_pool, parse_document, path, gpt.model, chunk_size, chunk_overlap, boundary)
+                pending[future] = ("parse", path, name, content_hash, stored, None, None)
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, path, name, content_hash, stored, spans, diff = pending.pop(future)
+                try:
+                    if stage == "parse":
+                        spans = future.result()
+                        diff = diff_chunks(stored, spans) if stored is not None else None
+                        to_embed = diff[1] if diff is not None else spans
+                        pending[embed_pool.submit(embed, to_embed)] = ("embed", path, name, content_hash, stored, spans, diff)
+                        continue
+
+                    if diff is not None:
+                        #add before removing, since every stored chunk may be gone
+                        removed, added, moved = diff
+                        context = stored
+                        added_ids = context.add_chunks(future.result(), [span[1] for span in added], [span[2] for span in added])
+                        context.set_chunk_sources(moved)
+                        context.remove_chunks(removed)
+                        #the vectors as embedded, since reading them back from a memory-mapped index may be lossy
+                        changes = {"added": added_ids, "removed": removed, "moved": list(moved),
+                                   "vectors": dict(zip(added_ids, (vector for _, vector in future.result())))}
+                    else:
+                        context = Context(name, path, future.result(), gpt.context_embedding_model, gpt.index_spec,
+                                          gpt.metric, token_counts=[n_tokens for _, n_tokens, _ in spans],
+                                          sources=[source for _, _, source in spans])
+                        changes = None
+                    db_connection.write_ingested_context(path, content_hash, settings, context, changes)
+                    contexts[name] = context
+                    done += 1
+                    chunks_done += len(spans)
+                except Exception as e:
+                    #keep going; the document has no checkpoint, so the next run tries it again
+                    failures[path] = e
+                    print(f"Ingesting {path} failed: {e}")
+
+                if progress is not None:
+                    elapsed = max(time.perf_counter() - start, 1e-9)
+                    progress({"document": name, "chunks": 0 if spans is None else len(spans), "done": done,
+                              "failed": len(failures), "total": total, "skipped": len(paths) - total,
+                              "elapsed": elapsed, "docs_per_second": done / elapsed,
+                              "chunks_per_second": chunks_done / elapsed})
+
+    for name, context in contexts.items():
+        if name in gpt.contexts:
+            gpt.remove_context(name)
+        gpt.add_context(context)
+
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(paths)} documents failed to ingest: {', '.join(failures)}")
+    return contexts
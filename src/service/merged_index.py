@@ -0,0 +1,116 @@
+import numpy as np
+import faiss
+from src.service.index_spec import normalize
+from src.service.retrieval import Hit, similarity_from_distances, mmr
+
+
+class MergedIndex:
+    """
+    One FAISS index holding the vectors of every context in a CustomGPT.
+
+    Purpose:
+    --------
+    - Answers a query with a single search over all contexts, returning the
+      global top-k chunks instead of the top-k of each context.
+    - Maps every vector id back to the context and chunk it came from, so
+      each hit can be attributed to its context.
+    - Is updated incrementally: adding a context appends its vectors and
+      removing one deletes only its ids.
+
+    The vectors are copied out of each context (normalized, as in
+    Context.generate_faiss_index), so a memory-mapped context also takes
+    up memory here.
+    """
+    def __init__(self):
+        self.index = None           # IndexIDMap2 over a flat L2 index, created with the first context
+        self.contexts = {}          # key -> Context, for looking up chunk texts and the current context name
+        self.ids = {}               # key -> array of the vector ids belonging to that context
+        self.id_to_chunk = {}       # vector id -> (key, chunk index within the context)
+        self.next_id = 0
+
+    def add_context(self, key: str, context) -> None:
+        """
+        Add a context's vectors under the given key (the name it has in the CustomGPT).
+        """
+        if key in self.contexts:
+            raise ValueError(f"context {key} is already in the merged index")
+
+        vectors = normalize(context.get_vectors())
+        if len(vectors) == 0:
+            raise ValueError(f"context {key} has no vectors")
+
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        elif vectors.shape[1] != self.index.d:
+            raise ValueError(f"context {key} has {vectors.shape[1]} dimensional vectors, the merged index has {self.index.d}")
+
+        ids = np.arange(self.next_id, self.next_id + len(vectors), dtype="int64")
+        self.next_id += len(vectors)
+        self.index.add_with_ids(vectors, ids)
+
+        self.contexts[key] = context
+        self.ids[key] = ids
+        self.id_to_chunk.update((int(vector_id), (key, i)) for i, vector_id in enumerate(ids))
+        return
+
+    def remove_context(self, key: str) -> None:
+        """
+        Remove a context's vectors; the other contexts are left in place.
+        """
+        if key not in self.contexts:
+            raise ValueError(f"context {key} is not in the merged index")
+
+        ids = self.ids.pop(key)
+        self.index.remove_ids(ids)
+        for vector_id in ids:
+            del self.id_to_chunk[int(vector_id)]
+        del self.contexts[key]
+        return
+
+    def clear(self) -> None:
+        self.__init__()
+        return
+
+    def search(self, query_vector: np.array, k: int = 10, score_threshold: float = None,
+               mmr_diversity: float = None, fetch_k: int = None) -> list:
+        """
+        Find the k chunks closest to the query vector across all contexts.
+        The query is normalized like the stored vectors. Options are as for Context.search.
+        :return: list of Hits attributed to their contexts, most similar first
+        """
+        return self.search_batch(query_vector, k, score_threshold, mmr_diversity, fetch_k)[0]
+
+    def search_batch(self, query_vectors: np.ndarray, k: int = 10, score_threshold: float = None,
+                     mmr_diversity: float = None, fetch_k: int = None) -> list:
+        """
+        Like search() for many queries at once, with a single FAISS search over the matrix of query vectors.
+        :return: one list of Hits per query, in query order
+        """
+        queries = normalize(query_vectors)
+        if self.index is None or self.index.ntotal == 0:
+            return [[] for _ in range(len(queries))]
+
+        k = min(k, self.index.ntotal)
+        n_candidates = k if mmr_diversity is None else min(self.index.ntotal, fetch_k or max(4 * k, 20))
+        D, I = self.index.search(queries, n_candidates)
+        return [self._hits(D[row], I[row], k, score_threshold, mmr_diversity) for row in range(len(queries))]
+
+    def _hits(self, distances: np.ndarray, ids: np.ndarray, k: int, score_threshold: float, mmr_diversity: float) -> list:
+        scores = similarity_from_distances(distances, self.index.metric_type)
+        if score_threshold is not None:
+            ids, scores = ids[scores >= score_threshold], scores[scores >= score_threshold]
+        if mmr_diversity is not None and len(ids) > 0:
+            order = mmr(np.vstack([self.index.reconstruct(int(i)) for i in ids]), scores, k, mmr_diversity)
+            ids, scores = ids[order], scores[order]
+
+        hits = []
+        for vector_id, score in zip(ids[:k], scores[:k]):
+            key, chunk_index = self.id_to_chunk[int(vector_id)]
+            context = self.contexts[key]
+            hits.append(Hit(context.name, context.chunk_ids[chunk_index], float(score), context.chunks[chunk_index],
+                            None if context.token_counts is None else context.token_counts[chunk_index],
+                            None if context.sources is None else context.sources[chunk_index]))
+        return hits
+
+    def __len__(self):
+        return 0 if self.index is None else self.index.ntotal
@@ -0,0 +1,43 @@
+"""
+Filename: prompt.py
+Description:
+    Packs retrieved chunks into the prompt within a token budget, highest scoring first. Chunk token counts come
+    from ingestion (Hit.token_count), so a query normally doesn't tokenize anything; chunks without a stored count
+    (contexts written before counts were kept) are counted with the supplied function instead.
+"""
+
+
+def pack_hits(hits : list, token_budget : int = None, count_tokens=None) -> tuple:
+    """
+    Choose the chunks to put in the prompt. Hits are taken in order of score; one that doesn't fit in what is left
+    of the budget is dropped and smaller, lower scoring ones may still be taken after it.
+    :param hits: Hits from one or more contexts
+    :param token_budget: most chunk tokens to include, None for no limit
+    :param count_tokens: function from chunk text to its token count, used for hits without a token_count
+    :return: (hits to include in score order, usage dict with token_budget, tokens_used, tokens_dropped,
+             chunks_used and chunks_dropped)
+    """
+    packed = []
+    used = 0
+    dropped = 0
+
+    for hit in sorted(hits, key=lambda hit: hit.score, reverse=True):
+        if hit.token_count is not None:
+            n_tokens = hit.token_count
+        elif count_tokens is not None:
+            n_tokens = count_tokens(hit.text)
+        else:
+            raise ValueError(f"Chunk {hit.chunk_id} of context {hit.context} has no token count and no count_tokens function was given")
+
+        if token_budget is None or used + n_tokens <= token_budget:
+            packed.append(hit)
+            used += n_tokens
+        else:
+            dropped += n_tokens
+
+    usage = {"token_budget": token_budget,
+             "tokens_used": used,
+             "tokens_dropped": dropped,
+             "chunks_used": len(packed),
+             "chunks_dropped": len(hits) - len(packed)}
+    return packed, usage
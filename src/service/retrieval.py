@@ -0,0 +1,58 @@
+"""
+Filename: retrieval.py
+Description:
+    Typed search results shared by Context and MergedIndex, and maximal marginal relevance (MMR) re-ranking.
+    Scores are cosine similarities whatever the index metric (higher is closer), so a score threshold means the
+    same thing for every context.
+"""
+from dataclasses import dataclass
+
+import faiss
+import numpy as np
+
+
+@dataclass(frozen=True)
+class Hit:
+    context: str        # name of the context the chunk belongs to
+    chunk_id: int       # stable id of the chunk within its context (its position unless chunks were added or removed)
+    score: float        # cosine similarity between the query and the chunk
+    text: str
+    token_count: int = None  # tokens in text, when counted at ingestion
+    source: tuple = None     # (first, last) page, paragraph or line of the document the text came from, when known
+
+
+def similarity_from_distances(distances: np.ndarray, metric_type: int) -> np.ndarray:
+    """
+    Convert FAISS search results over unit vectors to cosine similarities. Inner product already is one; squared
+    L2 distance between unit vectors is 2 - 2 * cosine.
+    """
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        return distances
+    return 1.0 - distances / 2.0
+
+
+def mmr(candidate_vectors: np.ndarray, scores: np.ndarray, k: int, diversity: float) -> list:
+    """
+    Pick k candidates one at a time, each maximizing (1 - diversity) * similarity to the query minus
+    diversity * its highest similarity to the candidates already picked, so near-duplicates of a picked chunk drop
+    down the list.
+    :param candidate_vectors: normalized vectors of the candidates, one row each
+    :param scores: similarity of each candidate to the query
+    :param diversity: 0 keeps the original ranking, 1 only avoids redundancy
+    :return: indices into the candidates, in pick order
+    """
+    if len(scores) == 0:
+        return []
+    pairwise = candidate_vectors @ candidate_vectors.T
+    picked = [int(np.argmax(scores))]
+    redundancy = pairwise[picked[0]].copy()
+    available = np.ones(len(scores), dtype=bool)
+    available[picked[0]] = False
+
+    while len(picked) < min(k, len(scores)):
+        marginal = np.where(available, (1.0 - diversity) * scores - diversity * redundancy, -np.inf)
+        best = int(np.argmax(marginal))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return picked
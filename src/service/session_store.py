@@ -0,0 +1,304 @@
+"""
+Filename: session_store.py
+Description:
+    Keeps the CustomGPTs the app has loaded and one chat history per (gpt, session id). A GPT's contexts are loaded
+    once and shared by all of its sessions; only the conversation is per session. GPTs and sessions are evicted
+    least recently used first, when they've been idle longer than their TTL, when there are more sessions than
+    max_sessions, or when the approximate memory of everything resident goes over max_memory_bytes; that memory is
+    kept as a running total, updated as GPTs load and unload and as conversations grow, shrink or end. A GPT is loaded
+    once however many requests for it arrive while it is loading; they all wait on the same load. refresh() reloads
+    GPTs that changed in the database since they were loaded and swaps the new copy in.
+
+Usage:
+    store = SessionStore(lambda name: db_connection.read_custom_gpt_by_name(name), max_memory_bytes=2 * 1024 ** 3)
+    store.preload("BuddBot")
+    gpt, history = store.get("BuddBot", session_id)
+    answer = gpt.query(message, chat_history=history)
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from src.service.chat_history import ChatHistory
+from src.service.customGPT import CustomGPT
+
+
+def approximate_gpt_bytes(gpt : CustomGPT) -> int:
+    """
+    Estimate the memory a loaded GPT holds: chunk texts, vectors kept in Python and FAISS index storage. Indexes
+    that are memory-mapped are left out, since their pages belong to the OS file cache.
+    """
+    total = 0
+    for context in gpt.contexts.values():
+        total += sum(sys.getsizeof(chunk) for chunk in context.chunks or [])
+        if context.embeddings:
+            total += len(context.embeddings) * context.embeddings[0][1].nbytes
+        if context.index is not None and not context.mmap:
+            total += context.index.ntotal * context.index.d * 4
+    if gpt.merged_index is not None and gpt.merged_index.index is not None:
+        total += gpt.merged_index.index.ntotal * gpt.merged_index.index.d * 4
+    return total
+
+
+def approximate_history_bytes(history : ChatHistory) -> int:
+    return history.content_bytes
+
+
+class SessionStore:
+
+    def __init__(self, load_gpt, max_sessions : int = 1000, session_ttl : float = 1800.0, gpt_ttl : float = None,
+                 max_memory_bytes : int = None, get_generations=None):
+        """
+        :param load_gpt: function from a GPT name to a loaded CustomGPT, or None if there is no such GPT
+        :param get_generations: function returning the current generation of every GPT by name, compared with
+                                CustomGPT.generation by refresh(); None disables refresh
+        :param max_sessions: most conversations kept across all GPTs
+        :param session_ttl: seconds a conversation is kept after its last message
+        :param gpt_ttl: seconds a GPT stays loaded after its last use; None keeps it until memory is needed
+        :param max_memory_bytes: approximate memory cap for loaded GPTs and conversations together; None for no cap
+        """
+        self.load_gpt = load_gpt
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.gpt_ttl = gpt_ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.get_generations = get_generations
+        self._gpts = OrderedDict()      # name -> [CustomGPT, approximate bytes, last used], least recently used first
+        self._sessions = OrderedDict()  # (gpt name, session id) -> [ChatHistory, last used], least recently used first
+        self._loading = {}              # name -> Future of the GPT's entry (None if unknown), while it is being loaded
+        self._gpt_bytes = 0             # approximate bytes of the resident GPTs
+        self._session_bytes = 0         # approximate bytes of the resident conversations
+        self._lock = threading.Lock()
+        self.evictions = {"gpts": 0, "sessions": 0}
+        self.reloads = 0
+
+    def get(self, gpt_name : str, session_id : str) -> tuple:
+        """
+        Return the named GPT and the conversation of the given session with it, loading the GPT or starting the
+        conversation if needed.
+        :return: (CustomGPT, ChatHistory), or (None, None) if load_gpt doesn't know the GPT
+        """
+        now = time.monotonic()
+        entry = self._load(gpt_name, now)
+        if entry is None:
+            return None, None
+
+        with self._lock:
+            #refresh() may swap in a reloaded copy at any time; take the one that is current now
+            gpt = entry[0]
+            key = (gpt_name, session_id)
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = [self._track(key, gpt.new_chat_history()), now]
+            elif session[0].count_tokens != gpt.count_tokens:
+                #the GPT was unloaded or reloaded since this conversation's last message
+                gpt.bind_chat_history(session[0])
+            session[1] = now
+            self._sessions.move_to_end(key)
+            self._evict(now, keep_gpt=gpt_name, keep_session=key)
+
+        return gpt, session[0]
+
+    def get_gpt(self, gpt_name : str) -> CustomGPT:
+        """
+        Return the named GPT without starting a conversation, loading it if needed.
+        :return: CustomGPT, or None if load_gpt doesn't know the GPT
+        """
+        now = time.monotonic()
+        entry = self._load(gpt_name, now)
+        if entry is None:
+            return None
+        with self._lock:
+            gpt = entry[0]
+            self._evict(now, keep_gpt=gpt_name)
+        return gpt
+
+    def preload(self, gpt_name : str) -> bool:
+        """
+        Load a GPT ahead of its first request, e.g. at startup.
+        :return: False if load_gpt doesn't know the GPT
+        """
+        return self.get_gpt(gpt_name) is not None
+
+    def _load(self, gpt_name : str, now : float) -> list:
+        """
+        Return the GPT's entry, marking it used, or load it if it isn't resident. Only the first caller for a GPT
+        that isn't resident loads it; the others wait for that load.
+        :return: [CustomGPT, approximate bytes, last used], or None if load_gpt doesn't know the GPT
+        """
+        with self._lock:
+            entry = self._gpts.get(gpt_name)
+            if entry is not None:
+                entry[2] = now
+                self._gpts.move_to_end(gpt_name)
+                return entry
+            loading = self._loading.get(gpt_name)
+            first = loading is None
+            if first:
+                loading = self._loading[gpt_name] = Future()
+        if not first:
+            return loading.result()
+
+        #load outside the lock so requests for GPTs that are already resident aren't held up
+        try:
+            gpt = self.load_gpt(gpt_name)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[gpt_name]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            entry = None
+            if gpt is not None:
+                entry = self._gpts[gpt_name] = [gpt, approximate_gpt_bytes(gpt), now]
+                self._gpt_bytes += entry[1]
+            del self._loading[gpt_name]
+        loading.set_result(entry)
+        return entry
+
+    def refresh(self) -> list:
+        """
+        Reload the resident GPTs whose generation in the database has moved on since they were loaded, and unload
+        the ones that have been deleted. A reloaded GPT is swapped in at once: queries already running finish with
+        the copy they started on, later ones get the new copy, and conversations carry on with it. Loading happens
+        in the calling thread, e.g. a background watcher (see src.app.state.watch_for_updates), without holding
+        up requests.
+        :return: names of the GPTs reloaded or unloaded
+        """
+        if self.get_generations is None:
+            return []
+        generations = self.get_generations()
+        with self._lock:
+            #GPTs that weren't read from the database have no generation to compare
+            stale = [(name, entry[0]) for name, entry in self._gpts.items()
+                     if entry[0].generation is not None and generations.get(name) != entry[0].generation]
+
+        changed = []
+        for name, old_gpt in stale:
+            gpt = None
+            if name in generations:
+                try:
+                    gpt = self.load_gpt(name)
+                except Exception as e:
+                    #keep serving the old copy; the next refresh tries again
+                    print(f"Reloading GPT {name} failed: {e}")
+                    continue
+            with self._lock:
+                entry = self._gpts.get(name)
+                if entry is None or entry[0] is not old_gpt:
+                    #evicted or already replaced meanwhile
+                    continue
+                if gpt is None:
+                    self._unload_gpt(name, evicted=False)
+                else:
+                    entry[0] = gpt
+                    self._gpt_bytes -= entry[1]
+                    entry[1] = approximate_gpt_bytes(gpt)
+                    self._gpt_bytes += entry[1]
+                    for (gpt_name, _), session in self._sessions.items():
+                        if gpt_name == name:
+                            gpt.bind_chat_history(session[0])
+                    self.reloads += 1
+                    self._evict(time.monotonic(), keep_gpt=name)
+            changed.append(name)
+        return changed
+
+    def end_session(self, gpt_name : str, session_id : str) -> None:
+        with self._lock:
+            if (gpt_name, session_id) in self._sessions:
+                self._drop_session((gpt_name, session_id), evicted=False)
+        return
+
+    def _track(self, key : tuple, history : ChatHistory) -> ChatHistory:
+        #count the conversation's memory now and follow it as messages come and go, for as long as it is resident
+        self._session_bytes += history.content_bytes
+        history.on_resize = lambda delta: self._history_resized(key, history, delta)
+        return history
+
+    def _history_resized(self, key : tuple, history : ChatHistory, delta : int) -> None:
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session[0] is history:
+                self._session_bytes += delta
+        return
+
+    def _drop_session(self, key : tuple, evicted : bool = True) -> int:
+        history = self._sessions.pop(key)[0]
+        history.on_resize = None
+        self._session_bytes -= history.content_bytes
+        if evicted:
+            self.evictions["sessions"] += 1
+        return history.content_bytes
+
+    def _unload_gpt(self, name : str, evicted : bool = True) -> int:
+        #detach the GPT's conversations from it so they don't keep it in memory
+        for (gpt_name, _), session in self._sessions.items():
+            if gpt_name == name:
+                session[0].bind()
+        if evicted:
+            self.evictions["gpts"] += 1
+        gpt_bytes = self._gpts.pop(name)[1]
+        self._gpt_bytes -= gpt_bytes
+        return gpt_bytes
+
+    def _memory_bytes(self) -> int:
+        return self._gpt_bytes + self._session_bytes
+
+    def _evict(self, now : float, keep_gpt : str = None, keep_session : tuple = None) -> None:
+        #idle sessions and GPTs first
+        for key in [key for key, session in self._sessions.items() if now - session[1] > self.session_ttl and key != keep_session]:
+            self._drop_session(key)
+        if self.gpt_ttl is not None:
+            for name in [name for name, entry in self._gpts.items() if now - entry[2] > self.gpt_ttl and name != keep_gpt]:
+                self._unload_gpt(name)
+
+        while len(self._sessions) > self.max_sessions:
+            self._drop_session(next(iter(self._sessions)))
+
+        if self.max_memory_bytes is None:
+            return
+        #GPTs hold far more than conversations, so unload least recently used GPTs first; their sessions keep their
+        #histories and the GPT is loaded again on its next request
+        memory = self._memory_bytes()
+        for name in [name for name in self._gpts if name != keep_gpt]:
+            if memory <= self.max_memory_bytes:
+                return
+            memory -= self._unload_gpt(name)
+        for key in [key for key in self._sessions if key != keep_session]:
+            if memory <= self.max_memory_bytes:
+                return
+            memory -= self._drop_session(key)
+        return
+
+    def stats(self) -> dict:
+        """
+        Resident GPTs and sessions with their approximate memory, for the admin endpoint. Sessions are only
+        counted: a session id is all it takes to continue a conversation, so ids are never listed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            sessions_per_gpt = {}
+            for (gpt_name, _), session in self._sessions.items():
+                counts = sessions_per_gpt.setdefault(gpt_name, [0, 0, 0])
+                counts[0] += 1
+                counts[1] += len(session[0])
+                counts[2] += approximate_history_bytes(session[0])
+            gpts = [{"name": name, "generation": entry[0].generation, "approx_bytes": entry[1], "idle_seconds": round(now - entry[2], 1),
+                     "sessions": sessions_per_gpt.get(name, [0])[0]} for name, entry in self._gpts.items()]
+            sessions = {"count": len(self._sessions),
+                        "messages": sum(counts[1] for counts in sessions_per_gpt.values()),
+                        "approx_bytes": sum(counts[2] for counts in sessions_per_gpt.values()),
+                        "per_gpt": {name: counts[0] for name, counts in sessions_per_gpt.items()}}
+
+            loading = list(self._loading)
+
+        return {"gpts": gpts,
+                "loading": loading,
+                "sessions": sessions,
+                "approx_bytes": sum(g["approx_bytes"] for g in gpts) + sessions["approx_bytes"],
+                "max_memory_bytes": self.max_memory_bytes,
+                "max_sessions": self.max_sessions,
+                "evictions": dict(self.evictions),
+                "reloads": self.reloads}
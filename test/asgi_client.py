@@ -0,0 +1,47 @@
+"""
+Filename: asgi_client.py
+Description:
+    Calls an ASGI application in process, the way a server would for one HTTP request, so the async app can be
+    tested and load tested without an ASGI server installed.
+
+Usage:
+    status, headers, body = await asgi_request(app, "POST", "/chat/query", {"gpt_name": "BuddBot", "message": "hi"})
+"""
+import asyncio
+import json
+
+
+async def asgi_request(app, method: str, path: str, body: dict = None, headers: dict = None) -> tuple:
+    """
+    :param headers: extra request headers by name
+    :return: (status, dict of lowercase header names to values, body bytes)
+    """
+    request = json.dumps(body).encode("utf-8") if body is not None else b""
+    received = asyncio.Event()
+    response = {"status": None, "headers": {}, "body": b""}
+
+    async def receive():
+        if not received.is_set():
+            received.set()
+            return {"type": "http.request", "body": request, "more_body": False}
+        #nothing more to read until the response is finished; then the client goes away
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {key.decode().lower(): value.decode() for key, value in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+            if not message.get("more_body", False):
+                finished.set()
+        return
+
+    finished = asyncio.Event()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "path": path,
+             "query_string": b"", "headers": [(b"content-type", b"application/json")]
+             + [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()]}
+    await app(scope, receive, send)
+    finished.set()
+    return response["status"], response["headers"], response["body"]
@@ -0,0 +1,175 @@
+"""
+Filename: fake_openai_server.py
+Description:
+    A local stand-in for the OpenAI embeddings and chat completions endpoints so ingestion and querying can be
+    tested without an API key. Vectors are derived from a hash of the input text, so the same text always gets the
+    same vector, and completions echo the last message back, streamed word by word when the request asks for it.
+    make_gpt builds the GPT most tests query through it.
+
+Usage:
+    with FakeOpenAIServer(rate_limit_first=2) as server:
+        client = OpenAI(api_key="test", base_url=server.base_url)
+        gpt = make_gpt(server.base_url, answer_cache_size=16)
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src.service.context import Context
+from src.service.customGPT import CustomGPT
+
+
+def fake_embedding(text: str, dimensions: int = 64) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions).astype("float32")
+
+
+def make_gpt(base_url: str = None, name: str = "Testgpt", contexts: tuple = ("walls", "roofs"), **options) -> CustomGPT:
+    """
+    GPT whose contexts hold 30 chunks each, "chunk i about <context>", embedded with fake_embedding so a query with
+    the same text as a chunk finds it first.
+    :param options: further CustomGPT arguments, overriding the defaults, e.g. answer_cache_size
+    """
+    settings = {"model": "gpt-4-turbo", "context_embedding_model": "text-embedding-3-small", "initial_role": "be brief",
+                "initial_context": "", "api_key": "test"}
+    gpt = CustomGPT(name=name, base_url=base_url, **{**settings, **options})
+    for context in contexts:
+        texts = [f"chunk {i} about {context}" for i in range(30)]
+        gpt.add_context(Context(context, "doc.docx", [[text, fake_embedding(text)] for text in texts], token_counts=[5] * 30))
+    return gpt
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    #the default listen backlog of 5 makes bursts of concurrent connections wait on SYN retransmits
+    request_queue_size = 1024
+
+
+class FakeOpenAIServer:
+
+    def __init__(self, dimensions: int = 64, latency: float = 0.0, rate_limit_first: int = 0, token_latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency                      # seconds each request takes before anything is sent back
+        self.token_latency = token_latency          # seconds each word of a completion takes to generate
+        self.rate_limit_first = rate_limit_first    # number of requests answered with a 429 before succeeding
+        self.requests = []                          # list of input lists received by the embeddings endpoint
+        self.chat_requests = []                     # list of message lists received by the chat completions endpoint
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.httpd = _HTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                return
+
+            def _send_json(self, status: int, body: dict, headers: dict = None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server.lock:
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    time.sleep(server.latency)
+                    if self.path.endswith("/embeddings"):
+                        self._embeddings(body)
+                    elif self.path.endswith("/chat/completions"):
+                        self._chat_completions(body)
+                    else:
+                        self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+            def _embeddings(self, body: dict):
+                with server.lock:
+                    if server.rate_limit_first > 0:
+                        server.rate_limit_first -= 1
+                        self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {"retry-after": "0"})
+                        return
+                    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                    server.requests.append(inputs)
+
+                data = []
+                for i, text in enumerate(inputs):
+                    vector = fake_embedding(text, server.dimensions)
+                    if body.get("encoding_format") == "base64":
+                        embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+                    else:
+                        embedding = vector.tolist()
+                    data.append({"object": "embedding", "index": i, "embedding": embedding})
+                #answer out of order to make sure callers use the returned index
+                data.reverse()
+                self._send_json(200, {"object": "list", "data": data, "model": body["model"],
+                                      "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+            def _chat_completions(self, body: dict):
+                with server.lock:
+                    server.chat_requests.append(body["messages"])
+                content = "echo: " + body["messages"][-1]["content"]
+                words = content.split(" ")
+                if body.get("stream"):
+                    self._stream_completion(body, words)
+                    return
+                time.sleep(server.token_latency * len(words))
+                self._send_json(200, {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                                      "model": body["model"],
+                                      "choices": [{"index": 0, "finish_reason": "stop",
+                                                   "message": {"role": "assistant", "content": content}}],
+                                      "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+            def _stream_completion(self, body: dict, words: list):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+
+                def send_chunk(delta: dict, finish_reason=None):
+                    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": body["model"], "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                try:
+                    send_chunk({"role": "assistant", "content": ""})
+                    for i, word in enumerate(words):
+                        time.sleep(server.token_latency)
+                        send_chunk({"content": word if i == 0 else " " + word})
+                    send_chunk({}, "stop")
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    #the client stopped reading part way through
+                    return
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
@@ -0,0 +1,91 @@
+import unittest
+from src.service.answer_cache import SemanticAnswerCache
+from fake_openai_server import FakeOpenAIServer, make_gpt
+from unittest.mock import patch
+import numpy as np
+
+class MyTestCase(unittest.TestCase):
+
+    def test_near_duplicates_hit(self):
+        rng = np.random.default_rng(0)
+        question = rng.standard_normal(64).astype("float32")
+        cache = SemanticAnswerCache(threshold=0.95)
+        self.assertIsNone(cache.get(question, ("k=10",)))
+        cache.put(question, ("k=10",), "anchored to the slab edge")
+
+        near = question + 0.05 * rng.standard_normal(64).astype("float32")
+        self.assertEqual(cache.get(near * 3, ("k=10",)), "anchored to the slab edge")
+        self.assertIsNone(cache.get(rng.standard_normal(64).astype("float32"), ("k=10",)))
+        #the same question asked with other retrieval settings may have another answer
+        self.assertIsNone(cache.get(question, ("k=3",)))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 3, "size": 1, "max_entries": 256})
+
+        return
+
+    def test_ttl_and_lru(self):
+        clock = [0.0]
+        vectors = np.eye(4, dtype="float32")
+        with patch("src.service.answer_cache.time.monotonic", lambda: clock[0]):
+            cache = SemanticAnswerCache(ttl=60, max_entries=2)
+            cache.put(vectors[0], (), "a")
+            cache.put(vectors[1], (), "b")
+            self.assertEqual(cache.get(vectors[0]), "a")
+            cache.put(vectors[2], (), "c")
+            #b was the least recently used
+            self.assertIsNone(cache.get(vectors[1]))
+            self.assertEqual((cache.get(vectors[0]), cache.get(vectors[2])), ("a", "c"))
+
+            clock[0] += 61
+            self.assertIsNone(cache.get(vectors[0]))
+            self.assertEqual((len(cache), cache.index.ntotal), (1, 1))
+
+        return
+
+    def test_customgpt_answers_repeated_first_turns_from_cache(self):
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url, answer_cache_size=16)
+            first = gpt.query("how are curtain walls anchored", chat_history=gpt.new_chat_history())
+            history = gpt.new_chat_history()
+            self.assertEqual(gpt.query("how are curtain walls anchored", chat_history=history), first)
+            self.assertEqual(len(server.chat_requests), 1)
+            self.assertEqual([m["content"] for m in history][1:], ["how are curtain walls anchored", first])
+            self.assertEqual(list(gpt.query_stream("how are curtain walls anchored", chat_history=gpt.new_chat_history())), [first])
+
+            #a follow-up depends on the conversation, so it isn't answered from the cache
+            gpt.query("how are curtain walls anchored", chat_history=history)
+            self.assertEqual(len(server.chat_requests), 2)
+
+            gpt.initial_role = "be thorough"
+            gpt.query("how are curtain walls anchored", chat_history=gpt.new_chat_history())
+            self.assertEqual(len(server.chat_requests), 3)
+            gpt.remove_context("walls")
+            self.assertEqual(len(gpt.answer_cache), 0)
+
+        return
+
+    def test_answers_in_flight_during_an_update_are_not_cached(self):
+        cache = SemanticAnswerCache()
+        generation = cache.generation
+        cache.clear()
+        cache.put(np.eye(4, dtype="float32")[0], (), "stale", generation)
+        self.assertEqual(len(cache), 0)
+
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url, answer_cache_size=16)
+            prepare = gpt._prepare_query
+            def update_during_retrieval(*args, **kwargs):
+                #the contexts change after the query read the cache's generation but before its answer is cached
+                gpt.invalidate_answer_cache()
+                return prepare(*args, **kwargs)
+            with patch.object(gpt, "_prepare_query", update_during_retrieval):
+                gpt.query("how are curtain walls anchored", chat_history=gpt.new_chat_history())
+                list(gpt.query_batch(["how are curtain walls anchored"]))
+            self.assertEqual(len(gpt.answer_cache), 0)
+
+            gpt.query("how are curtain walls anchored", chat_history=gpt.new_chat_history())
+            self.assertEqual(len(gpt.answer_cache), 1)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
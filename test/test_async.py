@@ -0,0 +1,139 @@
+import unittest
+import asyncio
+import json
+import time
+from src.app.asgi import create_asgi_app
+from src.service.session_store import SessionStore
+from src.service.chat_history import ChatHistory
+from fake_openai_server import FakeOpenAIServer, make_gpt
+from asgi_client import asgi_request
+from unittest.mock import patch
+
+class MyTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aquery_matches_query(self):
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url)
+            blocking = await asyncio.to_thread(gpt.query, "chunk 3 about walls", k=3)
+            history = gpt.new_chat_history()
+            answer = await gpt.aquery("chunk 3 about walls", k=3, chat_history=history)
+            streamed = [token async for token in gpt.aquery_stream("chunk 3 about walls", k=3, chat_history=gpt.new_chat_history())]
+
+        self.assertEqual(answer, blocking)
+        self.assertEqual("".join(streamed), blocking)
+        self.assertEqual(server.chat_requests[0], server.chat_requests[1])
+        self.assertIn("Chunk 0 from walls: chunk 3 about walls", server.chat_requests[1][-1]["content"])
+        self.assertEqual([m["content"] for m in history], [m["content"] for m in gpt.chat_history])
+        #the repeated query was embedded once
+        self.assertEqual(len(server.requests), 1)
+
+        return
+
+    async def test_concurrent_queries_overlap(self):
+        with FakeOpenAIServer(latency=0.2) as server:
+            gpt = make_gpt(server.base_url)
+            start = time.perf_counter()
+            answers = await asyncio.gather(*[gpt.aquery(f"question {i}", chat_history=gpt.new_chat_history()) for i in range(50)])
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(set(answers)), 50)
+        #50 queries of two 0.2 s requests each would take 20 s one at a time
+        self.assertGreater(server.max_in_flight, 10)
+        self.assertLess(elapsed, 5)
+
+        return
+
+    async def test_history_summaries_run_off_the_event_loop(self):
+        def summarize(summary, messages):
+            #a blocking completion, as CustomGPT.summarize_turns makes
+            time.sleep(0.3)
+            return "summary"
+
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url)
+            history = ChatHistory("be brief", max_tokens=30, summarize=summarize)
+            ticker = asyncio.ensure_future(tick())
+            await gpt.aquery("a long first question about curtain wall anchors", retrieve_relevant_context=False, chat_history=history)
+            streamed = [token async for token in gpt.aquery_stream("another question about mullions", retrieve_relevant_context=False,
+                                                                    chat_history=history)]
+            ticker.cancel()
+
+        self.assertTrue(streamed)
+        self.assertEqual(history.summary[0]["content"], "summary")
+        #the loop kept running while the turns were being summarized
+        self.assertLess(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.2)
+
+        return
+
+    async def test_asgi_routes(self):
+        with FakeOpenAIServer() as server:
+            store = SessionStore(lambda name: make_gpt(server.base_url) if name == "Testgpt" else None)
+            app = create_asgi_app(store)
+
+            status, _, body = await asgi_request(app, "POST", "/chat/query", {"gpt_name": "Testgpt", "message": "hi"})
+            self.assertEqual(status, 200)
+            first = json.loads(body)
+            status, headers, body = await asgi_request(app, "POST", "/chat/query_stream",
+                                                       {"gpt_name": "Testgpt", "message": "again", "session_id": first["session_id"]})
+            self.assertEqual(headers["content-type"], "text/event-stream; charset=utf-8")
+            self.assertEqual(headers["x-session-id"], first["session_id"])
+            events = [event.split("\n") for event in body.decode().strip().split("\n\n")]
+            self.assertEqual((await asgi_request(app, "POST", "/chat/query", {"gpt_name": "nope", "message": "hi"}))[0], 404)
+            self.assertEqual((await asgi_request(app, "GET", "/chat/unknown"))[0], 404)
+            with patch.dict("os.environ", {"ADMIN_TOKEN": "secret"}):
+                forbidden = (await asgi_request(app, "GET", "/chat/admin/sessions", headers={"X-Admin-Token": "guess"}))[0]
+                stats = (await asgi_request(app, "GET", "/chat/admin/sessions", headers={"X-Admin-Token": "secret"}))[2]
+            self.assertEqual((await asgi_request(app, "GET", "/chat/admin/sessions"))[0], 403)
+            _, headers, batch = await asgi_request(app, "POST", "/chat/batch_query", {"gpt_name": "Testgpt", "queries": ["a", "b"]})
+
+        tokens = [json.loads(data[len("data: "):])["token"] for name, data in events if name == "event: token"]
+        self.assertEqual("".join(tokens), "echo: " + server.chat_requests[1][-1]["content"])
+        self.assertEqual(events[-1], ["event: done", f"data: {json.dumps({'session_id': first['session_id']})}"])
+        self.assertEqual(first["message"], "echo: " + server.chat_requests[0][-1]["content"])
+        #the second request continued the first one's conversation
+        self.assertEqual([m["content"] for m in server.chat_requests[1][1:-1]], ["hi", first["message"]])
+        #stats are for the admin only, and never list the session ids that let a client continue a conversation
+        self.assertEqual(forbidden, 403)
+        self.assertNotIn(first["session_id"].encode(), stats)
+        self.assertEqual(json.loads(stats)["sessions"]["messages"], 5)
+        self.assertEqual(headers["content-type"], "application/x-ndjson")
+        self.assertEqual([json.loads(line)["query"] for line in batch.decode().splitlines()], ["a", "b"])
+
+        return
+
+    async def test_cancelled_batch_query(self):
+        with FakeOpenAIServer(latency=0.2) as server:
+            store = SessionStore(lambda name: make_gpt(server.base_url))
+            app = create_asgi_app(store)
+            self.assertEqual((await asgi_request(app, "POST", "/chat/batch_query", {"gpt_name": "Testgpt", "queries": "abc"}))[0], 400)
+
+            streamed = asyncio.Event()
+            async def receive():
+                return {"type": "http.request", "body": json.dumps({"gpt_name": "Testgpt", "queries": [f"q{i}" for i in range(40)]}).encode()}
+            async def send(message):
+                if message.get("more_body"):
+                    streamed.set()
+            scope = {"type": "http", "method": "POST", "path": "/chat/batch_query", "headers": []}
+            handler = asyncio.ensure_future(app(scope, receive, send))
+            await streamed.wait()
+            #the client goes away while the next answer is being generated in a worker thread
+            await asyncio.sleep(0.05)
+            handler.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await handler
+            in_flight = server.max_in_flight
+
+        #the batch was closed: at most the completions already running were finished, none were started after
+        self.assertLess(len(server.chat_requests), 40)
+        self.assertLessEqual(in_flight, 8)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from src.service.context import Context
+from src.service.merged_index import MergedIndex
+from src.service.session_store import SessionStore
+from fake_openai_server import FakeOpenAIServer, make_gpt
+from unittest.mock import patch
+import numpy as np
+import json
+
+class MyTestCase(unittest.TestCase):
+
+    def test_search_batch_matches_single_searches(self):
+        rng = np.random.default_rng(0)
+        embeddings = [[f"chunk {i}", v] for i, v in enumerate(rng.standard_normal((200, 32)).astype("float32"))]
+        queries = rng.standard_normal((7, 32)).astype("float32")
+        context = Context("ctx", "doc.docx", embeddings, index_spec="hnsw", metric="cosine")
+        merged = MergedIndex()
+        merged.add_context("ctx", context)
+
+        for searcher in [context, merged]:
+            for options in [{}, {"score_threshold": 0.1}, {"mmr_diversity": 0.5}]:
+                batch = searcher.search_batch(queries, 5, **options)
+                self.assertEqual(batch, [searcher.search(query, 5, **options) for query in queries])
+
+        return
+
+    def test_query_batch(self):
+        queries = [f"question {i % 20}" for i in range(30)] + ["fail"]
+        with FakeOpenAIServer(latency=0.02) as server:
+            gpt = make_gpt(server.base_url)
+            original = gpt._prepare_query
+            def prepare(query, *args, **kwargs):
+                if query == "fail":
+                    raise RuntimeError("no luck")
+                return original(query, *args, **kwargs)
+
+            with patch.object(gpt, "_prepare_query", prepare):
+                results = list(gpt.query_batch(queries, k=2, max_concurrency=4))
+
+        #20 distinct questions in one embeddings request, and 30 completions at most 4 at a time
+        self.assertEqual(server.requests, [list(dict.fromkeys(queries))])
+        self.assertEqual(len(server.chat_requests), 30)
+        self.assertLessEqual(server.max_in_flight, 4)
+        self.assertEqual([r["index"] for r in results], list(range(31)))
+        self.assertEqual(results[-1], {"index": 30, "query": "fail", "error": "no luck"})
+        #each answer carries the usage of its own prompt: 2 chunks from each of 2 contexts, 5 tokens each
+        self.assertTrue(all(r["context_usage"]["chunks_used"] == 4 and r["context_usage"]["tokens_used"] == 20 for r in results[:-1]))
+
+        #each question gets the prompt a single query would have built
+        by_question = {messages[-1]["content"].split("Answer the following:")[-1]: messages for messages in server.chat_requests}
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url)
+            gpt.query("question 3", k=2, chat_history=gpt.new_chat_history())
+        self.assertEqual(server.chat_requests[0], by_question["question 3"])
+        self.assertEqual(results[3]["answer"], "echo: " + server.chat_requests[0][-1]["content"])
+
+        return
+
+    def test_batch_query_route(self):
+        from src.app import routes
+        from flask import Flask
+
+        with FakeOpenAIServer() as server:
+            store = SessionStore(lambda name: make_gpt(server.base_url, merged_index=True) if name == "Testgpt" else None)
+            app = Flask(__name__)
+            app.register_blueprint(routes.chat_blueprint, url_prefix="/chat")
+            with patch.object(routes, "session_store", store), app.test_client() as client:
+                response = client.post("/chat/batch_query", json={"gpt_name": "Testgpt", "queries": ["a", "b", "c"], "k": 3})
+                lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+                self.assertEqual(client.post("/chat/batch_query", json={"gpt_name": "nope", "queries": ["a"]}).status_code, 404)
+                #a string would otherwise be answered one character at a time
+                self.assertEqual([client.post("/chat/batch_query", json={"gpt_name": "Testgpt", "queries": queries}).status_code
+                                  for queries in ["abc", ["a", 1], None]], [400, 400, 400])
+
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual([(line["index"], line["query"]) for line in lines], [(0, "a"), (1, "b"), (2, "c")])
+        self.assertTrue(all(line["answer"].startswith("echo: Using this initial context") for line in lines))
+        #answering a batch doesn't start any conversations
+        self.assertEqual(store.stats()["sessions"]["count"], 0)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
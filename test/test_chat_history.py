@@ -0,0 +1,113 @@
+import unittest
+from src.service.chat_history import ChatHistory, MESSAGE_OVERHEAD_TOKENS
+from src.service.customGPT import CustomGPT
+from fake_openai_server import FakeOpenAIServer
+import test_chunking
+from unittest.mock import patch
+import sys
+
+def count_words(text : str) -> int:
+    return len(text.split())
+
+class MyTestCase(unittest.TestCase):
+
+    def test_unbounded_history_keeps_everything(self):
+        counted = []
+        history = ChatHistory("be brief", count_tokens=lambda text: counted.append(text) or count_words(text))
+        for i in range(50):
+            history.append("user", f"question {i}")
+        self.assertEqual(len(history), 51)
+        self.assertEqual(history[0], {"role": "system", "content": "be brief"})
+        #nothing is counted until the count is asked for, and then each message only once
+        self.assertEqual(counted, [])
+        self.assertEqual(history.token_count, 2 + 50 * 2 + 51 * MESSAGE_OVERHEAD_TOKENS)
+        history.token_count
+        self.assertEqual(len(counted), 51)
+
+        return
+
+    def test_sliding_window(self):
+        history = ChatHistory("be brief", max_tokens=60, count_tokens=count_words)
+        for i in range(100):
+            history.append("user", f"question number {i}")
+            history.append("assistant", f"answer {i}")
+            self.assertLessEqual(history.token_count, 60)
+
+        messages = history.messages()
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertEqual(messages[-1], {"role": "assistant", "content": "answer 99"})
+        self.assertEqual(messages[-2], {"role": "user", "content": "question number 99"})
+        #(60 - 6 for the system prompt) / 6 or 7 tokens per turn
+        self.assertEqual(len(messages), 9)
+
+        return
+
+    def test_messages_reuse_stored_dicts(self):
+        history = ChatHistory("be brief", max_tokens=100, count_tokens=count_words)
+        history.append("user", "one two three")
+        extra = {"role": "user", "content": "context " * 86}
+        first, second = history.messages(), history.messages(extra=[extra])
+        self.assertIs(first[1], second[1])
+        self.assertIs(second[-1], extra)
+
+        #turns are left out of the outgoing list to make room for the extra message, but stay in the history
+        self.assertEqual(history.messages(extra=[extra], reserve_tokens=count_words(extra["content"]) + MESSAGE_OVERHEAD_TOKENS), [first[0], extra])
+        self.assertEqual(len(history), 2)
+
+        return
+
+    def test_rolling_summary(self):
+        calls = []
+        def summarize(summary, messages):
+            calls.append((summary, [m["content"] for m in messages]))
+            return f"summary of {len(messages)} messages"
+
+        history = ChatHistory("be brief", max_tokens=40, count_tokens=count_words, summarize=summarize)
+        resized = []
+        history.on_resize = resized.append
+        for i in range(10):
+            history.append("user", f"question {i}")
+            self.assertLessEqual(history.token_count, 40)
+            #the running byte count follows dropped turns and replaced summaries
+            self.assertEqual(history.content_bytes, sum(sys.getsizeof(m["content"]) for m in history))
+        self.assertEqual(sum(resized), history.content_bytes - sys.getsizeof("be brief"))
+
+        messages = history.messages()
+        self.assertEqual(messages[1]["role"], "system")
+        self.assertTrue(messages[1]["content"].startswith("summary of"))
+        self.assertEqual(messages[-1]["content"], "question 9")
+        self.assertIsNone(calls[0][0])
+        #later summaries build on the previous one
+        self.assertEqual(calls[1][0], f"summary of {len(calls[0][1])} messages")
+
+        history.clear()
+        self.assertEqual(history.messages(), [{"role": "system", "content": "be brief"}])
+        self.assertEqual((history.content_bytes, sum(resized)), (sys.getsizeof("be brief"), 0))
+
+        return
+
+    def test_query_requests_stay_bounded(self):
+        with FakeOpenAIServer() as server:
+            client = CustomGPT(name="Testgpt",
+                               model="gpt-4-turbo",
+                               context_embedding_model="text-embedding-3-small",
+                               initial_role="be brief",
+                               initial_context="",
+                               history_max_tokens=400,
+                               summarize_history=True,
+                               api_key="test",
+                               base_url=server.base_url)
+            with patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding):
+                for i in range(20):
+                    client.query(f"question {i} " + "about curtain walls " * 5, retrieve_relevant_context=False)
+                    self.assertLessEqual(client.chat_history.token_count, 400)
+
+            sizes = [sum(len(m["content"]) for m in messages) for messages in server.chat_requests]
+            #the request size levels off instead of growing with every turn, and old turns are summarized
+            self.assertLess(max(sizes[-5:]), 2 * max(sizes[:5]) + 400)
+            self.assertTrue(any(m["content"].startswith("Summary of the earlier conversation") for m in client.chat_history))
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from src.service.chunking import chunk_text, chunk_token_spans, chunk_token_stream
+import tiktoken
+
+# byte-level encoding so the tests don't need to download a BPE file; every byte is one token
+encoding = tiktoken.Encoding(name="byte_level",
+                             pat_str=r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s""",
+                             mergeable_ranks={bytes([i]): i for i in range(256)},
+                             special_tokens={})
+
+text = "\n".join(" ".join(f"Sentence {p}.{s} has a handful of plain words in it." for s in range(6)) for p in range(20))
+
+class MyTestCase(unittest.TestCase):
+
+    def test_chunks_respect_size(self):
+        for chunk_size in [40, 100, 333]:
+            for chunk, n_tokens in chunk_token_spans(text, encoding, chunk_size):
+                self.assertLessEqual(n_tokens, chunk_size)
+                self.assertLessEqual(len(encoding.encode(chunk)), chunk_size)
+
+        return
+
+    def test_word_boundaries_preserve_text(self):
+        #without overlap the chunks should be the original words, in order, with nothing lost or split
+        chunks = chunk_text(text, encoding, 64)
+        self.assertEqual(" ".join(chunks).split(), text.split())
+
+        return
+
+    def test_sentence_and_paragraph_boundaries(self):
+        for chunk in chunk_text(text, encoding, 200, boundary="sentence"):
+            self.assertTrue(chunk.endswith("."))
+
+        paragraphs = text.split("\n")
+        for chunk in chunk_text(text, encoding, 800, boundary="paragraph"):
+            self.assertTrue(all(p in paragraphs for p in chunk.split("\n")))
+
+        return
+
+    def test_overlap(self):
+        chunks = chunk_text(text, encoding, 100, overlap=30)
+        for previous, current in zip(chunks, chunks[1:]):
+            #the start of each chunk repeats whole words from the end of the one before it
+            words = current.split()
+            self.assertTrue(any(" ".join(previous.split()).endswith(" " + " ".join(words[:n])) for n in range(1, len(words))))
+
+        self.assertRaises(ValueError, chunk_text, text, encoding, 100, 100)
+        self.assertRaises(ValueError, chunk_text, text, encoding, 100, 0, "chapter")
+
+        return
+
+    def test_empty_text(self):
+        self.assertEqual(chunk_text("", encoding), [])
+        self.assertEqual(chunk_text("   \n ", encoding), [])
+
+        return
+
+    def test_streamed_blocks(self):
+        paragraphs = text.split("\n")
+        for chunk_size, overlap, boundary in [(40, 0, "word"), (100, 30, "sentence"), (300, 0, "paragraph")]:
+            streamed = list(chunk_token_stream(enumerate(paragraphs, 1), encoding, chunk_size, overlap, boundary))
+            #cutting as the paragraphs arrive gives the same chunks as cutting the whole text
+            self.assertEqual([span[:2] for span in streamed], chunk_token_spans(text, encoding, chunk_size, overlap, boundary))
+            for chunk, _, (first, last) in streamed:
+                self.assertIn(chunk.split("\n")[0], paragraphs[first - 1])
+                self.assertIn(chunk.split("\n")[-1], paragraphs[last - 1])
+                self.assertEqual(last - first, chunk.count("\n"))
+
+        #chunks come out long before the last block has been read
+        read = []
+        def blocks():
+            for number in range(10_000):
+                read.append(number)
+                yield number, f"Page {number} has a few words on it."
+        stream = chunk_token_stream(blocks(), encoding, 50)
+        self.assertEqual(next(stream)[2], (0, 1))
+        self.assertLess(len(read), 20)
+
+        return
+
+    def test_multibyte_characters(self):
+        #with byte-level tokens a character may span several tokens; chunks are never cut inside one
+        paragraphs = [f"Größe {p}: naïve café façades — 日本語のテキスト {p} 🎉 ok." * 3 for p in range(30)]
+        whole = "\n".join(paragraphs)
+        for chunk_size, overlap, boundary in [(7, 0, "token"), (23, 5, "token"), (40, 0, "word"), (60, 20, "word")]:
+            spans = chunk_token_spans(whole, encoding, chunk_size, overlap, boundary)
+            streamed = list(chunk_token_stream(enumerate(paragraphs, 1), encoding, chunk_size, overlap, boundary))
+            self.assertEqual([span[:2] for span in streamed], spans)
+            for chunk, n_tokens in spans:
+                self.assertNotIn("\ufffd", chunk)
+                self.assertLessEqual(len(encoding.encode(chunk)), chunk_size)
+            if overlap == 0 and boundary == "token":
+                self.assertEqual("".join(chunk for chunk, _ in spans).replace("\n", "").replace(" ", ""),
+                                 whole.replace("\n", "").replace(" ", ""))
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
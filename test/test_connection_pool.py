@@ -0,0 +1,94 @@
+import unittest
+from src.data.connection_pool import sqlite_connection_pool, get_pool, close_pool
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import tempfile
+import os
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.tmp_dir.name, "pool.db")
+        self.pool = sqlite_connection_pool(self.db_name, max_connections=4)
+        with self.pool.transaction(write=True) as cursor:
+            cursor.execute('''CREATE TABLE item (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)''')
+
+    def tearDown(self):
+        self.pool.close()
+        self.tmp_dir.cleanup()
+
+    def count(self) -> int:
+        with self.pool.transaction() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM item''')
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.execute('''PRAGMA journal_mode''').fetchone()[0], "wal")
+            self.assertEqual(conn.execute('''PRAGMA foreign_keys''').fetchone()[0], 1)
+            self.assertEqual(conn.execute('''PRAGMA synchronous''').fetchone()[0], 1)
+
+        return
+
+    def test_nested_transactions_share_one_connection(self):
+        with self.pool.transaction(write=True) as outer:
+            outer.execute('''INSERT INTO item (value) VALUES (1)''')
+            with self.pool.transaction(write=True) as inner:
+                self.assertIs(inner.connection, outer.connection)
+                inner.execute('''INSERT INTO item (value) VALUES (2)''')
+            #the inner block doesn't commit on its own
+            self.assertTrue(outer.connection.in_transaction)
+        self.assertEqual(self.count(), 2)
+
+        return
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.transaction(write=True) as cursor:
+                cursor.execute('''INSERT INTO item (value) VALUES (1)''')
+                with self.pool.transaction(write=True) as inner:
+                    inner.execute('''INSERT INTO item (value) VALUES (2)''')
+                raise RuntimeError("fail halfway")
+        self.assertEqual(self.count(), 0)
+
+        return
+
+    def test_concurrent_writers(self):
+        def write(i):
+            with self.pool.transaction(write=True) as cursor:
+                cursor.execute('''INSERT INTO item (value) VALUES (?)''', (i,))
+            return self.count()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(write, range(200)))
+        self.assertEqual(self.count(), 200)
+        self.assertLessEqual(self.pool._opened, 4)
+
+        return
+
+    def test_checkpoint(self):
+        with self.pool.transaction(write=True) as cursor:
+            cursor.executemany('''INSERT INTO item (value) VALUES (?)''', [(i,) for i in range(100)])
+        self.assertGreater(os.path.getsize(self.db_name + "-wal"), 0)
+        self.pool.checkpoint()
+
+        #the database file alone now holds every committed row, as a copy committed to git would
+        self.assertEqual(os.path.getsize(self.db_name + "-wal"), 0)
+        copy = os.path.join(self.tmp_dir.name, "copy.db")
+        with open(self.db_name, "rb") as source, open(copy, "wb") as target:
+            target.write(source.read())
+        conn = sqlite3.connect(copy)
+        self.assertEqual(conn.execute('''SELECT COUNT(*) FROM item''').fetchone()[0], 100)
+        conn.close()
+
+        return
+
+    def test_shared_pools(self):
+        self.assertIs(get_pool(self.db_name), get_pool(os.path.join(self.tmp_dir.name, ".", "pool.db")))
+        close_pool(self.db_name)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,7 +27,7 @@ class MyTestCase(unittest.TestCase):
 
     def test_read_write_contexts(self):
 
-        db = context_db_connection(db_name)
+        db = context_db_connection(db_name, migrate=True)  # Test_7.db predates the schema migrations
         db.initialize_with_entries()
 
         #context = client.add_context_from_docx("Test_1", "..//documents//curtainwall101.docx")
@@ -61,7 +61,7 @@ class MyTestCase(unittest.TestCase):
         context_docs=[f"test_{i}" for i in range(10)]
 
         #test deleting by id
-        db = context_db_connection(db_name)
+        db = context_db_connection(db_name, migrate=True)  # Test_7.db predates the schema migrations
 
         client.clear_contexts()
         test_contexts : list[Context]=[client.add_context_from_docx(context_doc, f"..//documents//testing//{context_doc}.docx") for context_doc in context_docs]
@@ -92,7 +92,7 @@ class MyTestCase(unittest.TestCase):
 
     def test_read_write_custom_gpts(self):
         # test writing and reading of custom gpt objects
-        db = context_db_connection(db_name)
+        db = context_db_connection(db_name, migrate=True)  # Test_7.db predates the schema migrations
 
         context_docs=[f"test_{i}" for i in range(10)]
         test_contexts : list[Context]=[client.add_context_from_docx(context_doc, f"..//documents//testing//{context_doc}.docx") for context_doc in context_docs]
@@ -0,0 +1,298 @@
+import unittest
+from src.data.context_database import context_db_connection, embeddings_from_rows, vector_to_db, SCHEMA_MIGRATIONS
+from src.service.context import Context
+from src.service.customGPT import CustomGPT
+import numpy as np
+import sqlite3
+from src.data.connection_pool import close_pool
+import tempfile
+import faiss
+import os
+
+os.environ.setdefault("API_KEY", "test") #read_custom_gpt_by_name creates clients with this key; no requests are made
+
+def random_embeddings(n : int, d : int = 32, seed : int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    return [[f"chunk {i}", rng.standard_normal(d).astype("float32")] for i in range(n)]
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.tmp_dir.name, "test.db")
+        self.db = context_db_connection(self.db_name, faiss_dir=self.tmp_dir.name)
+        self.db.initialize_with_entries()
+
+    def tearDown(self):
+        close_pool(self.db_name)
+        self.tmp_dir.cleanup()
+
+    def insert_context(self, name : str, embeddings : list, as_text : bool) -> int:
+        #write rows directly so the test doesn't write index files into the repository's faiss folder
+        faiss_file = os.path.join(self.tmp_dir.name, f"{name}.faiss")
+        faiss.write_index(Context(name, "doc.docx", embeddings).index, faiss_file)
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO context (name, origin_filename, faiss_index_filename) VALUES (?, ?, ?)''', (name, "doc.docx", faiss_file))
+        context_id = cursor.lastrowid
+        cursor.executemany('''INSERT INTO context_embeddings (context_id, chunk_index, chunk_text, embedding_vector) VALUES (?, ?, ?, ?)''',
+                           [(context_id, i, text, ",".join(map(str, vector)) if as_text else vector_to_db(vector)) for i, (text, vector) in enumerate(embeddings)])
+        conn.commit()
+        conn.close()
+        return context_id
+
+    def test_blob_round_trip_is_exact(self):
+        embeddings = random_embeddings(50)
+        context_id = self.insert_context("blob", embeddings, as_text=False)
+
+        read_context = self.db.read_context_by_id(context_id)
+        self.assertEqual([e[0] for e in read_context.embeddings], [e[0] for e in embeddings])
+        for (_, written), (_, read) in zip(embeddings, read_context.embeddings):
+            np.testing.assert_array_equal(written, read)
+
+        #all vectors are views into one contiguous matrix
+        base = read_context.embeddings[0][1].base
+        self.assertTrue(all(e[1].base is base for e in read_context.embeddings))
+
+        return
+
+    def test_migrate_embeddings_to_blob(self):
+        embeddings = random_embeddings(30)
+        context_id = self.insert_context("legacy", embeddings, as_text=True)
+        legacy_context = self.db.read_context_by_id(context_id)
+
+        self.assertEqual(self.db.migrate_embeddings_to_blob(), 30)
+        self.assertEqual(self.db.migrate_embeddings_to_blob(), 0)
+
+        conn = sqlite3.connect(self.db_name)
+        types = conn.execute('''SELECT DISTINCT typeof(embedding_vector) FROM context_embeddings''').fetchall()
+        conn.close()
+        self.assertEqual(types, [("blob",)])
+
+        migrated_context = self.db.read_context_by_id(context_id)
+        for (_, legacy), (_, migrated) in zip(legacy_context.embeddings, migrated_context.embeddings):
+            np.testing.assert_array_equal(legacy, migrated)
+
+        return
+
+    def test_mmap_indexes(self):
+        embeddings = random_embeddings(40)
+        context_id = self.insert_context("mmap", embeddings, as_text=False)
+        in_memory = self.db.read_context_by_id(context_id)
+        mapped = context_db_connection(self.db_name, mmap_indexes=True).read_context_by_id(context_id)
+
+        #only chunk texts are held in Python; the vectors are in the mapped index
+        self.assertTrue(mapped.mmap)
+        self.assertIsNone(mapped.embeddings)
+        self.assertEqual(mapped.chunks, [e[0] for e in embeddings])
+        self.assertEqual(mapped.get_vectors().shape, (40, 32))
+
+        query_vector = np.random.default_rng(1).standard_normal(32)
+        self.assertEqual(mapped.query_similar(query_vector, k=5), in_memory.query_similar(query_vector, k=5))
+        self.assertTrue(mapped == in_memory)
+
+        return
+
+    def test_write_context(self):
+        embeddings = random_embeddings(500)
+        context_id = self.db.write_context(Context("written", "doc.docx", embeddings))
+
+        read_context = self.db.read_context_by_id(context_id)
+        self.assertEqual(read_context.chunks, [e[0] for e in embeddings])
+        self.assertEqual(read_context.index.ntotal, 500)
+        #only the final index file is left behind
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["test.db", "test.db-shm", "test.db-wal", "written.faiss"])
+
+        return
+
+    def test_index_spec_is_persisted(self):
+        embeddings = random_embeddings(500)
+        context = Context("hnsw_context", "doc.docx", embeddings, index_spec="hnsw:M=16,efSearch=100", metric="cosine")
+        context_id = self.db.write_context(context)
+
+        for mmap in [False, True]:
+            read_context = context_db_connection(self.db_name, mmap_indexes=mmap).read_context_by_id(context_id)
+            self.assertEqual((read_context.index_spec, read_context.metric), ("hnsw:M=16,efSearch=100", "cosine"))
+            self.assertEqual(read_context.index.metric_type, faiss.METRIC_INNER_PRODUCT)
+            self.assertIsInstance(read_context.index, faiss.IndexHNSWFlat)
+            self.assertEqual(read_context.index.hnsw.efSearch, 100)
+            self.assertTrue(read_context == context)
+
+        return
+
+    def test_token_counts(self):
+        embeddings = random_embeddings(20)
+        context = Context("counted", "doc.docx", embeddings, token_counts=list(range(10, 30)))
+        counted_id = self.db.write_context(context)
+        uncounted_id = self.db.write_context(Context("uncounted", "doc.docx", embeddings))
+
+        for mmap in [False, True]:
+            db = context_db_connection(self.db_name, mmap_indexes=mmap)
+            self.assertEqual(db.read_context_by_id(counted_id).token_counts, list(range(10, 30)))
+            self.assertEqual(db.read_context_by_id(uncounted_id).token_counts, [None] * 20)
+
+        self.assertEqual(self.db.backfill_token_counts(lambda text: len(text)), 20)
+        self.assertEqual(self.db.read_context_by_id(uncounted_id).token_counts, [len(chunk) for chunk, _ in embeddings])
+        self.assertEqual(self.db.backfill_token_counts(lambda text: len(text)), 0)
+
+        return
+
+    def test_write_custom_gpt_is_atomic(self):
+        def new_gpt(context_names):
+            gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                            initial_role="", initial_context="", api_key="test")
+            for i, name in enumerate(context_names):
+                gpt.add_context(Context(name, "doc.docx", random_embeddings(20, seed=i)))
+            return gpt
+
+        self.db.write_custom_gpt(new_gpt(["first"]))
+
+        #writing a second GPT with the same name fails on the custom_gpt insert, after its new context was written
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.write_custom_gpt(new_gpt(["first", "second"]))
+
+        self.assertIsNone(self.db.read_context_by_name("second"))
+        self.assertFalse(any(f.startswith("second") for f in os.listdir(self.tmp_dir.name)))
+        conn = sqlite3.connect(self.db_name)
+        self.assertEqual(conn.execute('''SELECT COUNT(*) FROM context_embeddings''').fetchone()[0], 20)
+        self.assertEqual(conn.execute('''SELECT COUNT(*) FROM gpt_context''').fetchone()[0], 1)
+        conn.close()
+
+        read_gpt = self.db.read_custom_gpt_by_name("Testgpt")
+        self.assertEqual(list(read_gpt.contexts), ["first"])
+
+        return
+
+    def test_read_custom_gpt_runs_constant_queries(self):
+        gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                        initial_role="", initial_context="", api_key="test")
+        for i in range(8):
+            gpt.add_context(Context(f"context_{i}", "doc.docx", random_embeddings(10, seed=i)))
+        self.db.write_custom_gpt(gpt)
+
+        statements = []
+        with self.db.pool.connection() as conn:
+            conn.set_trace_callback(statements.append)
+            read_gpt = self.db.read_custom_gpt_by_name("Testgpt")
+            conn.set_trace_callback(None)
+
+        self.assertEqual(sorted(read_gpt.contexts), sorted(gpt.contexts))
+        for name in gpt.contexts:
+            self.assertTrue(read_gpt.contexts[name] == gpt.contexts[name])
+        self.assertEqual(len([s for s in statements if s.lstrip().upper().startswith("SELECT")]), 3)
+
+        #chunk lookups go through the context_id index rather than scanning the table
+        plan = " ".join(str(row) for row in conn.execute('''EXPLAIN QUERY PLAN SELECT chunk_text FROM context_embeddings WHERE context_id = 1 ORDER BY chunk_index'''))
+        self.assertIn("idx_context_embeddings_context_id", plan)
+
+        return
+
+    def create_legacy_database(self, db_name : str) -> None:
+        #a database created before the migrations existed has no indexes and user_version 0
+        conn = sqlite3.connect(db_name)
+        conn.executescript('''CREATE TABLE custom_gpt (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, model TEXT NOT NULL, context_embedding_model TEXT NOT NULL, initial_role TEXT, initial_context TEXT);
+                              CREATE TABLE context (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, origin_filename TEXT NOT NULL, faiss_index_filename TEXT NOT NULL);
+                              CREATE TABLE context_embeddings (id INTEGER PRIMARY KEY AUTOINCREMENT, context_id INTEGER NOT NULL, chunk_index INTEGER NOT NULL, chunk_text TEXT NOT NULL, embedding_vector TEXT NOT NULL);
+                              CREATE TABLE gpt_context (id INTEGER PRIMARY KEY AUTOINCREMENT, gpt_id INTEGER NOT NULL, context_id INTEGER NOT NULL);''')
+        conn.close()
+        return
+
+    def test_migrate_existing_database(self):
+        legacy_db = os.path.join(self.tmp_dir.name, "legacy.db")
+        self.create_legacy_database(legacy_db)
+
+        #opening it doesn't change its schema; migrating has to be asked for
+        def schema():
+            conn = sqlite3.connect(legacy_db)
+            rows = conn.execute('''SELECT type, name, sql FROM sqlite_master ORDER BY name''').fetchall() + conn.execute('''PRAGMA user_version''').fetchall()
+            conn.close()
+            return rows
+        legacy_schema = schema()
+        with self.assertRaisesRegex(RuntimeError, "schema version 0"):
+            context_db_connection(legacy_db)
+        self.assertEqual(schema(), legacy_schema)
+
+        context_db_connection(legacy_db, migrate=True)
+        conn = sqlite3.connect(legacy_db)
+        self.assertEqual(conn.execute('''PRAGMA user_version''').fetchone()[0], len(SCHEMA_MIGRATIONS))
+        indexes = [row[0] for row in conn.execute('''SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%' ''')]
+        conn.close()
+        self.assertIn("idx_gpt_context_gpt_id", indexes)
+        self.assertEqual(context_db_connection(legacy_db).migrate(), 0)
+        close_pool(legacy_db)
+
+        return
+
+    def test_servers_check_schema_at_startup(self):
+        from src.app import state
+        from src.app.app import create_app
+        from src.app.asgi import create_asgi_app
+        from unittest.mock import patch
+        import asyncio
+
+        legacy_db = os.path.join(self.tmp_dir.name, "legacy.db")
+        self.create_legacy_database(legacy_db)
+
+        def start_asgi_app() -> dict:
+            messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+            sent = []
+            async def receive():
+                return messages.pop(0)
+            async def send(message):
+                sent.append(message)
+            asyncio.run(create_asgi_app()({"type": "lifespan"}, receive, send))
+            return sent[0]
+
+        with patch.object(state, "db_path", legacy_db):
+            #both servers refuse to start on an unmigrated database, and say how to migrate it
+            with self.assertRaisesRegex(RuntimeError, "src.data.context_database .*legacy.db migrate"):
+                create_app(preload=False, reload_interval=0)
+            failed = start_asgi_app()
+            self.assertEqual(failed["type"], "lifespan.startup.failed")
+            self.assertIn("migrate", failed["message"])
+
+            context_db_connection(legacy_db, migrate=True)
+            create_app(preload=False, reload_interval=0)
+            self.assertEqual(start_asgi_app()["type"], "lifespan.startup.complete")
+        close_pool(legacy_db)
+
+        return
+
+    def test_gpt_generation_tracks_changes(self):
+        gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                        initial_role="", initial_context="", api_key="test")
+        gpt.add_context(Context("linked", "doc.docx", random_embeddings(10)))
+        self.db.write_custom_gpt(gpt)
+        unlinked_id = self.db.write_context(Context("unlinked", "doc.docx", random_embeddings(10, seed=1)))
+
+        generation = self.db.read_custom_gpt_by_name("Testgpt").generation
+        self.assertEqual(self.db.get_gpt_generations(), {"Testgpt": generation})
+
+        def changes(statement : str, params : tuple = ()) -> int:
+            before = self.db.get_gpt_generations()["Testgpt"]
+            with self.db.transaction(write=True) as cursor:
+                cursor.execute(statement, params)
+            return self.db.get_gpt_generations()["Testgpt"] - before
+
+        self.assertEqual(changes('''UPDATE context_embeddings SET chunk_text = 'edited' WHERE context_id = ? ''', (unlinked_id,)), 0)
+        self.assertEqual(changes('''UPDATE context_embeddings SET chunk_text = 'edited' WHERE context_id != ? AND chunk_index = 0''', (unlinked_id,)), 1)
+        self.assertEqual(changes('''UPDATE context_embeddings SET token_count = 3'''), 0)
+        self.assertEqual(changes('''UPDATE custom_gpt SET initial_role = 'be brief' '''), 1)
+        self.assertEqual(changes('''INSERT INTO gpt_context (gpt_id, context_id) VALUES (1, ?)''', (unlinked_id,)), 1)
+        self.assertGreater(changes('''DELETE FROM context WHERE name = 'linked' '''), 0)
+
+        read_gpt = self.db.read_custom_gpt_by_name("Testgpt")
+        self.assertEqual(read_gpt.generation, self.db.get_gpt_generations()["Testgpt"])
+        self.assertEqual(list(read_gpt.contexts), ["unlinked"])
+
+        return
+
+    def test_embeddings_from_rows(self):
+        self.assertEqual(embeddings_from_rows([]), [])
+        rows = [("a", vector_to_db([1, 2])), ("b", "3,4")]
+        self.assertEqual([list(e[1]) for e in embeddings_from_rows(rows)], [[1, 2], [3, 4]])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
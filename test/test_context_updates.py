@@ -0,0 +1,205 @@
+import unittest
+from src.data.context_database import context_db_connection
+from src.data.connection_pool import close_pool
+from src.service.context import Context
+from src.service.index_spec import normalize
+from src.service.customGPT import CustomGPT
+from fake_openai_server import FakeOpenAIServer, fake_embedding
+from unittest.mock import patch
+import test_chunking
+import numpy as np
+import sqlite3
+import tempfile
+import os
+
+def random_embeddings(n : int, d : int = 32, seed : int = 0, prefix : str = "chunk") -> list:
+    rng = np.random.default_rng(seed)
+    return [[f"{prefix} {i}", rng.standard_normal(d).astype("float32")] for i in range(n)]
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.tmp_dir.name, "test.db")
+        self.db = context_db_connection(self.db_name, faiss_dir=self.tmp_dir.name)
+        self.db.initialize_with_entries()
+
+    def tearDown(self):
+        close_pool(self.db_name)
+        self.tmp_dir.cleanup()
+
+    def test_edits_match_a_rebuilt_context(self):
+        embeddings = random_embeddings(400)
+        new = random_embeddings(30, seed=1, prefix="new")
+        replacements = random_embeddings(5, seed=2, prefix="replacement")
+        for spec in ["flat", "ivf", "hnsw"]:
+            context = Context("ctx", "doc.docx", embeddings, index_spec=spec, metric="cosine", token_counts=[3] * 400)
+            added = context.add_chunks(new, [4] * 30)
+            context.remove_chunks(range(0, 400, 2))
+            context.replace_chunks([1, 3, 5, 7, 9], replacements)
+
+            self.assertEqual(added, list(range(400, 430)))
+            self.assertEqual(context.index.ntotal, 230)
+            self.assertEqual(context.chunk_ids[:3], [1, 3, 5])
+            self.assertEqual(context.chunks[:6], [e[0] for e in replacements] + ["chunk 11"])
+            self.assertEqual(context.token_counts[:5] + context.token_counts[-1:], [None] * 5 + [4])
+            self.assertRaises(ValueError, context.remove_chunks, [0])
+
+            #each chunk is found under its stable id, with the text, vector and token count it has now
+            for chunk_id in [1, 11, 399, 415]:
+                position = context.chunk_position(chunk_id)
+                hit = context.search(context.embeddings[position][1], 1)[0]
+                self.assertEqual((hit.chunk_id, hit.text, hit.token_count),
+                                 (chunk_id, context.chunks[position], context.token_counts[position]))
+            np.testing.assert_allclose(context.get_chunk_vectors([415]), [new[15][1]])
+
+            #and exact search ranks them as a context built from scratch would
+            if spec == "flat":
+                rebuilt = Context("ctx", "doc.docx", context.embeddings, metric="cosine")
+                query = random_embeddings(1, seed=3)[0][1]
+                self.assertEqual([(context.chunk_ids[rebuilt.chunk_position(h.chunk_id)], h.text) for h in rebuilt.search(query, 10)],
+                                 [(h.chunk_id, h.text) for h in context.search(query, 10)])
+
+        return
+
+    def test_edit_memory_mapped_context(self):
+        embeddings = random_embeddings(50)
+        written = Context("mapped", "doc.docx", embeddings)
+        self.db.write_context(written)
+        index_file = os.path.join(self.tmp_dir.name, "mapped.faiss")
+        on_disk = open(index_file, "rb").read()
+
+        reader = context_db_connection(self.db_name, mmap_indexes=True, faiss_dir=self.tmp_dir.name)
+        context = reader.read_context_by_name("mapped")
+        self.assertTrue(context.mmap)
+        context.remove_chunks([0, 1])
+        added = context.add_chunks(random_embeddings(3, seed=1, prefix="new"))
+
+        #the index was copied into memory before being edited, leaving the mapped file alone
+        self.assertFalse(context.mmap)
+        self.assertEqual(open(index_file, "rb").read(), on_disk)
+        self.assertIsNone(context.embeddings)
+        self.assertEqual(context.search(embeddings[5][1], 1)[0].text, "chunk 5")
+        reader.update_context_chunks(context, added=added, removed=[0, 1])
+        self.assertEqual(self.db.read_context_by_name("mapped").chunks, [f"chunk {i}" for i in range(2, 50)] + ["new 0", "new 1", "new 2"])
+
+        return
+
+    def test_update_context_chunks(self):
+        context = Context("ctx", "doc.docx", random_embeddings(20), index_spec="hnsw", sources=[(i, i) for i in range(20)])
+        context_id = self.db.write_context(context)
+        gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                        initial_role="", initial_context="", api_key="test")
+        gpt.add_context(context)
+        self.db.write_custom_gpt(gpt)
+        generation = self.db.get_gpt_generations()["Testgpt"]
+        conn = sqlite3.connect(self.db_name)
+        row_ids = dict(conn.execute('''SELECT chunk_index, id FROM context_embeddings'''))
+
+        added = context.add_chunks(random_embeddings(2, seed=1, prefix="new"), [7, 7], [(20, 21), (21, 21)])
+        context.remove_chunks([4, 5])
+        context.replace_chunks([6], random_embeddings(1, seed=2, prefix="replacement"), [9], [(6, 7)])
+        context.set_chunk_sources({7: (8, 8)})
+        #ids as numpy integers, as they come out of FAISS, are bound like Python ones
+        self.assertEqual(self.db.update_context_chunks(context, added=np.array(added, dtype="int64"), removed=np.array([4, 5], dtype="int64"),
+                                                       replaced=[np.int64(6)], moved=[np.int64(7)]), context_id)
+
+        #untouched chunks keep their rows
+        self.assertEqual({i: row_ids[i] for i in range(20) if i not in (4, 5)},
+                         dict(conn.execute('''SELECT chunk_index, id FROM context_embeddings WHERE chunk_index < 20''')))
+        conn.close()
+        self.assertGreater(self.db.get_gpt_generations()["Testgpt"], generation)
+
+        for reader in [self.db, context_db_connection(self.db_name, mmap_indexes=True, faiss_dir=self.tmp_dir.name)]:
+            stored = reader.read_context_by_id(context_id)
+            self.assertEqual(stored.chunk_ids, context.chunk_ids)
+            self.assertEqual(stored.chunks, context.chunks)
+            self.assertEqual(stored.sources, context.sources)
+            self.assertEqual(stored.token_counts[4:6], [9, None])
+            np.testing.assert_allclose(normalize(stored.get_vectors()), normalize(context.get_vectors()), atol=1e-6)
+            hit = stored.search(context.get_chunk_vectors([21])[0], 1)[0]
+            self.assertEqual((hit.chunk_id, hit.text, hit.source), (21, "new 1", (21, 21)))
+
+        context.add_chunks(random_embeddings(1, seed=3, prefix="unsaved"))
+        context.name = "missing"
+        self.assertRaises(ValueError, self.db.update_context_chunks, context, added=[22])
+
+        return
+
+    def test_reload_between_commit_and_index_rename(self):
+        gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                        initial_role="", initial_context="", api_key="test")
+        context = Context("ctx", "doc.docx", random_embeddings(20))
+        gpt.add_context(context)
+        self.db.write_custom_gpt(gpt)
+        added = context.add_chunks(random_embeddings(2, seed=1, prefix="new"))
+
+        #another server sees the committed rows and their generation, but the index file hasn't been replaced yet
+        server = context_db_connection(self.db_name, faiss_dir=self.tmp_dir.name)
+        replace = os.replace
+        def reload_then_replace(source, destination):
+            reloads.append((server.get_gpt_generations()["Testgpt"], server.read_custom_gpt_by_name("Testgpt")))
+            replace(source, destination)
+        reloads = []
+        with patch("src.data.context_database.os.replace", reload_then_replace):
+            self.db.update_context_chunks(context, added=added)
+        generation, stale = reloads[0]
+        self.assertEqual(len(stale.contexts["ctx"].chunks), 22)
+        self.assertEqual(stale.contexts["ctx"].index.ntotal, 20)
+
+        #so the generation moves again once it has been, and the next check reloads a consistent copy
+        self.assertGreater(server.get_gpt_generations()["Testgpt"], generation)
+        self.assertEqual(server.read_custom_gpt_by_name("Testgpt").contexts["ctx"].index.ntotal, 22)
+
+        return
+
+    def test_customgpt_update_context(self):
+        texts = [f"chunk {i} about curtain walls" for i in range(10)]
+        #count tokens with a byte-level encoding so the test doesn't need to download one
+        with FakeOpenAIServer() as server, patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding):
+            gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                            initial_role="", initial_context="", api_key="test", base_url=server.base_url,
+                            merged_index=True, answer_cache_size=4)
+            gpt.add_context(Context("walls", "doc.docx", [[text, fake_embedding(text)] for text in texts], token_counts=[6] * 10))
+            gpt.query("chunk 3 about curtain walls", chat_history=gpt.new_chat_history())
+
+            #invalid edits are refused before anything is embedded or changed
+            requests = len(server.requests)
+            for edit in [{"add": ["new"], "remove": [0, 0]}, {"add": ["new"], "replace": {2: "two"}, "remove": [2]},
+                         {"add": ["new"], "replace": {99: "unknown"}}, {"remove": range(10)}]:
+                self.assertRaises(ValueError, gpt.update_context, "walls", **edit)
+            self.assertEqual((len(server.requests), gpt.contexts["walls"].chunks), (requests, texts))
+
+            added = gpt.update_context("walls", add=["anchors are stainless"], remove=np.array([0, 1]), replace={3: "chunk 3 about roofs"})
+            self.assertRaises(ValueError, gpt.update_context, "walls", remove=[0])
+
+        #only the new texts were embedded, in one request
+        self.assertEqual(server.requests[-1], ["anchors are stainless", "chunk 3 about roofs"])
+        self.assertEqual(added, [10])
+        self.assertEqual(len(gpt.answer_cache), 0)
+        hits = gpt.merged_index.search(fake_embedding("chunk 3 about roofs"), 1) + gpt.merged_index.search(fake_embedding("anchors are stainless"), 1)
+        self.assertEqual([(hit.chunk_id, hit.text) for hit in hits], [(3, "chunk 3 about roofs"), (10, "anchors are stainless")])
+        self.assertEqual(len(gpt.merged_index), 9)
+
+        return
+
+    def test_edited_vectors_are_stored_as_embedded(self):
+        #enough vectors to train PQ codebooks, whose reconstructed vectors are approximate
+        self.db.write_context(Context("big", "doc.docx", random_embeddings(10000, d=64), index_spec="ivfpq:nlist=16,m=8"))
+        reader = context_db_connection(self.db_name, mmap_indexes=True, faiss_dir=self.tmp_dir.name)
+        with FakeOpenAIServer() as server, patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding):
+            gpt = CustomGPT(name="Testgpt", model="gpt-4-turbo", context_embedding_model="text-embedding-3-small",
+                            initial_role="", initial_context="", api_key="test", base_url=server.base_url)
+            gpt.add_context(reader.read_context_by_name("big"))
+            vectors = {}
+            added = gpt.update_context("big", add=["anchors are stainless"], replace={5: "chunk 5 about roofs"}, vectors=vectors)
+        reader.update_context_chunks(gpt.contexts["big"], added=added, replaced=[5], vectors=vectors)
+
+        stored = self.db.read_context_by_name("big")
+        for chunk_id, text in [(5, "chunk 5 about roofs"), (10000, "anchors are stainless")]:
+            np.testing.assert_array_equal(stored.get_chunk_vectors([chunk_id])[0], fake_embedding(text))
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
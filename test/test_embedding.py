@@ -0,0 +1,149 @@
+import unittest
+from src.service.embedding import batch_ranges, embed_chunks, QueryEmbeddingCache
+from src.service.customGPT import CustomGPT
+from src.service.context import Context
+from fake_openai_server import FakeOpenAIServer, fake_embedding
+from openai import OpenAI
+import numpy as np
+import test_chunking
+from unittest.mock import patch
+
+chunks = [f"chunk number {i} about curtain wall anchors" for i in range(100)]
+
+class MyTestCase(unittest.TestCase):
+
+    def test_batch_ranges(self):
+        self.assertEqual(batch_ranges([10] * 10, max_inputs=4), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(batch_ranges([10, 10, 25, 5, 30], max_inputs=10, max_tokens=30), [(0, 2), (2, 4), (4, 5)])
+        #a single chunk over the token budget still gets its own batch
+        self.assertEqual(batch_ranges([50, 5], max_tokens=30), [(0, 1), (1, 2)])
+        self.assertEqual(batch_ranges([]), [])
+
+        return
+
+    def test_embed_chunks_matches_serial_output(self):
+        with FakeOpenAIServer(latency=0.05) as server:
+            client = OpenAI(api_key="test", base_url=server.base_url)
+            embeddings = embed_chunks(client, chunks, "text-embedding-3-small", token_counts=[8] * len(chunks),
+                                      max_inputs=16, max_concurrency=3)
+
+            #same [chunk, vector] pairs, in the same order, as one request per chunk would give
+            self.assertEqual([e[0] for e in embeddings], chunks)
+            for chunk, vector in embeddings:
+                self.assertEqual(vector.dtype, np.float32)
+                np.testing.assert_allclose(vector, fake_embedding(chunk))
+
+            self.assertEqual(len(server.requests), 7)
+            self.assertTrue(all(len(inputs) <= 16 for inputs in server.requests))
+            self.assertLessEqual(server.max_in_flight, 3)
+            self.assertGreater(server.max_in_flight, 1)
+
+        return
+
+    def test_embed_chunks_retries_rate_limits(self):
+        with FakeOpenAIServer(rate_limit_first=3) as server:
+            client = OpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+            embeddings = embed_chunks(client, chunks[:10], "text-embedding-3-small", token_counts=[8] * 10,
+                                      max_concurrency=1, initial_backoff=0.01)
+            self.assertEqual(len(embeddings), 10)
+            self.assertEqual(server.rate_limit_first, 0)
+
+        return
+
+    def test_add_context_from_text(self):
+        with FakeOpenAIServer() as server:
+            client = CustomGPT(name="Testgpt",
+                               model="gpt-4-turbo",
+                               context_embedding_model="text-embedding-3-small",
+                               initial_role="",
+                               initial_context="",
+                               embedding_batch_size=4,
+                               api_key="test",
+                               base_url=server.base_url)
+            #chunk on a byte-level encoding so the test doesn't need to download one
+            with patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding):
+                context = client.add_context_from_text("test", "test.txt", test_chunking.text, chunk_size=200)
+
+            self.assertIsInstance(context, Context)
+            self.assertEqual(context.index.ntotal, len(context.embeddings))
+            self.assertTrue(all(len(inputs) <= 4 for inputs in server.requests))
+
+        return
+
+    def test_query_embedding_cache(self):
+        cache = QueryEmbeddingCache(max_entries=2, ttl=60)
+        vector = np.ones(4, dtype="float32")
+        self.assertIsNone(cache.get("model", "a"))
+        cache.put("model", "a", vector)
+        cache.put("model", "b", vector)
+        self.assertIs(cache.get("model", "a"), vector)
+        self.assertIsNone(cache.get("other-model", "a"))
+
+        #"b" is now least recently used so it is evicted first
+        cache.put("model", "c", vector)
+        self.assertIsNone(cache.get("model", "b"))
+        self.assertIsNotNone(cache.get("model", "a"))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 3, "size": 2, "max_entries": 2})
+
+        expired = QueryEmbeddingCache(ttl=0)
+        expired.put("model", "a", vector)
+        self.assertIsNone(expired.get("model", "a"))
+
+        return
+
+    def test_query_embeds_once(self):
+        with FakeOpenAIServer() as server:
+            client = CustomGPT(name="Testgpt",
+                               model="gpt-4-turbo",
+                               context_embedding_model="text-embedding-3-small",
+                               initial_role="",
+                               initial_context="",
+                               api_key="test",
+                               base_url=server.base_url)
+            for i in range(4):
+                client.add_context(Context(f"context_{i}", "test.txt", embed_chunks(client, chunks[i * 10:(i + 1) * 10], "text-embedding-3-small", [8] * 10)))
+            server.requests.clear()
+
+            with patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding):
+                client.query("What anchors a curtain wall?")
+                self.assertEqual(server.requests, [["What anchors a curtain wall?"]])
+
+                #asking again is answered from the cache without another embeddings request
+                client.query("What anchors a curtain wall?")
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(client.query_embedding_cache.stats()["hits"], 1)
+
+        return
+
+    def test_query_packs_chunks_within_token_budget(self):
+        with FakeOpenAIServer() as server:
+            client = CustomGPT(name="Testgpt",
+                               model="gpt-4-turbo",
+                               context_embedding_model="text-embedding-3-small",
+                               initial_role="",
+                               initial_context="",
+                               context_token_budget=250,
+                               api_key="test",
+                               base_url=server.base_url)
+            with patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding) as encoding_for_model:
+                context = client.add_context_from_text("test", "test.txt", test_chunking.text, chunk_size=100)
+                #counts are of the token span before surrounding whitespace is stripped, so never below the chunk's own count
+                for chunk, n_tokens in zip(context.chunks, context.token_counts):
+                    self.assertTrue(0 <= n_tokens - len(test_chunking.encoding.encode(chunk)) <= 2)
+
+                #counts from ingestion are used, so the query doesn't tokenize anything
+                encoding_for_model.reset_mock()
+                usage = {}
+                client.query("What anchors a curtain wall?", k=5, context_usage=usage)
+                encoding_for_model.assert_not_called()
+
+            self.assertLessEqual(usage["tokens_used"], 250)
+            self.assertEqual(usage["chunks_used"] + usage["chunks_dropped"], 5)
+            self.assertGreater(usage["tokens_dropped"], 0)
+            prompt = server.chat_requests[-1][-1]["content"]
+            self.assertEqual(prompt.count("from test: "), usage["chunks_used"])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
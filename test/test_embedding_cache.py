@@ -0,0 +1,71 @@
+import unittest
+from src.data.embedding_cache import embedding_cache_db_connection
+from src.service.embedding import embed_chunks
+from fake_openai_server import FakeOpenAIServer
+from openai import OpenAI
+import numpy as np
+from src.data.connection_pool import close_pool
+import tempfile
+import os
+
+model = "text-embedding-3-small"
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = embedding_cache_db_connection(os.path.join(self.tmp_dir.name, "cache.db"))
+
+    def tearDown(self):
+        close_pool(self.cache.db_name)
+        self.tmp_dir.cleanup()
+
+    def test_get_put(self):
+        vector = np.arange(8, dtype="float32")
+        self.cache.put_many(model, [["a", vector], ["b", vector * 2]])
+
+        found = self.cache.get_many(model, ["a", "b", "c"])
+        self.assertEqual(set(found), {"a", "b"})
+        np.testing.assert_array_equal(found["b"], vector * 2)
+        self.assertEqual(self.cache.get_many("other-model", ["a"]), {})
+
+        stats = self.cache.size()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["bytes"], 2 * vector.nbytes)
+
+        return
+
+    def test_evict_and_vacuum(self):
+        vector = np.zeros(256, dtype="float32")
+        self.cache.put_many(model, [[str(i), vector] for i in range(10)])
+        self.cache.get_many(model, ["8", "9"])
+
+        #least recently used entries go first
+        self.assertEqual(self.cache.evict(max_bytes=2 * vector.nbytes), 8)
+        self.assertEqual(set(self.cache.get_many(model, [str(i) for i in range(10)])), {"8", "9"})
+        self.assertEqual(self.cache.evict(older_than_days=-1), 2)
+        self.cache.vacuum()
+        self.assertEqual(self.cache.size()["entries"], 0)
+
+        return
+
+    def test_reingestion_only_embeds_changed_chunks(self):
+        chunks = [f"paragraph {i} of the curtain wall spec" for i in range(20)]
+        with FakeOpenAIServer() as server:
+            client = OpenAI(api_key="test", base_url=server.base_url)
+            first = embed_chunks(client, chunks, model, [8] * 20, max_inputs=8, cache=self.cache)
+
+            #edit two chunks; only those should be sent to the API
+            edited = chunks[:5] + ["an edited paragraph", "another edited paragraph"] + chunks[7:]
+            server.requests.clear()
+            second = embed_chunks(client, edited, model, [8] * 20, max_inputs=8, cache=self.cache)
+            self.assertEqual(server.requests, [["an edited paragraph", "another edited paragraph"]])
+
+            self.assertEqual([e[0] for e in second], edited)
+            for i in list(range(5)) + list(range(7, 20)):
+                np.testing.assert_array_equal(first[i][1], second[i][1])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
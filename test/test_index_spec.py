@@ -0,0 +1,93 @@
+import unittest
+from src.service.index_spec import build_index, parse_index_spec, default_nlist, default_pq_m, normalize
+from src.service.context import Context
+import numpy as np
+import faiss
+
+def clustered_vectors(n : int, d : int = 32, clusters : int = 50, seed : int = 0) -> np.ndarray:
+    #embeddings of real documents are clustered by topic, which is what the approximate indexes rely on
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, d))
+    vectors = centers[rng.integers(0, clusters, n)] + 0.3 * rng.standard_normal((n, d))
+    vectors = vectors.astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+class MyTestCase(unittest.TestCase):
+
+    def test_parse_index_spec(self):
+        self.assertEqual(parse_index_spec("flat"), ("flat", {}))
+        self.assertEqual(parse_index_spec("HNSW:M=16,efSearch=128"), ("hnsw", {"m": 16, "efsearch": 128}))
+        with self.assertRaises(ValueError):
+            parse_index_spec("lsh")
+        with self.assertRaises(ValueError):
+            parse_index_spec("ivf:nlist=many")
+        with self.assertRaises(ValueError):
+            Context("test", index_spec="annoy")
+
+        return
+
+    def test_defaults(self):
+        self.assertEqual(default_nlist(10), 1)
+        self.assertEqual(default_nlist(10000), 256)
+        self.assertEqual(default_nlist(1000000), 4000)
+        self.assertEqual(default_pq_m(1536), 192)
+        self.assertEqual(default_pq_m(100), 10)
+
+        return
+
+    def test_recall_against_flat(self):
+        #queries are held out from the same distribution as the chunks
+        vectors = clustered_vectors(12100)
+        vectors, queries = vectors[:12000], vectors[12000:]
+        _, expected = build_index(vectors, "flat").search(queries, 10)
+
+        for spec, min_recall in [("ivf", 0.9), ("hnsw", 0.9), ("ivfpq", 0.3)]:
+            index = build_index(vectors, spec)
+            self.assertTrue(index.is_trained)
+            self.assertEqual(index.ntotal, len(vectors))
+            _, found = index.search(queries, 10)
+            recall = np.mean([len(set(f) & set(e)) / 10 for f, e in zip(found, expected)])
+            self.assertGreaterEqual(recall, min_recall, spec)
+
+        return
+
+    def test_small_contexts(self):
+        vectors = clustered_vectors(100)
+        #too few vectors to train PQ codebooks, so ivfpq builds an ivf index instead
+        self.assertIsInstance(build_index(vectors, "ivfpq"), faiss.IndexIVFFlat)
+        index = build_index(vectors, "ivf:nlist=2,nprobe=5")
+        self.assertEqual((index.nlist, index.nprobe), (2, 2))
+
+        #an approximate index can't return more chunks than it finds
+        context = Context("test", "doc.docx", [[f"chunk {i}", v] for i, v in enumerate(vectors[:20])], index_spec="ivf:nlist=1")
+        self.assertEqual(context.query_similar(vectors[0], k=30).count("Chunk from FAISS"), 20)
+        np.testing.assert_allclose(context.get_vectors(), vectors[:20], atol=1e-6)
+
+        return
+
+    def test_metrics(self):
+        rng = np.random.default_rng(2)
+        embeddings = [[f"chunk {i}", v] for i, v in enumerate(rng.standard_normal((200, 32)).astype("float32") * 5)]
+        query_vector = rng.standard_normal(32) * 3
+        vectors = normalize([e[1] for e in embeddings])
+        cosine = vectors @ normalize(query_vector)[0]
+        expected = np.argsort(-cosine)[:10]
+
+        for metric in ["l2", "cosine"]:
+            context = Context("test", "doc.docx", embeddings, metric=metric)
+            D, I = context.index.search(normalize(query_vector), 10)
+            np.testing.assert_array_equal(I[0], expected)
+            #both compare unit vectors: cosine reports the similarity, l2 the squared distance 2 - 2 * similarity
+            np.testing.assert_allclose(D[0], cosine[expected] if metric == "cosine" else 2 - 2 * cosine[expected], atol=1e-5)
+            #the length of the query doesn't change the result
+            self.assertEqual(context.query_similar(query_vector), context.query_similar(query_vector * 100))
+
+        with self.assertRaises(ValueError):
+            Context("test", metric="dot")
+        self.assertEqual(build_index(vectors, "hnsw", "cosine").metric_type, faiss.METRIC_INNER_PRODUCT)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+from src.data.context_database import context_db_connection
+from src.data.connection_pool import close_pool
+from src.service.customGPT import CustomGPT
+from src.service.ingestion import ingest_documents
+from fake_openai_server import FakeOpenAIServer, fake_embedding, make_gpt
+from unittest.mock import patch
+from docx import Document
+from pathlib import Path
+import test_chunking
+import tempfile
+import os
+
+os.environ.setdefault("API_KEY", "test") #read_custom_gpt_by_name creates clients with this key; no requests are made
+
+def ingesting_gpt(base_url : str) -> CustomGPT:
+    #no contexts of its own, and small embedding batches so a document takes several requests
+    return make_gpt(base_url, contexts=(), embedding_batch_size=8)
+
+def write_docx(path : Path, paragraphs : list) -> None:
+    doc = Document()
+    for paragraph in paragraphs:
+        doc.add_paragraph(paragraph)
+    doc.save(str(path))
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmp_dir.name)
+        self.db_name = str(self.folder / "test.db")
+        self.db = context_db_connection(self.db_name, faiss_dir=self.tmp_dir.name)
+        self.db.initialize_with_entries()
+        self.docs = []
+        for i in range(3):
+            self.docs.append(self.folder / f"spec_{i}.docx")
+            write_docx(self.docs[-1], [f"Section {j} of spec {i} covers anchors, mullions and glazing." for j in range(40)])
+        for i in range(2):
+            self.docs.append(self.folder / f"notes_{i}.txt")
+            self.docs[-1].write_text("\n".join(f"Note {j} of file {i} about sealant joints." for j in range(30)), encoding="utf-8")
+        #chunk on a byte-level encoding so the test doesn't need to download one; forked workers inherit the patch
+        patcher = patch("tiktoken.encoding_for_model", return_value=test_chunking.encoding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        close_pool(self.db_name)
+        self.tmp_dir.cleanup()
+
+    def embedded_chunks(self, server : FakeOpenAIServer) -> int:
+        return sum(len(inputs) for inputs in server.requests)
+
+    def test_ingest_and_resume(self):
+        reports = []
+        with FakeOpenAIServer() as server:
+            gpt = ingesting_gpt(server.base_url)
+            contexts = ingest_documents(self.db, gpt, self.docs, chunk_size=64, parse_workers=2, progress=reports.append)
+            first_run = self.embedded_chunks(server)
+
+            self.assertEqual(sorted(contexts), sorted(doc.stem for doc in self.docs))
+            self.assertEqual(sorted(gpt.contexts), sorted(contexts))
+            self.assertEqual(len(self.db.get_ingestion_checkpoints()), 5)
+            self.assertEqual(first_run, sum(len(context.chunks) for context in contexts.values()))
+            self.assertEqual(sorted(r["document"] for r in reports), sorted(contexts))
+            self.assertEqual(reports[-1]["done"], 5)
+            self.assertGreater(reports[-1]["chunks_per_second"], 0)
+
+            #nothing has changed, so a rerun reads every context back without embedding anything
+            rerun_gpt = ingesting_gpt(server.base_url)
+            reread = ingest_documents(self.db, rerun_gpt, self.docs, chunk_size=64, parse_workers=0, progress=None)
+            self.assertEqual(self.embedded_chunks(server), first_run)
+            for name, context in contexts.items():
+                self.assertTrue(reread[name] == context)
+
+            #an edited document is ingested again, and only it
+            self.docs[3].write_text("A new note about fire stopping.", encoding="utf-8")
+            ingest_documents(self.db, rerun_gpt, self.docs, chunk_size=64, parse_workers=0, progress=None)
+            self.assertEqual(server.requests[-1], ["A new note about fire stopping."])
+            self.assertEqual(rerun_gpt.contexts["notes_0"].chunks, ["A new note about fire stopping."])
+            self.assertEqual(self.db.read_context_by_name("notes_0").chunks, ["A new note about fire stopping."])
+
+            #other chunking settings make for other contexts
+            ingest_documents(self.db, rerun_gpt, self.docs[:1], chunk_size=32, parse_workers=0, progress=None)
+            self.assertGreater(len(self.db.read_context_by_name("spec_0").chunks), len(contexts["spec_0"].chunks))
+
+        return
+
+    def test_chunk_sources(self):
+        with FakeOpenAIServer() as server:
+            gpt = ingesting_gpt(server.base_url)
+            ingested = ingest_documents(self.db, gpt, self.docs, chunk_size=64, parse_workers=0, progress=None)
+            built = ingesting_gpt(server.base_url).add_context_from_docx("spec_0", str(self.docs[0]), chunk_size=64)
+            hit = gpt.contexts["notes_1"].search(fake_embedding("Note 7 of file 1 about sealant joints."), 1)[0]
+
+        #each paragraph fits in a chunk, and the chunks are cut on paragraph starts
+        self.assertEqual(ingested["spec_0"].sources, [(j, j) for j in range(1, 41)])
+        self.assertEqual(built.sources, ingested["spec_0"].sources)
+        self.assertEqual(built.chunks, ingested["spec_0"].chunks)
+        #lines are shorter than chunks, so chunks span several of them
+        sources = ingested["notes_1"].sources
+        self.assertEqual(sources[:2], [(1, 2), (2, 4)])
+        self.assertEqual(sources[-1][1], 30)
+        self.assertEqual(self.db.read_context_by_name("notes_1").sources, sources)
+        self.assertEqual(hit.source, sources[hit.chunk_id])
+
+        return
+
+    def test_edited_documents_are_diffed(self):
+        paragraphs = [f"Section {j} of spec 0 covers anchors, mullions and glazing." for j in range(40)]
+        with FakeOpenAIServer() as server:
+            before = ingest_documents(self.db, ingesting_gpt(server.base_url), self.docs[:1], chunk_size=64,
+                                      boundary="paragraph", parse_workers=0, progress=None)["spec_0"]
+            embedded = self.embedded_chunks(server)
+
+            paragraphs[5] = "Section 5 now covers fire stopping."
+            del paragraphs[30]
+            write_docx(self.docs[0], paragraphs)
+            gpt = ingesting_gpt(server.base_url)
+            after = ingest_documents(self.db, gpt, self.docs[:1], chunk_size=64,
+                                     boundary="paragraph", parse_workers=0, progress=None)["spec_0"]
+
+        #only the edited paragraph is embedded, and unchanged chunks keep their ids
+        self.assertEqual(self.embedded_chunks(server) - embedded, 1)
+        self.assertEqual(server.requests[-1], ["Section 5 now covers fire stopping."])
+        self.assertEqual(after.chunk_ids, [i for i in before.chunk_ids if i not in (5, 30)] + [40])
+        #chunks after the removed paragraph moved up one
+        in_order = sorted(zip(after.sources, after.chunks))
+        self.assertEqual(in_order, [((j, j), paragraph) for j, paragraph in enumerate(paragraphs, start=1)])
+        stored = self.db.read_context_by_name("spec_0")
+        self.assertEqual((stored.chunk_ids, stored.chunks, stored.sources), (after.chunk_ids, after.chunks, after.sources))
+        hit = gpt.contexts["spec_0"].search(fake_embedding("Section 5 now covers fire stopping."), 1)[0]
+        self.assertEqual((hit.chunk_id, hit.source), (40, (6, 6)))
+
+        return
+
+    def test_gpts_keep_reingested_contexts(self):
+        with FakeOpenAIServer() as server:
+            gpt = ingesting_gpt(server.base_url)
+            ingest_documents(self.db, gpt, self.docs[:2], chunk_size=64, parse_workers=0, progress=None)
+            self.db.write_custom_gpt(gpt)
+
+            #an edited document is updated chunk by chunk, and other settings rebuild it; either way it keeps its row
+            write_docx(self.docs[0], ["Spec 0 now covers fire stopping."])
+            ingest_documents(self.db, ingesting_gpt(server.base_url), self.docs[:2], chunk_size=64, parse_workers=0, progress=None)
+            self.assertEqual(self.db.read_custom_gpt_by_name("Testgpt").contexts["spec_0"].chunks, ["Spec 0 now covers fire stopping."])
+            rebuilt = ingest_documents(self.db, ingesting_gpt(server.base_url), self.docs[:2], chunk_size=32, parse_workers=0, progress=None)
+
+        read_gpt = self.db.read_custom_gpt_by_name("Testgpt")
+        self.assertEqual(sorted(read_gpt.contexts), ["spec_0", "spec_1"])
+        for name in read_gpt.contexts:
+            self.assertEqual(read_gpt.contexts[name].chunks, rebuilt[name].chunks)
+        self.assertGreater(len(rebuilt["spec_1"].chunks), 40)
+
+        return
+
+    def test_failed_documents_are_retried(self):
+        self.docs[1].write_bytes(b"not a docx file")
+        with FakeOpenAIServer() as server:
+            with self.assertRaises(RuntimeError):
+                ingest_documents(self.db, ingesting_gpt(server.base_url), self.docs, chunk_size=64, parse_workers=2, progress=None)
+            self.assertEqual(sorted(Path(path).stem for path in self.db.get_ingestion_checkpoints()),
+                             ["notes_0", "notes_1", "spec_0", "spec_2"])
+
+            write_docx(self.docs[1], ["Spec 1 is back."])
+            embedded = self.embedded_chunks(server)
+            gpt = ingesting_gpt(server.base_url)
+            ingest_documents(self.db, gpt, self.docs, chunk_size=64, parse_workers=2, progress=None)
+            self.assertEqual(self.embedded_chunks(server) - embedded, 1)
+            self.assertEqual(len(gpt.contexts), 5)
+
+        with self.assertRaises(ValueError):
+            ingest_documents(self.db, gpt, [self.docs[0], self.folder / "other" / "spec_0.txt"])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
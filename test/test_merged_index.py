@@ -0,0 +1,83 @@
+import unittest
+from src.service.merged_index import MergedIndex
+from src.service.context import Context
+from src.service.customGPT import CustomGPT
+from fake_openai_server import FakeOpenAIServer
+import numpy as np
+
+def random_embeddings(n : int, prefix : str, d : int = 32, seed : int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    return [[f"{prefix} chunk {i}", rng.standard_normal(d).astype("float32")] for i in range(n)]
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.contexts = {f"context_{i}": Context(f"context_{i}", "doc.docx", random_embeddings(20 + i, f"context_{i}", seed=i)) for i in range(4)}
+
+    def brute_force(self, contexts : dict, query_vector : np.ndarray, k : int) -> list:
+        scored = []
+        for context in contexts.values():
+            for chunk, vector in context.embeddings:
+                scored.append((float(np.sum((query_vector - vector / np.linalg.norm(vector)) ** 2)), context.name, chunk))
+        return [(name, chunk) for _, name, chunk in sorted(scored)[:k]]
+
+    def test_global_top_k(self):
+        merged = MergedIndex()
+        for name, context in self.contexts.items():
+            merged.add_context(name, context)
+        self.assertEqual(len(merged), sum(len(c.chunks) for c in self.contexts.values()))
+
+        query_vector = np.random.default_rng(10).standard_normal(32).astype("float32")
+        hits = merged.search(query_vector, k=5)
+        self.assertEqual([(hit.context, hit.text) for hit in hits], self.brute_force(self.contexts, query_vector, 5))
+        self.assertEqual([hit.score for hit in hits], sorted((hit.score for hit in hits), reverse=True))
+
+        return
+
+    def test_incremental_updates(self):
+        merged = MergedIndex()
+        for name, context in self.contexts.items():
+            merged.add_context(name, context)
+        merged.remove_context("context_1")
+        merged.add_context("context_4", Context("context_4", "doc.docx", random_embeddings(7, "context_4", seed=4)))
+
+        remaining = {name: c for name, c in self.contexts.items() if name != "context_1"}
+        remaining["context_4"] = merged.contexts["context_4"]
+        query_vector = np.random.default_rng(11).standard_normal(32).astype("float32")
+        hits = merged.search(query_vector, k=len(merged))
+        self.assertNotIn("context_1", {hit.context for hit in hits})
+        self.assertEqual([(hit.context, hit.text) for hit in hits], self.brute_force(remaining, query_vector, len(merged)))
+
+        with self.assertRaises(ValueError):
+            merged.remove_context("context_1")
+        with self.assertRaises(ValueError):
+            merged.add_context("context_x", Context("context_x", "doc.docx", random_embeddings(3, "x", d=8)))
+
+        return
+
+    def test_query_with_merged_index(self):
+        with FakeOpenAIServer(dimensions=32) as server:
+            client = CustomGPT(name="Testgpt",
+                               model="gpt-4-turbo",
+                               context_embedding_model="text-embedding-3-small",
+                               initial_role="",
+                               initial_context="",
+                               merged_index=True,
+                               api_key="test",
+                               base_url=server.base_url)
+            for context in self.contexts.values():
+                context.token_counts = [len(chunk.split()) for chunk in context.chunks]
+                client.add_context(context)
+            client.remove_context("context_0")
+            self.assertEqual(len(client.merged_index), sum(len(c.chunks) for name, c in self.contexts.items() if name != "context_0"))
+
+            client.query("What anchors a curtain wall?", k=3)
+            prompt = server.chat_requests[-1][-1]["content"]
+            #three chunks in total, each labelled with the context it came from
+            self.assertEqual(prompt.count(" chunk "), 3)
+            self.assertNotIn("context_0", prompt)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
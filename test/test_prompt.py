@@ -0,0 +1,42 @@
+import unittest
+from src.service.prompt import pack_hits
+from src.service.retrieval import Hit
+
+hits = [Hit("a", 0, 0.9, "first", 40),
+        Hit("b", 0, 0.7, "third", 30),
+        Hit("a", 1, 0.8, "second", 50),
+        Hit("b", 1, 0.6, "fourth", 10)]
+
+class MyTestCase(unittest.TestCase):
+
+    def test_packs_highest_scores_first(self):
+        packed, usage = pack_hits(hits, token_budget=100)
+        #first (40) + second (50) leave 10 tokens, so third (30) is dropped but the smaller fourth (10) still fits
+        self.assertEqual([hit.text for hit in packed], ["first", "second", "fourth"])
+        self.assertEqual(usage, {"token_budget": 100, "tokens_used": 100, "tokens_dropped": 30,
+                                 "chunks_used": 3, "chunks_dropped": 1})
+
+        return
+
+    def test_no_budget(self):
+        packed, usage = pack_hits(hits)
+        self.assertEqual([hit.score for hit in packed], [0.9, 0.8, 0.7, 0.6])
+        self.assertEqual((usage["tokens_used"], usage["tokens_dropped"]), (130, 0))
+
+        return
+
+    def test_missing_token_counts(self):
+        uncounted = [Hit("a", 0, 0.9, "one two three"), Hit("a", 1, 0.5, "four five")]
+        counted = []
+        packed, usage = pack_hits(uncounted, 3, lambda text: counted.append(text) or len(text.split()))
+        self.assertEqual([hit.chunk_id for hit in packed], [0])
+        self.assertEqual((usage["tokens_used"], usage["tokens_dropped"]), (3, 2))
+        self.assertEqual(counted, ["one two three", "four five"])
+
+        with self.assertRaises(ValueError):
+            pack_hits(uncounted, 3)
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
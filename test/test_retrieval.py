@@ -0,0 +1,87 @@
+import unittest
+from src.service.retrieval import Hit, mmr
+from src.service.merged_index import MergedIndex
+from src.service.context import Context
+import numpy as np
+
+def embeddings_with_duplicates(seed : int = 0) -> tuple:
+    #five copies of one chunk sit right next to the query, the other chunks are spread further out
+    rng = np.random.default_rng(seed)
+    query_vector = rng.standard_normal(32).astype("float32")
+    near = query_vector + 0.1 * rng.standard_normal(32).astype("float32")
+    vectors = [near + 0.001 * rng.standard_normal(32).astype("float32") for _ in range(5)]
+    vectors += list(query_vector + 1.0 * rng.standard_normal((45, 32)).astype("float32"))
+    return query_vector, [[f"chunk {i}", v] for i, v in enumerate(vectors)]
+
+class MyTestCase(unittest.TestCase):
+
+    def test_hits(self):
+        query_vector, embeddings = embeddings_with_duplicates()
+        vectors = np.array([e[1] for e in embeddings])
+        cosine = vectors @ query_vector / np.linalg.norm(vectors, axis=1) / np.linalg.norm(query_vector)
+
+        for metric in ["l2", "cosine"]:
+            context = Context("test", "doc.docx", embeddings, metric=metric)
+            hits = context.search(query_vector, k=8)
+            self.assertTrue(all(isinstance(hit, Hit) and hit.context == "test" for hit in hits))
+            self.assertEqual([hit.chunk_id for hit in hits], list(np.argsort(-cosine)[:8]))
+            np.testing.assert_allclose([hit.score for hit in hits], np.sort(cosine)[::-1][:8], atol=1e-5)
+            self.assertEqual([hit.text for hit in hits], [embeddings[hit.chunk_id][0] for hit in hits])
+
+        return
+
+    def test_k_is_clamped(self):
+        _, embeddings = embeddings_with_duplicates()
+        context = Context("test", "doc.docx", embeddings[:3])
+        hits = context.search(embeddings[0][1], k=10)
+        self.assertEqual(sorted(hit.chunk_id for hit in hits), [0, 1, 2])
+        #previously the -1 ids FAISS pads with turned into repeats of the last chunk
+        self.assertEqual(context.query_similar(embeddings[0][1], k=10).count("Chunk from FAISS"), 3)
+        self.assertEqual(context.search(embeddings[0][1], k=0), [])
+
+        return
+
+    def test_score_threshold(self):
+        query_vector, embeddings = embeddings_with_duplicates()
+        context = Context("test", "doc.docx", embeddings)
+        hits = context.search(query_vector, k=50, score_threshold=0.9)
+        self.assertEqual(sorted(hit.chunk_id for hit in hits), [0, 1, 2, 3, 4])
+        self.assertTrue(all(hit.score >= 0.9 for hit in hits))
+
+        return
+
+    def test_mmr_drops_near_duplicates(self):
+        query_vector, embeddings = embeddings_with_duplicates()
+        context = Context("test", "doc.docx", embeddings)
+        self.assertEqual(sorted(hit.chunk_id for hit in context.search(query_vector, k=5)), [0, 1, 2, 3, 4])
+
+        hits = context.search(query_vector, k=5, mmr_diversity=0.5)
+        self.assertEqual(len(hits), 5)
+        self.assertEqual(len([hit for hit in hits if hit.chunk_id < 5]), 1)
+        #the most relevant chunk is still picked first
+        self.assertLess(hits[0].chunk_id, 5)
+
+        #the same with the vectors only in the index, as for a memory-mapped context
+        context.set_chunks(context.chunks)
+        self.assertEqual(context.search(query_vector, k=5, mmr_diversity=0.5), hits)
+
+        #and across contexts in a merged index
+        merged = MergedIndex()
+        merged.add_context("test", Context("test", "doc.docx", embeddings))
+        self.assertEqual([hit.chunk_id for hit in merged.search(query_vector, k=5, mmr_diversity=0.5)], [hit.chunk_id for hit in hits])
+        self.assertEqual(len(merged.search(query_vector, k=50, score_threshold=0.9)), 5)
+
+        return
+
+    def test_mmr_without_diversity_keeps_ranking(self):
+        rng = np.random.default_rng(3)
+        vectors = rng.standard_normal((10, 8))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        scores = rng.random(10)
+        self.assertEqual(mmr(vectors, scores, 4, 0.0), list(np.argsort(-scores)[:4]))
+        self.assertEqual(mmr(vectors[:0], scores[:0], 4, 0.5), [])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import unittest
+from src.service.session_store import SessionStore, approximate_gpt_bytes
+from src.service.customGPT import CustomGPT
+from fake_openai_server import FakeOpenAIServer, make_gpt
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+import time
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.clock = 1000.0
+        patcher = patch("src.service.session_store.time.monotonic", lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load_gpt(self, name : str) -> CustomGPT:
+        self.loads.append(name)
+        return make_gpt(name=name) if name.startswith("gpt") else None
+
+    def test_sessions_share_gpt_but_not_history(self):
+        store = SessionStore(self.load_gpt)
+        gpt_a, history_a = store.get("gpt1", "alice")
+        gpt_b, history_b = store.get("gpt1", "bob")
+        self.assertIs(gpt_a, gpt_b)
+        self.assertIsNot(history_a, history_b)
+        self.assertEqual(self.loads, ["gpt1"])
+
+        history_a.append("user", "hello")
+        self.assertEqual(len(store.get("gpt1", "alice")[1]), 2)
+        self.assertEqual(len(store.get("gpt1", "bob")[1]), 1)
+        self.assertEqual(store.get("unknown", "alice"), (None, None))
+
+        return
+
+    def test_lru_and_ttl(self):
+        store = SessionStore(self.load_gpt, max_sessions=2, session_ttl=60, gpt_ttl=300)
+        store.get("gpt1", "a")
+        store.get("gpt1", "b")
+        store.get("gpt1", "a")
+        store.get("gpt1", "c")
+        #b was the least recently used session
+        self.assertEqual(list(store._sessions), [("gpt1", "a"), ("gpt1", "c")])
+
+        self.clock += 120
+        store.get("gpt2", "a")
+        self.assertEqual(store.stats()["sessions"]["per_gpt"], {"gpt2": 1})
+        self.clock += 400
+        store.get("gpt2", "a")
+        self.assertEqual([g["name"] for g in store.stats()["gpts"]], ["gpt2"])
+        self.assertEqual(store.stats()["evictions"], {"gpts": 1, "sessions": 3})
+
+        return
+
+    def test_memory_cap_unloads_least_recently_used_gpt(self):
+        gpt_bytes = approximate_gpt_bytes(make_gpt(name="gpt0"))
+        store = SessionStore(self.load_gpt, max_memory_bytes=int(gpt_bytes * 2.5))
+        for name in ["gpt1", "gpt2", "gpt1", "gpt3"]:
+            gpt, history = store.get(name, "alice")
+            history.append("user", f"hello {name}")
+
+        stats = store.stats()
+        self.assertEqual(sorted(g["name"] for g in stats["gpts"]), ["gpt1", "gpt3"])
+        self.assertLessEqual(stats["approx_bytes"], stats["max_memory_bytes"])
+        #the running total matches what walking every GPT and conversation would give
+        self.assertEqual(store._memory_bytes(), stats["approx_bytes"])
+        self.assertEqual(store._memory_bytes(), sum(approximate_gpt_bytes(e[0]) for e in store._gpts.values())
+                         + sum(sys.getsizeof(m["content"]) for s in store._sessions.values() for m in s[0]))
+        #the conversation with the unloaded GPT survives and continues with a freshly loaded copy
+        gpt2, history = store.get("gpt2", "alice")
+        self.assertEqual(history[-1]["content"], "hello gpt2")
+        self.assertEqual(history.count_tokens, gpt2.count_tokens)
+        self.assertEqual(self.loads, ["gpt1", "gpt2", "gpt3", "gpt2"])
+
+        #conversations that are no longer resident stop counting, even if they are still being answered
+        store.end_session("gpt2", "alice")
+        memory = store._memory_bytes()
+        history.append("assistant", "late answer")
+        self.assertEqual(store._memory_bytes(), memory)
+
+        return
+
+    def test_concurrent_first_requests_share_one_load(self):
+        release = threading.Event()
+        def slow_load(name):
+            self.loads.append(name)
+            release.wait(5)
+            return make_gpt(name=name) if name.startswith("gpt") else None
+
+        store = SessionStore(slow_load)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            gets = [executor.submit(store.get, name, f"session_{i}") for i, name in enumerate(["gpt1"] * 6 + ["unknown"] * 2)]
+            while len(self.loads) < 2:
+                time.sleep(0.01)
+            self.assertEqual(store.stats()["loading"], ["gpt1", "unknown"])
+            release.set()
+            results = [get.result() for get in gets]
+
+        self.assertEqual(sorted(self.loads), ["gpt1", "unknown"])
+        self.assertEqual(len({id(gpt) for gpt, _ in results[:6]}), 1)
+        self.assertEqual(len({id(history) for _, history in results[:6]}), 6)
+        self.assertEqual(results[6:], [(None, None), (None, None)])
+        self.assertEqual(store.stats()["loading"], [])
+
+        return
+
+    def test_failed_load_is_retried(self):
+        def failing_load(name):
+            self.loads.append(name)
+            if len(self.loads) == 1:
+                raise RuntimeError("database is locked")
+            return make_gpt(name=name)
+
+        store = SessionStore(failing_load)
+        with self.assertRaises(RuntimeError):
+            store.preload("gpt1")
+        self.assertTrue(store.preload("gpt1"))
+        store.get("gpt1", "alice")
+        self.assertEqual(self.loads, ["gpt1", "gpt1"])
+
+        return
+
+    def test_preload_gpts(self):
+        from src.app import state
+
+        store = SessionStore(self.load_gpt)
+        with patch.object(state, "get_all_gpt_info", lambda: [{"name": "gpt1", "model": "m"}, {"name": "gpt2", "model": "m"}, {"name": "gone", "model": "m"}]):
+            state.preload_gpts(store, max_workers=2).join(10)
+
+        self.assertEqual(sorted(g["name"] for g in store.stats()["gpts"]), ["gpt1", "gpt2"])
+        store.get("gpt1", "alice")
+        self.assertEqual(sorted(self.loads), ["gone", "gpt1", "gpt2"])
+
+        return
+
+    def test_background_tasks_start_once(self):
+        from src.app import state, routes
+        from src.app.app import create_app
+
+        with patch.object(state, "preload_gpts") as preload_gpts, patch.object(state, "watch_for_updates") as watch_for_updates, \
+             patch("src.app.app.check_database"):
+            #an app factory called again, e.g. by a reloader or per test, doesn't start another set of threads
+            create_app(preload=True, reload_interval=5)
+            create_app(preload=True, reload_interval=5)
+            self.assertEqual((preload_gpts.call_count, watch_for_updates.call_count), (1, 1))
+            self.assertFalse(state.start_background_tasks(routes.session_store, preload=True, reload_interval=5))
+            #another store has tasks of its own
+            self.assertTrue(state.start_background_tasks(SessionStore(self.load_gpt), preload=True, reload_interval=5))
+            self.assertEqual((preload_gpts.call_count, watch_for_updates.call_count), (2, 2))
+
+        return
+
+    def test_refresh_swaps_in_changed_gpts(self):
+        generations = {"gpt1": 1, "gpt2": 1}
+        def load_gpt(name):
+            self.loads.append(name)
+            if name not in generations:
+                return None
+            gpt = make_gpt(name=name)
+            gpt.generation = generations[name]
+            return gpt
+
+        store = SessionStore(load_gpt, get_generations=lambda: dict(generations))
+        old_gpt1, history = store.get("gpt1", "alice")
+        old_gpt2, _ = store.get("gpt2", "bob")
+        history.append("user", "hello")
+        self.assertEqual(store.refresh(), [])
+
+        generations["gpt1"] = 2
+        del generations["gpt2"]
+        self.assertEqual(store.refresh(), ["gpt1", "gpt2"])
+        new_gpt1, same_history = store.get("gpt1", "alice")
+        self.assertIsNot(new_gpt1, old_gpt1)
+        self.assertEqual(new_gpt1.generation, 2)
+        #the conversation carries on with the new copy and no longer refers to the old one
+        self.assertIs(same_history, history)
+        self.assertEqual(history.count_tokens, new_gpt1.count_tokens)
+        self.assertEqual([g["name"] for g in store.stats()["gpts"]], ["gpt1"])
+        self.assertEqual((store.stats()["reloads"], store.stats()["evictions"]["gpts"]), (1, 0))
+        self.assertEqual(store.get("gpt2", "bob"), (None, None))
+        self.assertEqual(self.loads, ["gpt1", "gpt2", "gpt1", "gpt2"])
+
+        return
+
+    def test_refresh_keeps_old_copy_when_reload_fails(self):
+        generations = {"gpt1": 1}
+        def load_gpt(name):
+            if generations[name] == 2:
+                raise RuntimeError("index file not written yet")
+            gpt = make_gpt(name=name)
+            gpt.generation = generations[name]
+            return gpt
+
+        store = SessionStore(load_gpt, get_generations=lambda: dict(generations))
+        gpt, _ = store.get("gpt1", "alice")
+        generations["gpt1"] = 2
+        self.assertEqual(store.refresh(), [])
+        self.assertIs(store.get("gpt1", "alice")[0], gpt)
+        generations["gpt1"] = 3
+        self.assertEqual(store.refresh(), ["gpt1"])
+        self.assertEqual(store.get("gpt1", "alice")[0].generation, 3)
+
+        return
+
+    def test_routes(self):
+        from src.app import routes
+        from flask import Flask
+
+        with FakeOpenAIServer() as server:
+            store = SessionStore(lambda name: make_gpt(server.base_url, name=name, initial_role="you are gpt1") if name == "gpt1" else None)
+            app = Flask(__name__)
+            app.register_blueprint(routes.chat_blueprint, url_prefix="/chat")
+            with patch.object(routes, "session_store", store), patch.dict("os.environ", {"ADMIN_TOKEN": "secret"}), app.test_client() as client:
+                first = client.post("/chat/query", json={"gpt_name": "gpt1", "message": "hi"}).get_json()
+                client.post("/chat/query", json={"gpt_name": "gpt1", "message": "again", "session_id": first["session_id"]})
+                client.post("/chat/query", json={"gpt_name": "gpt1", "message": "someone else"})
+                self.assertEqual(client.post("/chat/query", json={"gpt_name": "nope", "message": "hi"}).status_code, 404)
+                forbidden = [client.get("/chat/admin/sessions", headers=headers).status_code for headers in [{}, {"X-Admin-Token": "guess"}]]
+                stats = client.get("/chat/admin/sessions", headers={"X-Admin-Token": "secret"})
+
+            #session ids are what lets a client continue a conversation, so only the admin sees stats and they never hold ids
+            self.assertEqual(forbidden, [403, 403])
+            self.assertNotIn(first["session_id"], stats.get_data(as_text=True))
+            stats = stats.get_json()
+            self.assertEqual(stats["gpts"][0]["sessions"], 2)
+            self.assertEqual((stats["sessions"]["count"], stats["sessions"]["messages"]), (2, 8))
+            #the second request of the first session carries its own history, not the other session's
+            self.assertEqual([m["content"] for m in server.chat_requests[1][:-1]], ["you are gpt1", "hi", "echo: " + server.chat_requests[0][-1]["content"]])
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from src.service.session_store import SessionStore
+from fake_openai_server import FakeOpenAIServer, make_gpt
+from unittest.mock import patch
+import json
+
+class MyTestCase(unittest.TestCase):
+
+    def test_stream_matches_blocking_answer(self):
+        with FakeOpenAIServer() as server:
+            gpt = make_gpt(server.base_url)
+            blocking = gpt.query("how are curtain walls anchored", retrieve_relevant_context=False)
+            history = gpt.new_chat_history()
+            pieces = list(gpt.query_stream("how are curtain walls anchored", retrieve_relevant_context=False, chat_history=history))
+
+            self.assertGreater(len(pieces), 1)
+            self.assertEqual("".join(pieces), blocking)
+            #the finished answer is in the history just as with the blocking call
+            self.assertEqual([m["content"] for m in history], [m["content"] for m in gpt.chat_history])
+
+        return
+
+    def test_stream_closed_early_keeps_partial_answer(self):
+        with FakeOpenAIServer(token_latency=0.01) as server:
+            gpt = make_gpt(server.base_url)
+            stream = gpt.query_stream("one two three four five six", retrieve_relevant_context=False)
+            first = [next(stream), next(stream)]
+            stream.close()
+            self.assertEqual(gpt.chat_history[-1], {"role": "assistant", "content": "".join(first)})
+
+        return
+
+    def test_query_stream_route(self):
+        from src.app import routes
+        from flask import Flask
+
+        with FakeOpenAIServer() as server:
+            store = SessionStore(lambda name: make_gpt(server.base_url))
+            app = Flask(__name__)
+            app.register_blueprint(routes.chat_blueprint, url_prefix="/chat")
+            with patch.object(routes, "session_store", store), app.test_client() as client:
+                response = client.post("/chat/query_stream", json={"gpt_name": "Testgpt", "message": "hello there"})
+                self.assertEqual(response.mimetype, "text/event-stream")
+                events = [event.split("\n") for event in response.get_data(as_text=True).strip().split("\n\n")]
+
+            tokens = [json.loads(data[len("data: "):])["token"] for name, data in events if name == "event: token"]
+            self.assertEqual("".join(tokens), "echo: " + server.chat_requests[0][-1]["content"])
+            self.assertEqual(events[-1][0], "event: done")
+            session_id = json.loads(events[-1][1][len("data: "):])["session_id"]
+            self.assertEqual(response.headers["X-Session-Id"], session_id)
+            self.assertEqual(store.get("Testgpt", session_id)[1][-1]["content"], "".join(tokens))
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()